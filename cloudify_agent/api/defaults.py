@@ -27,6 +27,7 @@ CLOUDIFY_AGENT_PREFIX = 'cfy-agent'
 LOG_LEVEL = 'info'
 LOG_FILE_SIZE = 5 * 1024 * 1024
 LOG_BACKUPS = 7
+SYSTEMD_WATCHDOG_TIMEOUT = 60
 
 SSL_CERTS_TARGET_DIR = 'cloudify/ssl'
 AGENT_SSL_CERT_FILENAME = 'cloudify_internal_cert.pem'
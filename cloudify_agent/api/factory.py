@@ -15,12 +15,26 @@
 
 import os
 import json
+import tempfile
+from collections import namedtuple
 
 from cloudify.utils import setup_logger
 
 from cloudify_agent.api import exceptions
 from cloudify_agent.api import utils
 
+# the index of the daemons in the storage directory. It doesn't end with
+# .json, so that it is not mistaken for a daemon
+INDEX_FILE = 'daemons.index'
+INDEX_VERSION = 1
+# the daemon attributes that are stored in the index
+INDEX_FIELDS = ['process_management', 'queue', 'user', 'deployment_id']
+
+DaemonSummary = namedtuple('DaemonSummary', ['name'] + INDEX_FIELDS)
+
+# process management name -> daemon class
+_implementations = {}
+
 
 class DaemonFactory(object):
 
@@ -73,21 +87,22 @@ class DaemonFactory(object):
         :raise DaemonNotImplementedError: if no implementation could be found.
         """
 
-        daemons = []
+        if process_management in _implementations:
+            return _implementations[process_management]
 
         def _find_daemons(daemon_superclass):
-            daemons.append(daemon_superclass)
-            subclasses = daemon_superclass.__subclasses__()
-            if subclasses:
-                for subclass in subclasses:
-                    _find_daemons(subclass)
+            if daemon_superclass.PROCESS_MANAGEMENT:
+                _implementations.setdefault(
+                    daemon_superclass.PROCESS_MANAGEMENT, daemon_superclass)
+            for subclass in daemon_superclass.__subclasses__():
+                _find_daemons(subclass)
 
         from cloudify_agent.api.pm.base import Daemon
         _find_daemons(Daemon)
-        for daemon in daemons:
-            if daemon.PROCESS_MANAGEMENT == process_management:
-                return daemon
-        raise exceptions.DaemonNotImplementedError(process_management)
+        try:
+            return _implementations[process_management]
+        except KeyError:
+            raise exceptions.DaemonNotImplementedError(process_management)
 
     def new(self, logger=None, **attributes):
 
@@ -153,6 +168,48 @@ class DaemonFactory(object):
 
         return daemons
 
+    def list_daemons(self):
+
+        """
+        Lists the daemons in local storage, without loading them.
+
+        This only reads the daemon files that changed since they were
+        last indexed, and doesn't create daemon instances, so it's cheap
+        even with many daemons.
+
+        :return: a DaemonSummary for every daemon, sorted by name.
+        :rtype: list
+        """
+        if not os.path.exists(self.storage):
+            return []
+
+        index = self._read_index()
+        new_index = {}
+        for entry in os.scandir(self.storage):
+            if not entry.name.endswith('.json'):
+                continue
+            name = entry.name[:-len('.json')]
+            stat = entry.stat()
+            indexed = index.get(name)
+            if indexed and indexed['mtime'] == stat.st_mtime \
+                    and indexed['size'] == stat.st_size:
+                new_index[name] = indexed
+                continue
+            try:
+                daemon_as_json = utils.json_load(entry.path)
+            except (IOError, OSError, ValueError) as err:
+                self.logger.warning(
+                    'Daemon from %s load failed: %s', entry.path, err)
+                continue
+            new_index[name] = self._index_entry(daemon_as_json, stat)
+        if new_index != index:
+            self._write_index(new_index)
+        return [
+            DaemonSummary(name=name, **{
+                field: new_index[name].get(field) for field in INDEX_FIELDS})
+            for name in sorted(new_index)
+        ]
+
     def load(self, name, logger=None):
 
         """
@@ -206,6 +263,9 @@ class DaemonFactory(object):
             props = daemon.as_dict()
             json.dump(props, f, indent=2)
             f.write(os.linesep)
+        index = self._read_index()
+        index[daemon.name] = self._index_entry(props, os.stat(daemon_path))
+        self._write_index(index)
 
     def delete(self, name):
 
@@ -219,6 +279,44 @@ class DaemonFactory(object):
             self.storage, '{0}.json'.format(name))
         if os.path.exists(daemon_path):
             os.remove(daemon_path)
+        index = self._read_index()
+        if index.pop(name, None) is not None:
+            self._write_index(index)
+
+    @staticmethod
+    def _index_entry(daemon_as_json, stat):
+        entry = {field: daemon_as_json.get(field) for field in INDEX_FIELDS}
+        entry['mtime'] = stat.st_mtime
+        entry['size'] = stat.st_size
+        return entry
+
+    def _read_index(self):
+        """The index: daemon name -> its indexed fields.
+
+        The index is only a cache: entries are checked against the mtime
+        and the size of the daemon files when they are used, so a missing,
+        stale or corrupted index is never a problem.
+        """
+        try:
+            with open(os.path.join(self.storage, INDEX_FILE)) as f:
+                index = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        if not isinstance(index, dict) \
+                or index.get('version') != INDEX_VERSION:
+            return {}
+        return index.get('daemons') or {}
+
+    def _write_index(self, daemons):
+        try:
+            with tempfile.NamedTemporaryFile(
+                    'w', dir=self.storage, prefix=INDEX_FILE,
+                    suffix='.tmp', delete=False) as f:
+                json.dump({'version': INDEX_VERSION, 'daemons': daemons}, f)
+            # atomic, so that readers never see a partially written index
+            os.replace(f.name, os.path.join(self.storage, INDEX_FILE))
+        except (IOError, OSError) as e:
+            self.logger.debug('Could not write the daemons index: %s', e)
 
     def _check_existing(self, attributes):
         """Should we verify that the agent does not exist yet?
@@ -0,0 +1,135 @@
+#########
+# Copyright (c) 2024 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import os
+import threading
+import time
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from cloudify.exceptions import PluginInstallationError
+from cloudify.state import ctx, current_ctx
+from cloudify.utils import target_plugin_prefix
+
+# installing a plugin is mostly waiting for downloads and for pip, but
+# building the venv also takes cpu
+DEFAULT_MAX_PARALLEL = min(4, os.cpu_count() or 1)
+
+PluginResult = namedtuple('PluginResult', ['name', 'error', 'duration'])
+
+
+def plugin_name(plugin):
+    return plugin.get('package_name') or plugin['name']
+
+
+def install_key(plugin):
+    """What installs of the same plugin are serialized on.
+
+    Where the installer installs a plugin depends on what it finds on
+    the manager; this only uses what the plugin declares, so that it
+    doesn't cost a REST request per plugin. Two installs that the key
+    doesn't tell apart still don't break each other: the installer also
+    locks the directory that it installs to.
+    """
+    return ctx.tenant_name, plugin_name(plugin), plugin.get('package_version')
+
+
+def uninstall_dir(plugin, deployment_id=None):
+    """The directory that plugin_installer.uninstall removes."""
+    return target_plugin_prefix(
+        name=plugin_name(plugin),
+        tenant_name=ctx.tenant_name,
+        version=plugin['package_version'],
+        deployment_id=deployment_id)
+
+
+def run_for_plugins(plugins, func, action, logger,
+                    max_parallel=DEFAULT_MAX_PARALLEL, key=None):
+    """Call func(plugin) for every plugin, in up to max_parallel threads.
+
+    The current operation context is available in the threads as well.
+    A failure for one plugin doesn't stop the others.
+
+    :param action: describes func for the logs, eg. "Installing"
+    :param key: key(plugin) tells which plugins func must not work on
+        at the same time, eg. `install_key`. Defaults to the plugin name.
+    :return: a PluginResult for every plugin, in order
+    """
+    try:
+        context = current_ctx.get_ctx()
+        parameters = current_ctx.get_parameters()
+    except Exception:
+        context, parameters = None, None
+    if key is None:
+        key = plugin_name
+    locks = defaultdict(threading.Lock)
+    locks_lock = threading.Lock()
+
+    def _run(plugin):
+        name = plugin_name(plugin)
+        logger.info('%s plugin: %s', action, name)
+        started = time.time()
+        error = None
+        try:
+            with current_ctx.push(context, parameters):
+                plugin_key = key(plugin)
+                with locks_lock:
+                    lock = locks[plugin_key]
+                with lock:
+                    func(plugin)
+        except Exception as e:
+            error = e
+        duration = time.time() - started
+        if error is None:
+            logger.info('%s plugin %s done in %.1fs', action, name, duration)
+        else:
+            logger.error('%s plugin %s failed after %.1fs: %s',
+                         action, name, duration, error)
+        return PluginResult(name, error, duration)
+
+    if max_parallel is None or max_parallel < 1:
+        max_parallel = DEFAULT_MAX_PARALLEL
+    max_parallel = min(max_parallel, len(plugins))
+    if max_parallel <= 1:
+        return [_run(plugin) for plugin in plugins]
+    with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+        return list(executor.map(_run, plugins))
+
+
+def result_dicts(results):
+    """The results as json-serializable dicts, eg. for a task response."""
+    return [{
+        'name': r.name,
+        'success': r.error is None,
+        'error': None if r.error is None else str(r.error),
+        'duration': r.duration,
+    } for r in results]
+
+
+def raise_for_errors(results, action):
+    """Raise if any of the plugins failed.
+
+    A single failure is re-raised as is. Several failures are reported
+    together, in one PluginInstallationError.
+    """
+    failed = [r for r in results if r.error is not None]
+    if not failed:
+        return
+    if len(failed) == 1:
+        raise failed[0].error
+    raise PluginInstallationError(
+        'Failed {0} {1} of {2} plugins: {3}'.format(
+            action, len(failed), len(results),
+            '; '.join('{0}: {1}'.format(r.name, r.error) for r in failed)))
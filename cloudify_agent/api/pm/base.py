@@ -17,6 +17,7 @@ import getpass
 import json
 import logging
 import os
+import shlex
 import time
 
 from pika.exceptions import ConnectionClosed, ProbableAuthenticationError
@@ -27,13 +28,17 @@ from cloudify import constants
 from cloudify.amqp_client import get_client
 from cloudify.exceptions import CommandExecutionException
 
-from cloudify_agent import VIRTUALENV
+from cloudify_agent import VIRTUALENV, readiness
 from cloudify_agent.api import utils
 from cloudify_agent.api import exceptions
 from cloudify_agent.api import defaults
+from cloudify_agent.api.pm import process
 
 
 AGENT_IS_REGISTERED_TIMEOUT = 1
+# when waiting for the daemon to stop, the status is queried first after
+# this many seconds, and then with a backoff, up to the stop interval
+STATUS_INITIAL_INTERVAL = 0.25
 
 
 class Daemon(object):
@@ -294,23 +299,71 @@ class Daemon(object):
             name=self.name
         )
 
-    def _is_daemon_running(self):
+    def _is_daemon_running(self, client=None):
+        """Ping the daemon over AMQP.
+
+        :param client: a connected client to use. If not given, a new
+                       connection is opened for this check.
+        """
         self._logger.debug('Checking if agent daemon is running...')
-        client = self._get_client()
+        if client is None:
+            try:
+                with self._get_client() as client:
+                    return self._is_daemon_running(client)
+            except (ConnectionClosed, ProbableAuthenticationError):
+                self._logger.debug('Connection error, AMQP is unreachable.')
+                return False
+        # precreate the queue that the agent will use, so that the
+        # message is already waiting for the agent when it starts up
+        client.channel_method(
+            'queue_declare',
+            queue='{0}_service'.format(self.queue),
+            auto_delete=False,
+            durable=True)
+        return utils.is_agent_alive(
+            self.queue, client, timeout=3, connect=False)
+
+    def _ready_listener(self):
+        return readiness.ReadinessListener(readiness.ready_socket_path(
+            utils.internal.get_storage_directory(self.user), self.name))
+
+    def _wait_until_running(self, listener, timeout, interval):
+        """Wait for the daemon to be ready.
+
+        Returns as soon as the worker says it's ready on the listener.
+        Until then, the worker is pinged over AMQP every interval, in case
+        it can't notify us (eg. it was already running), using a single
+        connection for all the checks.
+
+        :return: whether the daemon is running
+        """
+        end_time = time.time() + timeout
+        client = None
         try:
-            with client:
-                # precreate the queue that the agent will use, so that the
-                # message is already waiting for the agent when it starts up
-                client.channel_method(
-                    'queue_declare',
-                    queue='{0}_service'.format(self.queue),
-                    auto_delete=False,
-                    durable=True)
-                return utils.is_agent_alive(
-                    self.queue, client, timeout=3, connect=False)
-        except (ConnectionClosed, ProbableAuthenticationError):
-            self._logger.debug('Connection error, AMQP is unreachable.')
-            return False
+            while time.time() < end_time:
+                message = listener.wait(
+                    min(interval, max(end_time - time.time(), 0)))
+                if message is not None:
+                    self._logger.debug('Daemon %s is ready: %s',
+                                       self.name, message)
+                    return True
+                if client is None:
+                    try:
+                        client = self._get_client()
+                        client.consume_in_thread()
+                    except (ConnectionClosed, ProbableAuthenticationError):
+                        self._logger.debug(
+                            'Connection error, AMQP is unreachable.')
+                        client = None
+                        continue
+                if self._is_daemon_running(client):
+                    return True
+                self._logger.debug('Daemon %s is still not running',
+                                   self.name)
+        finally:
+            if client is not None:
+                client.close()
+        return False
 
     ########################################################################
     # the following methods must be implemented by the sub-classes as they
@@ -421,15 +474,10 @@ class Daemon(object):
         start_command = self.start_command()
         self._logger.info('Starting daemon with command: {0}'
                           .format(start_command))
-        self._runner.run(start_command)
-        end_time = time.time() + timeout
-        while time.time() < end_time:
-            if self._is_daemon_running():
+        with self._ready_listener() as listener:
+            self._runner.run(start_command)
+            if self._wait_until_running(listener, timeout, interval):
                 return
-            self._logger.debug('Daemon {0} is still not running. '
-                               'Sleeping for {1} seconds...'
-                               .format(self.name, interval))
-            time.sleep(interval)
         self._verify_no_error()
         raise exceptions.DaemonStartupTimeout(timeout, self.name)
 
@@ -455,8 +503,15 @@ class Daemon(object):
         stop_command = self.stop_command()
         self._logger.info('Stopping daemon with command: {0}'
                           .format(stop_command))
+        # found before stopping, because stopping might remove the pid file
+        pid = self._get_worker_pid()
         self._runner.run(stop_command)
         end_time = time.time() + timeout
+        if pid is not None:
+            self._logger.debug('Waiting for the worker process %s to exit',
+                               pid)
+            process.wait_for_exit(pid, timeout, max_interval=interval)
+        delay = min(STATUS_INITIAL_INTERVAL, interval)
         while time.time() < end_time:
             self._logger.debug('Querying status of daemon {0}'.format(
                 self.name))
@@ -469,8 +524,9 @@ class Daemon(object):
                 return
             self._logger.debug('Daemon {0} is still running. '
                                'Sleeping for {1} seconds...'
-                               .format(self.name, interval))
-            time.sleep(interval)
+                               .format(self.name, delay))
+            time.sleep(delay)
+            delay = min(delay * 2, interval)
         self._verify_no_error()
         raise exceptions.DaemonShutdownTimeout(timeout, self.name)
 
@@ -506,6 +562,17 @@ class Daemon(object):
         self.start(timeout=start_timeout,
                    interval=start_interval)
 
+    def _get_worker_pid(self):
+        """The pid of the running worker process, or None if not known.
+
+        This allows waiting for the worker to exit, without querying the
+        daemon status again and again.
+        """
+        pid = process.read_pid_file(self.pid_file)
+        if pid is None or not process.is_worker_process(pid):
+            return None
+        return pid
+
     def before_self_stop(self):
         """Called before stopping the daemon.
 
@@ -555,6 +622,9 @@ class Daemon(object):
 class GenericLinuxDaemonMixin(Daemon):
     SCRIPT_DIR = None
     CONFIG_DIR = None
+    SCRIPT_MODE = 0o644
+    # the config has the agent's environment, which can hold secrets
+    CONFIG_MODE = 0o600
 
     def status_command(self):
         raise NotImplementedError('Must be implemented by a subclass')
@@ -591,20 +661,68 @@ class GenericLinuxDaemonMixin(Daemon):
             self._logger.debug('%s', e)
             return False
 
+    def configure(self):
+        """Install the script and the config.
+
+        :return: whether any of them was changed
+        """
+        return self.install_files([
+            (self._get_rendered_script(), self.script_path,
+             self.SCRIPT_MODE),
+            (self._get_rendered_config(), self.config_path,
+             self.CONFIG_MODE),
+        ])
+
     def create_script(self):
-        rendered = self._get_rendered_script()
-        self._runner.run('sudo mkdir -p {0}'.format(
-            os.path.dirname(self.script_path)))
-        self._runner.run(
-            'sudo cp {0} {1}'.format(rendered, self.script_path))
-        self._runner.run('sudo rm {0}'.format(rendered))
+        self.install_files([
+            (self._get_rendered_script(), self.script_path, self.SCRIPT_MODE)
+        ])
 
     def create_config(self):
-        rendered = self._get_rendered_config()
-        self._runner.run('sudo mkdir -p {0}'.format(
-            os.path.dirname(self.config_path)))
-        self._runner.run('sudo cp {0} {1}'.format(rendered, self.config_path))
-        self._runner.run('sudo rm {0}'.format(rendered))
+        self.install_files([
+            (self._get_rendered_config(), self.config_path, self.CONFIG_MODE)
+        ])
+
+    def install_files(self, files):
+        """Install rendered files into their privileged locations.
+
+        All the files are installed using a single sudo call. Every file
+        is first copied next to its target, and then renamed over it, so
+        that the target is never partially written. Files whose content
+        and mode are already the same are skipped, and if all of them are,
+        sudo isn't called at all.
+
+        :param files: a list of (rendered file, target path, mode).
+                      The rendered files are removed.
+        :return: whether any file was changed
+        """
+        commands = []
+        for rendered, target, mode in files:
+            if _is_installed(rendered, target, mode):
+                self._logger.debug('%s is up to date', target)
+                continue
+            self._logger.debug('Installing %s', target)
+            temp_target = '{0}.cfy-tmp'.format(target)
+            commands += [
+                'mkdir -p {0}'.format(shlex.quote(os.path.dirname(target))),
+                # not cp + chmod: the copy would be readable by everyone
+                # until its mode is changed
+                'install -m {0:o} {1} {2}'.format(
+                    mode, shlex.quote(rendered), shlex.quote(temp_target)),
+                'mv -f {0} {1}'.format(
+                    shlex.quote(temp_target), shlex.quote(target)),
+            ]
+        script = None
+        try:
+            if commands:
+                script = utils.content_to_file(
+                    'set -e\n{0}\n'.format('\n'.join(commands)))
+                self._runner.run('sudo sh {0}'.format(script))
+        finally:
+            for path in [script] + [rendered for rendered, _, _ in files]:
+                if path and os.path.exists(path):
+                    os.remove(path)
+        return bool(commands)
 
     def delete(self, force=defaults.DAEMON_FORCE_DELETE):
         try:
@@ -614,12 +732,25 @@ class GenericLinuxDaemonMixin(Daemon):
 
         self._delete()
 
-        if os.path.exists(self.script_path):
-            self._logger.debug('Deleting {0}'.format(self.script_path))
-            self._runner.run('sudo rm {0}'.format(self.script_path))
-        if os.path.exists(self.config_path):
-            self._logger.debug('Deleting {0}'.format(self.config_path))
-            self._runner.run('sudo rm {0}'.format(self.config_path))
+        paths = [path for path in (self.script_path, self.config_path)
+                 if os.path.exists(path)]
+        if paths:
+            self._logger.debug('Deleting %s', ', '.join(paths))
+            self._runner.run('sudo rm {0}'.format(
+                ' '.join(shlex.quote(path) for path in paths)))
+
+
+def _is_installed(rendered, target, mode):
+    """Is target already the same as rendered, and has the mode."""
+    try:
+        if os.stat(target).st_mode & 0o7777 != mode:
+            return False
+        with open(rendered, 'rb') as f:
+            content = f.read()
+        with open(target, 'rb') as f:
+            return f.read() == content
+    except (IOError, OSError):
+        return False
 
 
 class CronRespawnDaemonMixin(Daemon):
@@ -680,7 +811,7 @@ class CronRespawnDaemonMixin(Daemon):
             start_command=self.start_command(),
             status_command=self.status_command()
         )
-        self._runner.run('chmod +x {0}'.format(self.cron_respawn_path))
+        os.chmod(self.cron_respawn_path, 0o755)
         self._logger.debug('Rendering enable cron script from template')
         utils.render_template_to_file(
             template_path='crontab/enable.sh.template',
@@ -690,7 +821,7 @@ class CronRespawnDaemonMixin(Daemon):
             workdir=self.workdir,
             name=self.name
         )
-        self._runner.run('chmod +x {0}'.format(enable_cron_script))
+        os.chmod(enable_cron_script, 0o755)
         return enable_cron_script
 
     def create_disable_cron_script(self):
@@ -704,5 +835,5 @@ class CronRespawnDaemonMixin(Daemon):
             name=self.name,
             workdir=self.workdir
         )
-        self._runner.run('chmod +x {0}'.format(disable_cron_script))
+        os.chmod(disable_cron_script, 0o755)
         return disable_cron_script
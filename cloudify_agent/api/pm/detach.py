@@ -17,7 +17,7 @@ import os
 
 from cloudify.exceptions import CommandExecutionException
 
-from cloudify_agent import VIRTUALENV
+from cloudify_agent import VIRTUALENV, supervisor
 from cloudify_agent.api import defaults
 from cloudify_agent.api import utils
 from cloudify_agent.api import exceptions
@@ -37,6 +37,15 @@ class DetachedDaemon(CronRespawnDaemonMixin):
 
     However, the advantage of this kind of daemon is that it does not
     require privileged permissions to execute.
+
+    Following are all possible custom key-word arguments
+    (in addition to the ones available in the cron respawn mixin)
+
+    ``supervise``
+
+        run the worker under `cloudify_agent.supervisor`, which restarts
+        it within seconds if it exits, rather than waiting for cron.
+        The status is then queried from the supervisor.
     """
 
     PROCESS_MANAGEMENT = 'detach'
@@ -49,6 +58,9 @@ class DetachedDaemon(CronRespawnDaemonMixin):
         # put the pidfile in the workdir, and not in /var/run or /run,
         # so that detach doesn't need any sudo/su calls to run
         self.pid_file = os.path.join(self.workdir, '{0}.pid'.format(self.name))
+        self.supervise = params.get('supervise', False)
+        self.status_socket = os.path.join(
+            self.workdir, '{0}.status'.format(self.name))
 
     def start(self, interval=defaults.START_INTERVAL,
               timeout=defaults.START_TIMEOUT,
@@ -123,6 +135,8 @@ class DetachedDaemon(CronRespawnDaemonMixin):
         if os.path.exists(self.script_path):
             self._logger.debug('Removing {0}'.format(self.script_path))
             os.remove(self.script_path)
+        if os.path.exists(self.status_socket):
+            os.remove(self.status_socket)
 
     def start_command(self):
         if not os.path.isfile(self.script_path):
@@ -132,6 +146,9 @@ class DetachedDaemon(CronRespawnDaemonMixin):
     def stop_command(self):
         with open(self.pid_file) as f:
             pid = f.read()
+        if self.supervise:
+            # the supervisor stops the worker, and then exits
+            return 'kill {0}'.format(pid)
         return 'kill -9 {0}'.format(pid)
 
     def status_command(self):
@@ -140,6 +157,13 @@ class DetachedDaemon(CronRespawnDaemonMixin):
         return 'kill -s 0 {0}'.format(pid)
 
     def status(self):
+        if self.supervise:
+            state = supervisor.query_status(self.status_socket)
+            if state is not None:
+                self._logger.debug('Supervisor status: %s', state)
+                return bool(state.get('running'))
+            # no supervisor, or one that was started before supervise
+            # was enabled: check the pid file
         try:
             if not os.path.exists(self.pid_file):
                 return False
@@ -161,7 +185,11 @@ class DetachedDaemon(CronRespawnDaemonMixin):
             max_workers=self.max_workers,
             virtualenv_path=VIRTUALENV,
             workdir=self.workdir,
-            pid_file=self.pid_file
+            pid_file=self.pid_file,
+            supervise=self.supervise,
+            status_socket=self.status_socket,
+            supervisor_log_file=os.path.join(
+                self.log_dir, '{0}-supervisor.log'.format(self.name)),
         )
 
         # no sudo needed, yey!
@@ -39,6 +39,7 @@ class InitDDaemon(GenericLinuxDaemonMixin, CronRespawnDaemonMixin):
 
     SCRIPT_DIR = '/etc/init.d'
     CONFIG_DIR = '/etc/default'
+    SCRIPT_MODE = 0o755
     PROCESS_MANAGEMENT = 'init.d'
 
     def __init__(self, logger=None, **params):
@@ -51,10 +52,11 @@ class InitDDaemon(GenericLinuxDaemonMixin, CronRespawnDaemonMixin):
                                                          self._runner)
 
     def configure(self):
-        super(InitDDaemon, self).configure()
+        changed = super(InitDDaemon, self).configure()
         if self.start_on_boot:
             self._logger.info('Creating start-on-boot entry')
             self._start_on_boot_handler.create()
+        return changed
 
     def _delete(self):
         if self.start_on_boot:
@@ -96,10 +98,6 @@ class InitDDaemon(GenericLinuxDaemonMixin, CronRespawnDaemonMixin):
             log_dir=self.log_dir
         )
 
-    def create_script(self):
-        super(InitDDaemon, self).create_script()
-        self._runner.run('sudo chmod +x {0}'.format(self.script_path))
-
     def _get_rendered_config(self):
         self._logger.debug('Rendering configuration script "{0}" from template'
                            .format(self.config_path))
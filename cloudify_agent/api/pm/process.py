@@ -0,0 +1,103 @@
+#########
+# Copyright (c) 2024 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""Waiting for a worker process to exit, without running status commands.
+
+The process doesn't have to be our child, so it can't be waited for with
+waitpid. On linux 5.3+, a pidfd becomes readable when the process exits,
+so that is waited for. Otherwise, the process is polled with signal 0,
+with a backoff.
+"""
+
+import os
+import select
+import time
+
+# first poll interval when pidfd is not available, doubled after every poll
+POLL_INITIAL_INTERVAL = 0.05
+
+
+def read_pid_file(path):
+    """The pid in the pid file, or None if there is no valid pid file."""
+    try:
+        with open(path) as f:
+            return int(f.read().strip())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def is_worker_process(pid):
+    """Is pid (still) a running cloudify agent worker.
+
+    Stale pid files might point to a pid that was reused by some other
+    process, which we must not wait for. That can only be checked where
+    /proc is available: elsewhere, this only checks that the process
+    exists.
+    """
+    if not is_running(pid):
+        return False
+    try:
+        with open('/proc/{0}/cmdline'.format(pid), 'rb') as f:
+            cmdline = f.read()
+    except (IOError, OSError):
+        return True
+    return b'cloudify_agent' in cmdline
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # running as another user
+        return True
+    except OSError:
+        return False
+    return True
+
+
+def wait_for_exit(pid, timeout, max_interval=1):
+    """Wait up to timeout seconds for the process to exit.
+
+    :param max_interval: the longest interval between polls, when pidfd
+                         is not available
+    :return: whether the process exited
+    """
+    try:
+        pidfd = os.pidfd_open(pid)
+    except ProcessLookupError:
+        return True
+    except (AttributeError, OSError):
+        # no pidfd: not linux, python < 3.9, or linux < 5.3
+        return _poll_for_exit(pid, timeout, max_interval)
+    try:
+        poller = select.poll()
+        poller.register(pidfd, select.POLLIN)
+        return bool(poller.poll(timeout * 1000))
+    finally:
+        os.close(pidfd)
+
+
+def _poll_for_exit(pid, timeout, max_interval):
+    end_time = time.time() + timeout
+    interval = POLL_INITIAL_INTERVAL
+    while is_running(pid):
+        remaining = end_time - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, max_interval)
+    return True
@@ -15,8 +15,10 @@
 
 import os
 
+from cloudify.exceptions import CommandExecutionException
+
 from cloudify_agent import VIRTUALENV
-from cloudify_agent.api import utils, exceptions
+from cloudify_agent.api import defaults, utils, exceptions
 from cloudify_agent.api.pm.base import GenericLinuxDaemonMixin
 
 
@@ -28,16 +30,29 @@ class SystemDDaemon(GenericLinuxDaemonMixin):
     Following are all possible custom key-word arguments
     (in addition to the ones available in the base daemon)
 
+    ``watchdog_timeout``
+
+        restart the worker if it hasn't pinged the systemd watchdog for
+        this many seconds, because it's stuck. 0 disables the watchdog.
+        defaults to 60.
+
     """
 
     SCRIPT_DIR = '/usr/lib/systemd/system/'
     CONFIG_DIR = '/etc/sysconfig'
     PROCESS_MANAGEMENT = 'systemd'
 
+    def __init__(self, logger=None, **params):
+        super().__init__(logger=logger, **params)
+        self.watchdog_timeout = int(params.get(
+            'watchdog_timeout', defaults.SYSTEMD_WATCHDOG_TIMEOUT))
+
     def configure(self):
-        super().configure()
+        changed = super().configure()
         self._runner.run(self._systemctl_command('enable'))
-        self._runner.run('sudo systemctl daemon-reload')
+        if changed:
+            self._runner.run('sudo systemctl daemon-reload')
+        return changed
 
     def _delete(self):
         self._runner.run(self._systemctl_command('disable'))
@@ -54,11 +69,30 @@ class SystemDDaemon(GenericLinuxDaemonMixin):
     def start_command(self):
         if not os.path.isfile(self.script_path):
             raise exceptions.DaemonNotConfiguredError(self.name)
-        return self._systemctl_command('start')
+        # with Type=notify, `systemctl start` would wait for the worker to
+        # be ready, without a timeout. Don't block, and wait in .start()
+        # instead, which does have a timeout.
+        return self._systemctl_command('start --no-block')
 
     def status_command(self):
         return self._systemctl_command('status')
 
+    def _get_worker_pid(self):
+        # systemd doesn't use the pid file, but knows the pid anyway
+        try:
+            response = self._runner.run(
+                'systemctl show -p MainPID {0}'.format(self.service_name))
+        except CommandExecutionException as e:
+            self._logger.debug('%s', e)
+            return None
+        # MainPID=1234, or MainPID=0 if the service is not running
+        _, _, pid = response.std_out.strip().partition('=')
+        try:
+            pid = int(pid)
+        except ValueError:
+            return None
+        return pid or None
+
     def _get_script_path(self):
         return os.path.join(
             self.SCRIPT_DIR,
@@ -75,6 +109,7 @@ class SystemDDaemon(GenericLinuxDaemonMixin):
             config_path=self.config_path,
             max_workers=self.max_workers,
             name=self.name,
+            watchdog_timeout=self.watchdog_timeout,
         )
 
     def _get_rendered_config(self):
@@ -24,19 +24,17 @@ import tempfile
 import uuid
 
 import appdirs
-import pkg_resources
 
-from jinja2 import Template
 from urllib.parse import quote as urlquote
 
-from cloudify.cluster import CloudifyClusterClient
-from cloudify.workflows import tasks as workflows_tasks
+# pkg_resources, jinja2, the REST client and the amqp client are slow to
+# import, and most cfy-agent commands don't need them: they are imported
+# by the functions that use them instead
 from cloudify.utils import setup_logger, get_exec_tempdir, ipv6_url_compat
 from cloudify.constants import (SECURED_PROTOCOL,
                                 BROKER_PORT_SSL,
-                                BROKER_PORT_NO_SSL)
-# imported here for backwards compat
-from cloudify.amqp_client import is_agent_alive  # noqa
+                                BROKER_PORT_NO_SSL,
+                                INSPECT_TIMEOUT)
 
 import cloudify_agent
 from cloudify_agent.api import defaults
@@ -149,9 +147,15 @@ class _Internal(object):
 internal = _Internal()
 
 
+def is_agent_alive(*args, **kwargs):
+    # kept here for backwards compat
+    from cloudify.amqp_client import is_agent_alive
+    return is_agent_alive(*args, **kwargs)
+
+
 def get_agent_registered(name,
                          celery_client,
-                         timeout=workflows_tasks.INSPECT_TIMEOUT):
+                         timeout=INSPECT_TIMEOUT):
 
     """
     Query for agent registered tasks based on agent name.
@@ -215,6 +219,7 @@ def render_template_to_file(template_path, file_path=None, **values):
     :param file_path: absolute path to the desired output file.
     :param values: keyword arguments passed to jinja.
     """
+    from jinja2 import Template
     template = get_resource(template_path)
     rendered = Template(template).render(**values)
     return content_to_file(rendered, file_path)
@@ -242,6 +247,7 @@ def get_resource(resource_path):
     :param resource_path: relative path to the resource.
     """
 
+    import pkg_resources
     return pkg_resources.resource_string(
         cloudify_agent.__name__,
         os.path.join('resources', resource_path)
@@ -256,6 +262,7 @@ def get_absolute_resource_path(resource_path):
 
     :param resource_path: the relative path to the resource
     """
+    import pkg_resources
     return pkg_resources.resource_filename(
         cloudify_agent.__name__,
         os.path.join('resources', resource_path)
@@ -422,6 +429,7 @@ def get_rest_client(rest_host,
                       'create a REST client for a secured ' \
                       'manager [{1}]'.format(name, rest_host)
 
+    from cloudify.cluster import CloudifyClusterClient
     return CloudifyClusterClient(
         host=rest_host,
         protocol=SECURED_PROTOCOL,
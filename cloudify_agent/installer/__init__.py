@@ -31,8 +31,14 @@ class AgentInstaller(object):
     def run_agent_command(self, command, execution_env=None):
         if execution_env is None:
             execution_env = {}
+        command = '{0} {1}'.format(self.cfy_agent_path, command)
+        if getattr(self.runner, 'can_stream', False):
+            # the output is logged by the runner, while the command runs
+            return self.runner.run(command=command,
+                                   execution_env=execution_env,
+                                   stream=True)
         response = self.runner.run(
-            command='{0} {1}'.format(self.cfy_agent_path, command),
+            command=command,
             execution_env=execution_env)
         output = response.std_out
         if output:
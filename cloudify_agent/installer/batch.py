@@ -0,0 +1,136 @@
+#########
+# Copyright (c) 2024 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""Installing the agents of many hosts at once.
+
+Installing an agent over ssh/winrm takes a while, and is mostly spent
+waiting for the remote host. `install_agents` runs the install scripts of
+a batch of agents concurrently, up to `max_parallel` hosts at a time, and
+reports the progress and the install times as it goes.
+
+The agents are the CloudifyAgentConfig of the node instances, as prepared
+for the create operation, with the remote install method.
+"""
+
+import logging
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from cloudify import ctx
+from cloudify.state import current_ctx
+
+from cloudify_agent.installer.config.installer_config import (
+    create_runner,
+    get_installer,
+)
+from cloudify_agent.installer.operations import install_agent
+
+DEFAULT_MAX_PARALLEL = 10
+# give up waiting for the install script of a host after this long
+DEFAULT_HOST_TIMEOUT = 1800
+
+InstallResult = namedtuple('InstallResult',
+                           ['name', 'host', 'error', 'duration'])
+
+
+class _HostLogger(logging.LoggerAdapter):
+    """Prefix the messages with the host, as the outputs are interleaved"""
+
+    def process(self, msg, kwargs):
+        return '[{0}] {1}'.format(self.extra['host'], msg), kwargs
+
+
+def install_agents(cloudify_agents, max_parallel=DEFAULT_MAX_PARALLEL,
+                   host_timeout=DEFAULT_HOST_TIMEOUT, logger=None):
+    """Install the agents, up to max_parallel of them at a time.
+
+    A failure to install one agent doesn't stop the others: the failed
+    agents are marked as failed, and their errors are returned.
+
+    :param cloudify_agents: CloudifyAgentConfig of the agents to install
+    :param max_parallel: how many hosts to install on at the same time
+    :param host_timeout: stop waiting for the install script of a host
+                         after this many seconds
+    :return: an InstallResult for every agent, in the order they finished
+    """
+    logger = logger or ctx.logger
+    ctx_obj = current_ctx.get_ctx()
+    parameters = current_ctx.get_parameters()
+    total = len(cloudify_agents)
+    results = []
+
+    def _install(cloudify_agent):
+        started = time.time()
+        error = None
+        try:
+            with current_ctx.push(ctx_obj, parameters):
+                _install_one(cloudify_agent, host_timeout)
+        except Exception as e:
+            error = e
+        return InstallResult(cloudify_agent['name'], cloudify_agent['ip'],
+                             error, time.time() - started)
+
+    logger.info('Installing %d agents, %d at a time', total, max_parallel)
+    with ThreadPoolExecutor(max_workers=max(1, max_parallel)) as executor:
+        futures = [executor.submit(_install, cloudify_agent)
+                   for cloudify_agent in cloudify_agents]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if result.error is None:
+                logger.info('[%d/%d] %s installed on %s in %.1fs',
+                            len(results), total, result.name, result.host,
+                            result.duration)
+            else:
+                logger.error('[%d/%d] %s failed on %s after %.1fs: %s',
+                             len(results), total, result.name, result.host,
+                             result.duration, result.error)
+    _log_summary(logger, results)
+    return results
+
+
+def _install_one(cloudify_agent, timeout):
+    runner = create_runner(cloudify_agent, validate_connection=False)
+    runner.logger = _HostLogger(runner.logger,
+                                {'host': cloudify_agent['ip']})
+    try:
+        cloudify_agent.set_installation_params(runner)
+        installer = get_installer(cloudify_agent, runner)
+        install_agent(cloudify_agent, installer, timeout=timeout)
+    finally:
+        if hasattr(runner, 'close'):
+            runner.close()
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    index = int(round((len(values) - 1) * percent / 100.0))
+    return values[index]
+
+
+def _log_summary(logger, results):
+    if not results:
+        return
+    failed = [result for result in results if result.error is not None]
+    durations = [result.duration for result in results]
+    logger.info(
+        'Installed %d agents, %d failed; install time: p50 %.1fs, '
+        'p95 %.1fs, max %.1fs',
+        len(results) - len(failed), len(failed),
+        _percentile(durations, 50), _percentile(durations, 95),
+        max(durations))
+    for result in failed:
+        logger.error('%s (%s): %s', result.name, result.host, result.error)
@@ -21,3 +21,14 @@ class AgentInstallerConfigurationError(exceptions.NonRecoverableError):
         super(AgentInstallerConfigurationError, self).__init__(
             'Failed configuring agent installer: {0}'.format(msg)
         )
+
+
+class DownloadChecksumError(exceptions.NonRecoverableError):
+    def __init__(self, url, expected, actual):
+        self.url = url
+        self.expected = expected
+        self.actual = actual
+        super(DownloadChecksumError, self).__init__(
+            'Checksum mismatch of {0}: expected {1}, got {2}'.format(
+                url, expected, actual)
+        )
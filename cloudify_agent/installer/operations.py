@@ -2,7 +2,6 @@ import logging
 import time
 
 from cloudify.decorators import operation
-from cloudify.amqp_client import get_client
 from cloudify.models_states import AgentState
 from cloudify import ctx, utils as cloudify_utils
 from cloudify.exceptions import (
@@ -17,7 +16,7 @@ from cloudify.agent_utils import (
     delete_agent_exchange,
 )
 
-from cloudify_agent.api import utils
+from cloudify_agent import liveness
 from cloudify_agent.installer import script
 
 from .config.agent_config import update_agent_runtime_properties
@@ -30,27 +29,7 @@ def create(cloudify_agent, installer, **_):
     # When not in "remote" mode, this operation is called only to set the
     # agent_config dict in the runtime properties
     if cloudify_agent.has_installer:
-        with script.install_script_path(cloudify_agent) as script_path:
-            ctx.logger.info('Creating Agent {0}'.format(
-                cloudify_agent['name']))
-            try:
-                installer.runner.run_script(script_path)
-            except (CommandExecutionError, CommandExecutionException):
-                ctx.logger.error("Failed creating agent; marking agent as "
-                                 "failed")
-                update_agent_record(cloudify_agent, AgentState.FAILED)
-                try:
-                    ctx.logger.info('Attempting to cleanup after agent %s',
-                                    cloudify_agent['name'])
-                    installer.stop_agent()
-                    installer.delete_agent()
-                except Exception as err:
-                    ctx.logger.info('Deletion failed: %s', err)
-                raise
-            ctx.logger.info(
-                'Agent created, configured and started successfully'
-            )
-            update_agent_record(cloudify_agent, AgentState.STARTED)
+        install_agent(cloudify_agent, installer)
     elif cloudify_agent.is_proxied:
         ctx.logger.info('Working in "proxied" mode')
     elif cloudify_agent.is_provided:
@@ -68,6 +47,40 @@ def create(cloudify_agent, installer, **_):
         update_agent_record(cloudify_agent, AgentState.CREATED)
 
 
+def install_agent(cloudify_agent, installer, timeout=None):
+    """Run the install script on the agent's host, and record the result.
+
+    :param timeout: stop waiting for the script after this many seconds;
+                    only supported by runners that can stream the output
+    """
+    with script.install_script_path(cloudify_agent) as script_path:
+        ctx.logger.info('Creating Agent {0}'.format(
+            cloudify_agent['name']))
+        try:
+            if getattr(installer.runner, 'can_stream', False):
+                # log the progress of the script while it runs
+                installer.runner.run_script(
+                    script_path, stream=True, timeout=timeout)
+            else:
+                installer.runner.run_script(script_path)
+        except (CommandExecutionError, CommandExecutionException):
+            ctx.logger.error("Failed creating agent; marking agent as "
+                             "failed")
+            update_agent_record(cloudify_agent, AgentState.FAILED)
+            try:
+                ctx.logger.info('Attempting to cleanup after agent %s',
+                                cloudify_agent['name'])
+                installer.stop_agent()
+                installer.delete_agent()
+            except Exception as err:
+                ctx.logger.info('Deletion failed: %s', err)
+            raise
+        ctx.logger.info(
+            'Agent created, configured and started successfully'
+        )
+        update_agent_record(cloudify_agent, AgentState.STARTED)
+
+
 @operation
 @create_agent_config_and_installer()
 def configure(cloudify_agent, installer, **_):
@@ -88,14 +101,21 @@ def start(cloudify_agent, **_):
     """
     Only called in "init_script"/"plugin" mode, where the agent is started
     externally (e.g. userdata script), and all we have to do is wait for it
+
+    The agent publishes an event when it has started, which ends the wait
+    right away. Agents that were already running, or are too old to send
+    the event, reply to the pings that are sent every poll_interval.
+    When the worker runs a liveness monitor, the wait is done by it,
+    together with all the other agents being waited for.
     """
     agent_name = cloudify_agent['queue']
     update_agent_record(cloudify_agent, AgentState.STARTING)
     tenant = cloudify_utils.get_tenant()
-    client = get_client(
-        amqp_user=tenant['rabbitmq_username'],
-        amqp_pass=tenant['rabbitmq_password'],
-        amqp_vhost=tenant['rabbitmq_vhost']
+    waiter = liveness.AgentWaiter(
+        agent_name,
+        vhost=tenant['rabbitmq_vhost'],
+        user=tenant['rabbitmq_username'],
+        password=tenant['rabbitmq_password'],
     )
 
     marked_nonresponsive = False
@@ -103,23 +123,18 @@ def start(cloudify_agent, **_):
     # start sooner than that, but we have to give up eventually.
     start_time = time.time()
     timeout = 3600
-    # we can't poll too often, because we need to give the agent a chance to
+    # we can't ping too often, because we need to give the agent a chance to
     # respond. 10 seconds should be PLENTY even on very latency-deficient
     # networks.
     poll_interval = 10
-    with client:
-        agent_alive = False
+    started = False
+    with waiter:
         while True:
             elapsed = time.time() - start_time
             if elapsed > timeout:
                 break
-            agent_alive = utils.is_agent_alive(
-                name=agent_name,
-                client=client,
-                timeout=poll_interval,
-                connect=False,
-            )
-            if agent_alive:
+            started = waiter.wait(poll_interval)
+            if started:
                 break
             ctx.logger.log(
                 logging.WARNING if elapsed > 300 else logging.INFO,
@@ -132,12 +147,11 @@ def start(cloudify_agent, **_):
                 # or there is some problem booting it.
                 marked_nonresponsive = True
                 update_agent_record(cloudify_agent, AgentState.NONRESPONSIVE)
-            time.sleep(poll_interval)
 
     if not cloudify_agent.is_provided:
         script.cleanup_scripts()
 
-    if agent_alive:
+    if started:
         ctx.logger.info('Agent has started')
         update_agent_record(cloudify_agent, AgentState.STARTED)
     else:
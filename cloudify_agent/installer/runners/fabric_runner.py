@@ -15,17 +15,25 @@
 
 import os
 import sys
+import json
+import time
+import zlib
+import shlex
+import hashlib
 import logging
+import threading
 
 from fabric import Connection
 from io import StringIO
 from paramiko import RSAKey, ECDSAKey, Ed25519Key, SSHException
+from paramiko.agent import AgentRequestHandler
 
 from cloudify.utils import CommandExecutionResponse, setup_logger
 from cloudify.exceptions import CommandExecutionException
 from cloudify.exceptions import CommandExecutionError
 
 from cloudify_agent.installer import exceptions
+from cloudify_agent.installer.runners.streaming import OutputLogger
 
 from cloudify_rest_client.utils import is_kerberos_env
 
@@ -36,9 +44,146 @@ COMMON_ENV = {
     'forward_agent': True,
 }
 
+# close cached connections that weren't used for this many seconds
+CONNECTION_IDLE_TIMEOUT = 300
+# when streaming, how long to wait between polls of a channel with no output
+STREAM_POLL_INTERVAL = 0.05
+# files are sent in chunks of this size
+FILE_CHUNK_SIZE = 64 * 1024
+
+
+class ConnectionCache(object):
+    """Keeps SSH connections open after use, for the next runner.
+
+    Every agent operation creates a new FabricRunner, so installing an
+    agent used to connect (and authenticate, possibly through a gateway)
+    to the same host several times. Instead, when a runner is closed, its
+    connection is kept here, and the next runner for the same host, user
+    and credentials takes it over.
+
+    A connection is only used by one runner at a time. Connections that
+    are idle for longer than idle_timeout are closed, and connections
+    that are no longer alive are never handed out.
+    """
+
+    def __init__(self, idle_timeout=CONNECTION_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._idle = {}  # key: [(connection, released_at), ...]
+        self._reaper = None
+
+    def acquire(self, key, connect):
+        """An idle connection for key, or a new one from connect()"""
+        while True:
+            with self._lock:
+                entries = self._idle.get(key)
+                if not entries:
+                    return connect()
+                connection, released_at = entries.pop()
+                if not entries:
+                    del self._idle[key]
+            if time.time() - released_at < self.idle_timeout \
+                    and _is_alive(connection):
+                return connection
+            _close_quietly(connection)
+
+    def release(self, key, connection):
+        """Keep the connection for the next acquire(key)"""
+        if not _is_alive(connection):
+            _close_quietly(connection)
+            return
+        with self._lock:
+            self._idle.setdefault(key, []).append((connection, time.time()))
+            if self._reaper is None:
+                self._reaper = threading.Thread(
+                    target=self._reap, name='ssh-connection-reaper')
+                self._reaper.daemon = True
+                self._reaper.start()
+
+    def prune(self, max_idle=None):
+        """Close the connections that were idle for longer than max_idle.
+
+        :return: whether any idle connections are left
+        """
+        if max_idle is None:
+            max_idle = self.idle_timeout
+        expired = []
+        with self._lock:
+            now = time.time()
+            for key, entries in list(self._idle.items()):
+                keep = [e for e in entries if now - e[1] < max_idle]
+                expired.extend(e[0] for e in entries if now - e[1] >= max_idle)
+                if keep:
+                    self._idle[key] = keep
+                else:
+                    del self._idle[key]
+            left = bool(self._idle)
+        for connection in expired:
+            _close_quietly(connection)
+        return left
+
+    def clear(self):
+        """Close all the idle connections"""
+        self.prune(max_idle=0)
+
+    def _reap(self):
+        while True:
+            time.sleep(max(self.idle_timeout / 2.0, 1))
+            self.prune()
+            with self._lock:
+                if not self._idle:
+                    self._reaper = None
+                    return
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(FILE_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _file_chunks(path, compress):
+    """The contents of the file, gzipped if compress, in chunks"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(FILE_CHUNK_SIZE), b''):
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                yield chunk
+    if compressor is not None:
+        yield compressor.flush()
+
+
+def _is_alive(connection):
+    transport = connection.transport
+    if transport is None or not transport.is_active() \
+            or not transport.is_authenticated():
+        return False
+    try:
+        transport.send_ignore()
+    except Exception:
+        return False
+    return True
+
+
+def _close_quietly(connection):
+    try:
+        connection.close()
+    except Exception:
+        pass
+
+
+connection_cache = ConnectionCache()
+
 
 class FabricRunner(object):
 
+    # run() can log the output as it arrives, see stream
+    can_stream = True
+
     def __init__(self,
                  logger=None,
                  host=None,
@@ -48,7 +193,8 @@ class FabricRunner(object):
                  password=None,
                  validate_connection=True,
                  fabric_env=None,
-                 tmpdir=None):
+                 tmpdir=None,
+                 reuse_connection=True):
 
         # logger
         self.logger = logger or setup_logger('fabric_runner')
@@ -68,6 +214,11 @@ class FabricRunner(object):
         self.env = self._set_env()
         self.env.update(fabric_env or {})
         self._connection = None
+        # share the connection with later runners, see ConnectionCache
+        self.reuse_connection = reuse_connection
+        # whether files are sent gzipped: only if the host has gzip, which
+        # is checked before sending the first file
+        self._compress = None
 
         self._validate_ssh_config()
         if validate_connection:
@@ -133,14 +284,46 @@ class FabricRunner(object):
 
     def _ensure_connection(self):
         if self._connection is None:
-            self._connection = Connection(**self.env)
-            try:
-                self._connection.open()
-            except Exception as e:
-                _, _, tb = sys.exc_info()
-                raise FabricCommandExecutionError(str(e)).with_traceback(tb)
+            if self.reuse_connection:
+                self._connection = connection_cache.acquire(
+                    self._connection_key(), self._connect)
+            else:
+                self._connection = self._connect()
 
-    def run(self, command, execution_env=None, **attributes):
+    def _connect(self):
+        connection = Connection(**self.env)
+        try:
+            connection.open()
+        except Exception as e:
+            _, _, tb = sys.exc_info()
+            raise FabricCommandExecutionError(str(e)).with_traceback(tb)
+        return connection
+
+    def _connection_key(self):
+        """Runners with the same key can share a connection.
+
+        That is everything that the connection is made with: the host,
+        port and user, the fingerprint of the key, and the rest of the
+        fabric env. Secrets are only included hashed.
+        """
+        env = dict(self.env)
+        connect_kwargs = dict(env.pop('connect_kwargs', {}))
+        pkey = connect_kwargs.pop('pkey', None)
+        if pkey is not None:
+            connect_kwargs['pkey'] = pkey.get_fingerprint().hex()
+        key_filename = connect_kwargs.get('key_filename')
+        if isinstance(key_filename, str) and os.path.isfile(key_filename):
+            with open(key_filename, 'rb') as f:
+                connect_kwargs['key_filename'] = (
+                    key_filename, hashlib.sha256(f.read()).hexdigest())
+        password = connect_kwargs.pop('password', None)
+        if password:
+            connect_kwargs['password'] = hashlib.sha256(
+                password.encode('utf-8')).hexdigest()
+        env['connect_kwargs'] = connect_kwargs
+        return json.dumps(env, sort_keys=True, default=repr)
+
+    def run(self, command, execution_env=None, stream=False, **attributes):
 
         """
         Execute a command.
@@ -148,6 +331,9 @@ class FabricRunner(object):
         :param command: The command to execute.
         :param execution_env: environment variables to be applied before
                               running the command
+        :param stream: log the output lines as they arrive, and only keep
+                       the last lines of the output in the response.
+                       The attributes are not used then.
         :param quiet: run the command silently
         :param attributes: custom attributes passed directly to
                            fabric's run command
@@ -160,6 +346,8 @@ class FabricRunner(object):
         if execution_env is None:
             execution_env = {}
         self._ensure_connection()
+        if stream:
+            return self._run_streaming(command)
         attributes.setdefault('hide', self.logger.isEnabledFor(logging.DEBUG))
         attributes.setdefault('warn', True)
         r = self._connection.run(command, **attributes)
@@ -177,6 +365,66 @@ class FabricRunner(object):
             return_code=r.return_code
         )
 
+    def _run_streaming(self, command, stdin=None, level=logging.INFO,
+                       description=None, timeout=None):
+        """Run command on a new channel, logging the output as it arrives.
+
+        :param stdin: an iterable of bytes to send to the command's stdin,
+                      which is closed afterwards
+        :param level: the level to log the output at
+        :param description: the command, as reported in the response
+        :param timeout: stop waiting for the command after this many
+                        seconds, and raise FabricCommandExecutionError
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        stdout = OutputLogger(self.logger, level=level)
+        stderr = OutputLogger(self.logger, level=level)
+        channel = self._connection.transport.open_session()
+        try:
+            if self.env.get('forward_agent'):
+                AgentRequestHandler(channel)
+            channel.exec_command(command)
+            if stdin is not None:
+                for chunk in stdin:
+                    channel.sendall(chunk)
+                channel.shutdown_write()
+            while True:
+                if channel.recv_ready():
+                    stdout.write(channel.recv(32768))
+                elif channel.recv_stderr_ready():
+                    stderr.write(channel.recv_stderr(32768))
+                elif channel.exit_status_ready():
+                    break
+                elif deadline is not None and time.time() > deadline:
+                    raise FabricCommandExecutionError(
+                        command=description or command,
+                        error='Timed out after {0} seconds'.format(timeout))
+                else:
+                    time.sleep(STREAM_POLL_INTERVAL)
+            # the exit status can arrive before the last of the output
+            while channel.recv_ready():
+                stdout.write(channel.recv(32768))
+            while channel.recv_stderr_ready():
+                stderr.write(channel.recv_stderr(32768))
+            return_code = channel.recv_exit_status()
+        finally:
+            channel.close()
+        stdout.close()
+        stderr.close()
+        if return_code != 0:
+            raise FabricCommandExecutionException(
+                command=description or command,
+                error=stderr.tail,
+                output=stdout.tail,
+                code=return_code
+            )
+        return FabricCommandExecutionResponse(
+            command=description or command,
+            std_out=stdout.tail,
+            std_err=None,
+            return_code=return_code
+        )
+
     def sudo(self, command, **attributes):
 
         """
@@ -193,59 +441,115 @@ class FabricRunner(object):
 
         return self.run('sudo {0}'.format(command), **attributes)
 
-    def run_script(self, script):
+    def run_script(self, script, stream=False, timeout=None):
         """
         Execute a script.
 
+        The script is uploaded, made executable, run and removed, all in
+        a single remote command.
+
         :param script: The path to the script to execute.
+        :param stream: log the output of the script as it runs
+        :param timeout: stop waiting for the script after this many seconds
         :return: a response object containing information
                  about the execution
         :rtype: FabricCommandExecutionResponse
         :raise: FabricCommandExecutionException
         """
 
-        remote_path = self.put_file(script)
-        try:
-            self.sudo('chmod +x {0}'.format(remote_path))
-            result = self.sudo(remote_path)
-        finally:
-            # The script is pushed to a remote directory created with mkdtemp.
-            # Hence, to cleanup the whole directory has to be removed.
-            self.delete(os.path.dirname(remote_path))
-        return result
+        self._ensure_connection()
+        path = '"$d"/{0}'.format(shlex.quote(os.path.basename(script)))
+        command = (
+            'd=$({mktemp}) && {receive} > {path} && chmod +x {path} && '
+            'sudo {path}; rc=$?; rm -rf "$d"; exit $rc'
+            .format(mktemp=self._mktemp_command(directory=True),
+                    receive=self._receive_command(),
+                    path=path))
+        return self._send_file(
+            script, command,
+            level=logging.INFO if stream else logging.DEBUG,
+            description='sudo {0}'.format(os.path.basename(script)),
+            timeout=timeout)
 
     def put_file(self, src, dst=None, sudo=False, **attributes):
 
         """
         Copies a file from the src path to the dst path.
 
+        When dst already has the same contents (same sha256) as src, the
+        file is not uploaded again. Otherwise, it's sent compressed, in
+        the same remote command that creates the directory and moves the
+        file into place.
+
         :param src: Path to a local file.
-        :param dst: The remote path the file will copied to.
+        :param dst: The remote path the file will copied to. Defaults to
+                    a new temporary directory.
         :param sudo: indicates that this operation
                      will require sudo permissions
-        :param attributes: custom attributes passed directly to
-                           fabric's run command
+        :param attributes: not used, kept for compatibility
 
         :return: the destination path
         """
 
-        if dst:
-            self.verify_dir_exists(os.path.dirname(dst))
-        else:
-            basename = os.path.basename(src)
-            tempdir = self.mkdtemp()
-            dst = os.path.join(tempdir, basename)
         self._ensure_connection()
-        if dst is None:
-            dst = os.path.basename(src)
-        target_path = dst
-        if sudo:
-            dst = os.path.basename(dst)
-
-        self._connection.put(src, dst)
+        if not dst:
+            # a new directory: there's nothing to compare with
+            command = (
+                'd=$({mktemp}) && {receive} > "$d"/{name} && '
+                'echo "$d"/{name}'.format(
+                    mktemp=self._mktemp_command(directory=True),
+                    receive=self._receive_command(),
+                    name=shlex.quote(os.path.basename(src))))
+            response = self._send_file(src, command, level=logging.DEBUG)
+            return response.std_out.strip().splitlines()[-1]
+
+        prefix = 'sudo ' if sudo else ''
+        if self._remote_digest(dst, prefix) == _file_digest(src):
+            self.logger.debug('%s is up to date, not uploading', dst)
+            return dst
+        tmp = shlex.quote(dst + '.cfy-tmp')
+        command = 'mkdir -p {dir} && {receive} > {tmp} && mv -f {tmp} {dst}' \
+            .format(dir=shlex.quote(os.path.dirname(dst) or '.'),
+                    receive=self._receive_command(),
+                    tmp=tmp,
+                    dst=shlex.quote(dst))
         if sudo:
-            self.sudo('sudo mv {0} {1}'.format(dst, target_path))
-        return target_path
+            command = 'sudo sh -c {0}'.format(shlex.quote(command))
+        self._send_file(src, command, level=logging.DEBUG)
+        return dst
+
+    def _send_file(self, src, command, **kwargs):
+        """Run command, with the (compressed) contents of src as stdin"""
+        return self._run_streaming(
+            command, stdin=_file_chunks(src, compress=self._has_gzip()),
+            **kwargs)
+
+    def _receive_command(self):
+        return 'gzip -dc' if self._has_gzip() else 'cat'
+
+    def _has_gzip(self):
+        # checked in a command of its own: a command that fails before
+        # reading all of its stdin makes sending the file fail as well,
+        # with just a closed channel to tell why
+        if self._compress is None:
+            response = self.run('command -v gzip || true')
+            self._compress = bool(response.std_out.strip())
+            if not self._compress:
+                self.logger.debug('gzip not found on %s, sending files '
+                                  'uncompressed', self.host)
+        return self._compress
+
+    def _remote_digest(self, path, prefix=''):
+        response = self.run('{0}sha256sum {1} 2>/dev/null || true'
+                            .format(prefix, shlex.quote(path)))
+        output = response.std_out.split()
+        return output[0] if output else None
+
+    def _mktemp_command(self, directory=False):
+        flags = ['-d'] if directory else []
+        if self.tmpdir is not None:
+            flags.append('-p "{0}"'.format(self.tmpdir))
+        return ' '.join(['mktemp'] + flags)
 
     def ping(self, **attributes):
 
@@ -372,8 +676,13 @@ class FabricRunner(object):
         self.run('rm -rf {0}'.format(path))
 
     def close(self):
-        if self._connection is not None:
-            self._connection.close()
+        if self._connection is None:
+            return
+        connection, self._connection = self._connection, None
+        if self.reuse_connection:
+            connection_cache.release(self._connection_key(), connection)
+        else:
+            connection.close()
 
 
 class FabricCommandExecutionError(CommandExecutionError):
@@ -13,9 +13,12 @@
 #  * See the License for the specific language governing permissions and
 #  * limitations under the License.
 
+import hashlib
 import os
 import shutil
 import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 
@@ -24,27 +27,114 @@ from cloudify.exceptions import HttpException
 from cloudify.constants import CLOUDIFY_TOKEN_AUTHENTICATION_HEADER
 from cloudify.utils import LocalCommandRunner as _UtilsLocalCommandRunner
 
+from cloudify_agent.installer import exceptions
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# a download that fails midway is resumed this many times
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_RETRY_INTERVAL = 2
+# seconds to wait for the connection, and then for every chunk
+DOWNLOAD_TIMEOUT = (10, 60)
+
+# the errors after which a download is resumed
+_RESUMABLE_ERRORS = (
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+)
+
+
+class _IncompleteDownload(IOError):
+    pass
+
+
+_RESUMABLE_ERRORS += (_IncompleteDownload, )
+
 
 class LocalCommandRunner(_UtilsLocalCommandRunner):
     def download(self, url, output_path=None, certificate_file=None,
-                 **attributes):
-        headers = {CLOUDIFY_TOKEN_AUTHENTICATION_HEADER: str(ctx.rest_token)}
+                 checksum=None, parts=1, chunk_size=DOWNLOAD_CHUNK_SIZE,
+                 cache_dir=None, retries=DOWNLOAD_RETRIES, **attributes):
+        """Download url to output_path, or to a new temporary file.
+
+        A download that is interrupted is resumed where it stopped, if the
+        server supports ranges.
+
+        :param checksum: the expected digest of the file, as
+                         "<algorithm>:<hex digest>", or a sha256 hex digest
+        :param parts: fetch this many ranges of the file concurrently
+        :param chunk_size: read and write the file in chunks of this size
+        :param cache_dir: keep the downloaded file here, and don't download
+                          it again while the server's ETag is the same
+        :param retries: resume an interrupted download this many times
+        :return: the path of the downloaded file
+        """
+        headers = {
+            CLOUDIFY_TOKEN_AUTHENTICATION_HEADER: str(ctx.rest_token),
+            # the ranges are of the file, not of a compressed stream
+            'Accept-Encoding': 'identity',
+        }
+        destination = None
+        cache = _DownloadCache(cache_dir, url) if cache_dir else None
+
+        request_headers = dict(headers)
+        etag = cache.etag() if cache else None
+        if etag:
+            request_headers['If-None-Match'] = etag
         response = requests.get(
-            url, stream=True, verify=certificate_file, headers=headers)
+            url, stream=True, verify=certificate_file,
+            headers=request_headers, timeout=DOWNLOAD_TIMEOUT)
+        if response.status_code == 304:
+            response.close()
+            self.logger.debug('%s is not modified, using the cached file',
+                              url)
+            destination = output_path or _temp_path()
+            cache.copy_to(destination)
+            try:
+                _verify_checksum(url, destination, checksum)
+                return destination
+            except exceptions.DownloadChecksumError:
+                cache.remove()
+                response = requests.get(
+                    url, stream=True, verify=certificate_file,
+                    headers=headers, timeout=DOWNLOAD_TIMEOUT)
         if not response.ok:
             raise HttpException(url, response.status_code, response.reason)
 
-        if output_path:
-            destination_file = open(output_path, 'wb')
-            destination = output_path
-        else:
-            destination_file = tempfile.NamedTemporaryFile(delete=False)
-            destination = destination_file.name
-
-        with destination_file:
-            for chunk in response.iter_content(chunk_size=8192):
-                destination_file.write(chunk)
-
+        destination = destination or output_path or _temp_path()
+        size = response.headers.get('Content-Length')
+        size = int(size) if size and size.isdigit() else None
+        fetcher = _RangeFetcher(
+            url, headers, certificate_file, chunk_size, retries, size,
+            validator=response.headers.get('ETag') or
+            response.headers.get('Last-Modified'),
+            resumable=response.headers.get('Accept-Ranges') == 'bytes',
+            logger=self.logger)
+        try:
+            with open(destination, 'wb') as f:
+                if size is not None:
+                    f.truncate(size)
+            if parts > 1 and fetcher.resumable and size \
+                    and size >= parts * chunk_size:
+                response.close()
+                part_size = -(-size // parts)
+                ranges = [(start, min(start + part_size, size) - 1)
+                          for start in range(0, size, part_size)]
+                with ThreadPoolExecutor(max_workers=parts) as executor:
+                    for future in [
+                        executor.submit(fetcher.fetch, destination, *part)
+                        for part in ranges
+                    ]:
+                        future.result()
+            else:
+                fetcher.fetch(destination, 0, None, response=response)
+            _verify_checksum(url, destination, checksum)
+        except BaseException:
+            if not output_path:
+                os.remove(destination)
+            raise
+        if cache and response.headers.get('ETag'):
+            cache.store(destination, response.headers['ETag'])
         return destination
 
     def put_file(self, src, dst=None, *_):
@@ -67,3 +157,145 @@ class LocalCommandRunner(_UtilsLocalCommandRunner):
         cmd = '{0} {1}'.format(append, script_path)
         result = self.run(cmd)
         return result
+
+
+class _RangeFetcher(object):
+    """Writes ranges of a file at url into the same offsets of a local file.
+
+    A fetch that is interrupted is resumed from where it stopped, if the
+    server supports ranges. The validator (the ETag or Last-Modified of
+    the file) is sent as If-Range, so that a file that changed on the
+    server is not stitched together from two versions.
+    """
+
+    def __init__(self, url, headers, verify, chunk_size, retries, size,
+                 validator, resumable, logger):
+        self.url = url
+        self.size = size
+        self.headers = headers
+        self.verify = verify
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.validator = validator
+        self.resumable = resumable
+        self.logger = logger
+
+    def fetch(self, path, start, end, response=None):
+        """Write bytes start..end (inclusive) of the file to path.
+
+        :param end: the last byte, or None for the end of the file
+        :param response: a response that already returns the range
+        """
+        if end is None and self.size is not None:
+            end = self.size - 1
+        whole_file = start == 0 and (end is None or end + 1 == self.size)
+        position = start
+        attempt = 0
+        with open(path, 'r+b') as f:
+            while True:
+                try:
+                    if response is None:
+                        response = self._request(position, end)
+                        if response.status_code == 200 and position:
+                            # not a range: the file changed on the server
+                            if not whole_file:
+                                raise HttpException(
+                                    self.url, 200,
+                                    'the file changed during the download')
+                            # start over, with the new file
+                            position = 0
+                            end = None
+                    f.seek(position)
+                    for chunk in response.iter_content(self.chunk_size):
+                        f.write(chunk)
+                        position += len(chunk)
+                    if end is not None and position <= end:
+                        raise _IncompleteDownload(
+                            'got {0} of {1} bytes'.format(
+                                position - start, end - start + 1))
+                    if whole_file:
+                        f.truncate(position)
+                    return
+                except _RESUMABLE_ERRORS as e:
+                    attempt += 1
+                    if not self.resumable or attempt > self.retries:
+                        raise
+                    self.logger.warning(
+                        'Download of %s interrupted at byte %d (%s), '
+                        'resuming', self.url, position, e)
+                    time.sleep(DOWNLOAD_RETRY_INTERVAL)
+                finally:
+                    if response is not None:
+                        response.close()
+                        response = None
+
+    def _request(self, position, end):
+        headers = dict(self.headers)
+        headers['Range'] = 'bytes={0}-{1}'.format(
+            position, '' if end is None else end)
+        if self.validator:
+            headers['If-Range'] = self.validator
+        response = requests.get(
+            self.url, stream=True, verify=self.verify, headers=headers,
+            timeout=DOWNLOAD_TIMEOUT)
+        if not response.ok:
+            response.close()
+            raise HttpException(
+                self.url, response.status_code, response.reason)
+        return response
+
+
+class _DownloadCache(object):
+    """A downloaded file, and the ETag the server returned for it"""
+
+    def __init__(self, cache_dir, url):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        self._path = os.path.join(cache_dir, key)
+        self._etag_path = self._path + '.etag'
+
+    def etag(self):
+        if not os.path.exists(self._path):
+            return None
+        try:
+            with open(self._etag_path) as f:
+                return f.read().strip() or None
+        except (IOError, OSError):
+            return None
+
+    def copy_to(self, destination):
+        shutil.copyfile(self._path, destination)
+
+    def store(self, source, etag):
+        cache_dir = os.path.dirname(self._path)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+        os.close(fd)
+        shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, self._path)
+        with open(self._etag_path, 'w') as f:
+            f.write(etag)
+
+    def remove(self):
+        for path in (self._path, self._etag_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def _temp_path():
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    return path
+
+
+def _verify_checksum(url, path, checksum):
+    if not checksum:
+        return
+    algorithm, _, expected = checksum.rpartition(':')
+    digest = hashlib.new(algorithm or 'sha256')
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    if digest.hexdigest() != expected.lower():
+        raise exceptions.DownloadChecksumError(
+            url, expected, digest.hexdigest())
@@ -0,0 +1,66 @@
+#########
+# Copyright (c) 2024 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import codecs
+import logging
+from collections import deque
+
+# how many of the last output lines are kept, for reporting errors
+TAIL_LINES = 100
+
+
+class OutputLogger(object):
+    """Logs the output of a remote command line by line, as it arrives.
+
+    Only the last `tail_lines` lines are kept in memory, so that the
+    output of a long-running command (eg. the agent install script) is
+    visible while it runs, but not held on to afterwards.
+    """
+
+    def __init__(self, logger, level=logging.INFO, tail_lines=TAIL_LINES):
+        self._logger = logger
+        self._level = level
+        self._decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self._partial = ''
+        self._lines = deque(maxlen=tail_lines)
+
+    def write(self, data):
+        if isinstance(data, bytes):
+            data = self._decoder.decode(data)
+        if not data:
+            return
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self._emit(line)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """Log the last line, if it wasn't terminated by a newline"""
+        self._partial += self._decoder.decode(b'', final=True)
+        if self._partial:
+            self._emit(self._partial)
+            self._partial = ''
+
+    @property
+    def tail(self):
+        return '\n'.join(self._lines)
+
+    def _emit(self, line):
+        line = line.rstrip('\r')
+        self._lines.append(line)
+        self._logger.log(self._level, line)
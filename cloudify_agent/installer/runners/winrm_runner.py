@@ -15,9 +15,17 @@
 
 try:
     import winrm
+    from winrm.exceptions import WinRMError, WinRMOperationTimeoutError
 except Exception:
     winrm = None
+    WinRMError = None
+    WinRMOperationTimeoutError = None
+import hashlib
 import ntpath
+import os
+import time
+import uuid
+from base64 import b64encode
 
 from cloudify.exceptions import CommandExecutionException
 from cloudify.exceptions import CommandExecutionError
@@ -25,6 +33,7 @@ from cloudify.utils import CommandExecutionResponse
 from cloudify.utils import setup_logger
 
 from cloudify_agent.api import utils
+from cloudify_agent.installer.runners.streaming import OutputLogger
 
 from cloudify_rest_client.utils import is_kerberos_env
 from functools import reduce
@@ -34,6 +43,48 @@ DEFAULT_WINRM_URI = 'wsman'
 DEFAULT_WINRM_PROTOCOL = 'http'
 DEFAULT_TRANSPORT = 'basic'
 
+# put() sends the file on the stdin of a single command, one base64 line
+# per this many bytes, which keeps every message well below the default
+# WinRM max envelope size (150KB)
+PUT_CHUNK_SIZE = 48 * 1024
+
+# receives the file sent by put(), creating its directory if needed, and
+# prints the sha256 of what was received. The lines of stdin are in $input.
+# With $ansi, the received utf-8 text is then written in the ANSI code
+# page instead, same as Add-Content does.
+_RECEIVE_SCRIPT = '''
+$ErrorActionPreference = 'Stop'
+$path = '{path}'
+$ansi = ${ansi}
+[void][System.IO.Directory]::CreateDirectory(
+    [System.IO.Path]::GetDirectoryName($path))
+$out = [System.IO.File]::Create($path)
+try {{
+    foreach ($line in $input) {{
+        if ($line) {{
+            $bytes = [System.Convert]::FromBase64String($line)
+            $out.Write($bytes, 0, $bytes.Length)
+        }}
+    }}
+}} finally {{
+    $out.Close()
+}}
+$sha256 = [System.Security.Cryptography.SHA256]::Create()
+$in = [System.IO.File]::OpenRead($path)
+try {{
+    $hash = $sha256.ComputeHash($in)
+}} finally {{
+    $in.Close()
+}}
+if ($ansi) {{
+    $text = [System.IO.File]::ReadAllText(
+        $path, [System.Text.Encoding]::UTF8)
+    [System.IO.File]::WriteAllText(
+        $path, $text, [System.Text.Encoding]::Default)
+}}
+[System.BitConverter]::ToString($hash).Replace('-', '').ToLower()
+'''
+
 
 def validate(session_config):
 
@@ -52,6 +103,9 @@ def validate(session_config):
 
 class WinRMRunner(object):
 
+    # run() can log the output as it arrives, see stream
+    can_stream = True
+
     def __init__(self,
                  user,
                  password=None,
@@ -76,6 +130,10 @@ class WinRMRunner(object):
             'transport': transport or DEFAULT_TRANSPORT
         }
         self.tmpdir = tmpdir
+        # commands run in this shell, which is kept open until close()
+        self._shell_id = None
+        # sha256 of the contents of an env file: its remote path
+        self._env_files = {}
 
         # Validations - [host, user, password]
         validate(self.session_config)
@@ -119,7 +177,7 @@ class WinRMRunner(object):
                 transport=self.session_config['transport'])
 
     def run(self, command, raise_on_failure=True, execution_env=None,
-            powershell=False):
+            powershell=False, stream=False, timeout=None):
 
         """
         :param command: The command to execute.
@@ -131,6 +189,10 @@ class WinRMRunner(object):
                               running the command
         :param powershell: Determines where to run command as a powershell
                            script.
+        :param stream: log the output lines as they arrive, and only keep
+                       the last lines of the output in the response.
+        :param timeout: with stream, stop waiting for the command after
+                        this many seconds
 
         :return a response object with information about the execution
         :rtype WinRMCommandExecutionResponse.
@@ -141,10 +203,7 @@ class WinRMRunner(object):
 
         remote_env_file = None
         if execution_env:
-            env_file = utils.env_to_file(execution_env, posix=False)
-            remote_env_file = self.put_file(src=env_file,
-                                            dst='{0}.bat'.format(
-                                                self.mktemp()))
+            remote_env_file = self._env_file(execution_env)
 
         def _chk(res):
             if res.status_code == 0:
@@ -172,17 +231,122 @@ class WinRMRunner(object):
         if remote_env_file:
             command = 'call {0} & {1}'.format(remote_env_file, command)
         try:
-            if powershell:
-                response = self.session.run_ps(command)
+            if stream:
+                response = self._run_streaming(command, powershell, timeout)
             else:
-                response = self.session.run_cmd(command)
-        except BaseException as e:
+                response = self._run_command(command, powershell)
+        except Exception as e:
             raise WinRMCommandExecutionError(
                 command=command,
                 error=str(e)
             )
         return _chk(response)
 
+    def _env_file(self, execution_env):
+        """The remote path of a .bat file that sets execution_env.
+
+        Every env file is only uploaded once per runner, and is removed
+        in close().
+        """
+        env_file = utils.env_to_file(execution_env, posix=False)
+        try:
+            with open(env_file, 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            remote_path = self._env_files.get(digest)
+            if remote_path is None:
+                remote_path = ntpath.join(
+                    self.get_temp_dir(),
+                    'cfy-env-{0}.bat'.format(uuid.uuid4().hex))
+                self.put_file(src=env_file, dst=remote_path)
+                self._env_files[digest] = remote_path
+        finally:
+            os.remove(env_file)
+        return remote_path
+
+    def _start_command(self, command, **kwargs):
+        """Start command in the runner's shell, opening it if needed.
+
+        :return: the shell id and the command id
+        """
+        protocol = self.session.protocol
+        if self._shell_id is not None:
+            try:
+                return self._shell_id, protocol.run_command(
+                    self._shell_id, command, **kwargs)
+            except WinRMError as e:
+                # the shell is gone, eg. it was idle for longer than the
+                # IdleTimeout of the host: the command didn't start, so
+                # it can be run in a new shell
+                self.logger.debug('Opening a new WinRM shell: %s', e)
+                self._close_shell()
+        self._shell_id = protocol.open_shell()
+        return self._shell_id, protocol.run_command(
+            self._shell_id, command, **kwargs)
+
+    def _close_shell(self):
+        shell_id, self._shell_id = self._shell_id, None
+        if shell_id is None:
+            return
+        try:
+            self.session.protocol.close_shell(shell_id)
+        except Exception as e:
+            self.logger.debug('Could not close the WinRM shell: %s', e)
+
+    def _run_command(self, command, powershell=False):
+        """Like session.run_cmd/run_ps, but in the runner's shell"""
+        if powershell:
+            command = _encode_powershell(command)
+        protocol = self.session.protocol
+        shell_id, command_id = self._start_command(command)
+        try:
+            response = winrm.Response(
+                protocol.get_command_output(shell_id, command_id))
+        finally:
+            protocol.cleanup_command(shell_id, command_id)
+        if powershell and response.std_err:
+            # make the CLIXML error readable, same as run_ps
+            response.std_err = self.session._clean_error_msg(
+                response.std_err)
+        return response
+
+    def _run_streaming(self, command, powershell=False, timeout=None):
+        """Like _run_command, but logs the output as it arrives.
+
+        The output is polled from the shell, same as
+        protocol.get_command_output does, and only its tail is kept.
+        """
+        if powershell:
+            command = _encode_powershell(command)
+        deadline = None if timeout is None else time.time() + timeout
+        stdout = OutputLogger(self.logger)
+        stderr = OutputLogger(self.logger)
+        protocol = self.session.protocol
+        # public since pywinrm 0.5
+        get_output = getattr(protocol, 'get_command_output_raw', None) or \
+            protocol._raw_get_command_output
+        shell_id, command_id = self._start_command(command)
+        try:
+            done = False
+            while not done:
+                if deadline is not None and time.time() > deadline:
+                    raise RuntimeError(
+                        'Timed out after {0} seconds'.format(timeout))
+                try:
+                    out, err, return_code, done = get_output(
+                        shell_id, command_id)
+                except WinRMOperationTimeoutError:
+                    # a long-running command: poll again
+                    continue
+                stdout.write(out)
+                stderr.write(err)
+        finally:
+            protocol.cleanup_command(shell_id, command_id)
+        stdout.close()
+        stderr.close()
+        return winrm.Response((stdout.tail.encode('utf-8'),
+                               stderr.tail.encode('utf-8'),
+                               return_code))
+
     def ping(self):
 
         """
@@ -230,11 +394,12 @@ class WinRMRunner(object):
         :rtype: str
 
         """
-        if self.tmpdir is not None:
-            return self.tmpdir
-        return self.run(
-            '@powershell -Command "[System.IO.Path]::GetTempPath()"'
-        ).std_out.strip()
+        if self.tmpdir is None:
+            # it doesn't change, so only ask once
+            self.tmpdir = self.run(
+                '@powershell -Command "[System.IO.Path]::GetTempPath()"'
+            ).std_out.strip()
+        return self.tmpdir
 
     def new_dir(self, path):
 
@@ -296,27 +461,88 @@ class WinRMRunner(object):
 
     def put(self, contents, path):
 
-        """Split contents into chunks and write them to file in the given path.
+        """Write contents to the file in the given path.
+
+        The contents are sent base64-encoded on the stdin of a single
+        command, which writes them to the file and replies with their
+        sha256, so that a file of any size takes one command. The hash is
+        checked against the one of the contents.
 
-        :param contents: The contents to write. string based.
-        :param path: Path to a file.
-                     The file must be inside an existing directory.
+        :param contents: The contents to write. str or bytes; bytes are
+                         written as they are. str is written as utf-8
+                         with a BOM to .ps1 files, because powershell
+                         reads files with no BOM in the ANSI code page,
+                         and in the ANSI code page to other files, same
+                         as Add-Content.
+        :param path: Path to a file. Its directory is created if needed.
 
         :return:
             a list of response objects with information about all executions
         :rtype WinRMCommandExecutionResponse.
         """
-        # Escape single quotes, since the contents is surrounded by them
-        contents = contents.replace("'", "''")
-        chunks = split_into_chunks(contents)
-        responses = [
-            self.run(
-                'Add-Content "{0}" \'{1}\''.format(path, chunk),
-                powershell=True,
+        ansi = False
+        if not isinstance(contents, bytes):
+            if path.lower().endswith('.ps1'):
+                contents = contents.encode('utf-8-sig')
+            else:
+                contents = contents.encode('utf-8')
+                ansi = True
+        script = _RECEIVE_SCRIPT.format(
+            path=path.replace("'", "''"), ansi='true' if ansi else 'false')
+        command = _encode_powershell(
+            script, 'powershell -NoProfile -NonInteractive -EncodedCommand')
+        description = 'put {0}'.format(path)
+        self.logger.debug('[{0}] {1} ({2} bytes)'.format(
+            self.session_config['host'], description, len(contents)))
+        try:
+            std_out, std_err, return_code = self._run_with_stdin(
+                command, _base64_lines(contents))
+        except Exception as e:
+            raise WinRMCommandExecutionError(
+                command=description,
+                error=str(e)
             )
-            for chunk in chunks
-        ]
-        return responses
+        std_out = std_out.decode('utf-8', 'replace')
+        std_err = std_err.decode('utf-8', 'replace')
+        if return_code != 0:
+            raise WinRMCommandExecutionException(
+                command=description,
+                error=std_err,
+                output=std_out,
+                code=return_code)
+        lines = std_out.split()
+        remote_hash = lines[-1] if lines else ''
+        expected_hash = hashlib.sha256(contents).hexdigest()
+        if remote_hash != expected_hash:
+            raise WinRMCommandExecutionError(
+                command=description,
+                error='sha256 of the uploaded file is {0!r}, expected {1}'
+                      .format(remote_hash, expected_hash))
+        return [WinRMCommandExecutionResponse(
+            command=description,
+            std_err=std_err,
+            std_out=std_out,
+            return_code=return_code)]
+
+    def _run_with_stdin(self, command, stdin):
+        """Run command, sending it the chunks of stdin.
+
+        :return: stdout, stderr and the return code of the command
+        """
+        protocol = self.session.protocol
+        shell_id, command_id = self._start_command(
+            command, console_mode_stdin=False)
+        try:
+            chunk = None
+            for next_chunk in stdin:
+                if chunk is not None:
+                    protocol.send_command_input(shell_id, command_id, chunk)
+                chunk = next_chunk
+            protocol.send_command_input(
+                shell_id, command_id, chunk or b'', end=True)
+            return protocol.get_command_output(shell_id, command_id)
+        finally:
+            protocol.cleanup_command(shell_id, command_id)
 
     def put_file(self, src, dst=None):
 
@@ -331,24 +557,39 @@ class WinRMRunner(object):
         """
 
         with open(src) as f:
-            content = f.read()
+            # windows line endings, as the scripts are run by cmd/powershell
+            content = ''.join(
+                '{0}\r\n'.format(line) for line in f.read().splitlines())
 
-        if dst:
-            # Make sure the destination folder exists
-            self.new_dir(ntpath.dirname(dst))
-        else:
+        if not dst:
             dst = self.mktemp()
         self.put(contents=content, path=dst)
         return dst
 
     def close(self):
-        pass
-
-    def run_script(self, script_path):
+        """Remove the env files, and close the shell"""
+        env_files, self._env_files = self._env_files, {}
+        if env_files and self._shell_id is not None:
+            try:
+                self.run('Remove-Item -Force -ErrorAction SilentlyContinue '
+                         '{0}'.format(', '.join(
+                             '"{0}"'.format(path)
+                             for path in env_files.values())),
+                         raise_on_failure=False, powershell=True)
+            except Exception as e:
+                self.logger.debug('Could not remove the env files: %s', e)
+        self._close_shell()
+
+    def run_script(self, script_path, stream=False, timeout=None):
         """Upload script to remote instances, execute it and delete it.
 
         :param script_path: Local path to script
         :type script_path: str
+        :param stream: log the output of the script as it runs
+        :type stream: bool
+        :param timeout: with stream, stop waiting for the script after this
+                        many seconds
+        :type timeout: float
         :return: Script execution output
         :rtype WinRMCommandExecutionResponse
 
@@ -359,12 +600,24 @@ class WinRMRunner(object):
         )
         try:
             self.put_file(script_path, remote_path)
-            result = self.run(remote_path, powershell=True)
+            result = self.run(remote_path, powershell=True, stream=stream,
+                              timeout=timeout)
         finally:
             self.delete(remote_path, ignore_missing=True)
         return result
 
 
+def _encode_powershell(script, prefix='powershell -encodedcommand'):
+    # must use utf16 little endian on windows, see session.run_ps
+    return '{0} {1}'.format(
+        prefix, b64encode(script.encode('utf_16_le')).decode('ascii'))
+
+
+def _base64_lines(contents, chunk_size=PUT_CHUNK_SIZE):
+    for start in range(0, len(contents), chunk_size):
+        yield b64encode(contents[start:start + chunk_size]) + b'\r\n'
+
+
 def split_into_chunks(contents, max_size=2000, separator='\r\n'):
     """Split content into chunks to avoid command line too long error.
 
@@ -0,0 +1,181 @@
+########
+# Copyright (c) 2024 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+############
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from cloudify import constants
+
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_MAX_AGE = 24 * 60 * 60  # seconds
+# results larger than this are not stored; such operations will simply run
+# again if they are redelivered, same as without the journal
+MAX_RESULT_SIZE = 1024 * 1024
+# compact the journal every this many finished tasks
+COMPACT_EVERY = 100
+
+logger = logging.getLogger(__name__)
+
+JournalEntry = namedtuple('JournalEntry',
+                          ['task_id', 'state', 'result', 'timestamp'])
+
+
+class TaskJournal(object):
+    """A local, durable record of the operations handled by a worker.
+
+    When the worker dies after an operation has finished, but before the
+    response was sent, the operation will be sent to the agent again.
+    The journal stores the result of every successful operation, keyed
+    by the task id, so that the worker can reply with the stored result,
+    instead of running the operation again. Failed operations are not
+    stored: a resumed execution sends them again with the same task id,
+    and then they must run again.
+
+    The journal is a sqlite database, and it is bounded: entries older
+    than `max_age` seconds, and all but the `max_entries` newest entries,
+    are removed when the journal is compacted.
+    """
+
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES,
+                 max_age=DEFAULT_MAX_AGE):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._finished_since_compact = 0
+        self._db = sqlite3.connect(path, check_same_thread=False,
+                                   isolation_level=None)
+        with self._lock:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS tasks ('
+                'task_id TEXT PRIMARY KEY, '
+                'state TEXT NOT NULL, '
+                'result TEXT, '
+                'timestamp REAL NOT NULL)'
+            )
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS tasks_timestamp '
+                'ON tasks (timestamp)'
+            )
+        self.compact()
+
+    @classmethod
+    def for_daemon(cls, storage_dir, name, **kwargs):
+        """Open the journal of the daemon `name`, in its storage directory."""
+        if not os.path.exists(storage_dir):
+            os.makedirs(storage_dir)
+        return cls(os.path.join(storage_dir, '{0}.journal'.format(name)),
+                   **kwargs)
+
+    def get(self, task_id):
+        """The journal entry for the task, or None if it is not known."""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT task_id, state, result, timestamp FROM tasks '
+                'WHERE task_id = ?', (task_id, )
+            ).fetchone()
+        if row is None:
+            return None
+        task_id, state, result, timestamp = row
+        if result is not None:
+            result = json.loads(result)
+        return JournalEntry(task_id, state, result, timestamp)
+
+    def get_result(self, task_id):
+        """The stored result of the task, if it has already succeeded."""
+        entry = self.get(task_id)
+        if entry is None or entry.state != constants.TASK_SUCCEEDED:
+            return None
+        return entry.result
+
+    def started(self, task_id):
+        self._write(task_id, constants.TASK_STARTED, None)
+
+    def finished(self, task_id, result):
+        """Store the result of the task, if it succeeded.
+
+        :param result: the response that is going to be sent for the task,
+                       as returned from `handle_task`.
+        """
+        if not result.get('ok'):
+            self.forget(task_id)
+            return
+        try:
+            serialized = json.dumps(result)
+        except (TypeError, ValueError) as e:
+            logger.debug('Not journaling result of task %s: %s', task_id, e)
+            self.forget(task_id)
+            return
+        if len(serialized) > MAX_RESULT_SIZE:
+            logger.debug('Not journaling result of task %s: too large (%d)',
+                         task_id, len(serialized))
+            self.forget(task_id)
+            return
+        self._write(task_id, constants.TASK_SUCCEEDED, serialized)
+
+        self._finished_since_compact += 1
+        if self._finished_since_compact >= COMPACT_EVERY:
+            try:
+                self.compact()
+            except sqlite3.Error as e:
+                logger.warning('Could not compact the journal: %s', e)
+
+    def forget(self, task_id):
+        with self._lock:
+            self._db.execute('DELETE FROM tasks WHERE task_id = ?',
+                             (task_id, ))
+
+    def compact(self):
+        """Remove the expired entries, and the entries over the size bound."""
+        with self._lock:
+            self._finished_since_compact = 0
+            self._db.execute('DELETE FROM tasks WHERE timestamp < ?',
+                             (time.time() - self.max_age, ))
+            self._db.execute(
+                'DELETE FROM tasks WHERE task_id NOT IN ('
+                'SELECT task_id FROM tasks '
+                'ORDER BY timestamp DESC LIMIT ?)',
+                (self.max_entries, )
+            )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def count(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM tasks').fetchone()[0]
+
+    def _write(self, task_id, state, result):
+        # the journal is only an optimization: failing to write to it must
+        # not fail the operation itself
+        try:
+            with self._lock:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO tasks '
+                    '(task_id, state, result, timestamp) VALUES (?, ?, ?, ?)',
+                    (task_id, state, result, time.time())
+                )
+        except sqlite3.Error as e:
+            logger.warning('Could not write task %s to the journal: %s',
+                           task_id, e)
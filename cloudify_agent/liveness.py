@@ -0,0 +1,450 @@
+########
+# Copyright (c) 2024 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+############
+
+"""Waiting for many agents to start, over a single connection.
+
+The start operation of the agent installer waits for its agent to start
+(see `installer.operations.start`). When a workflow installs hundreds of
+agents, every one of these operations used to open its own AMQP
+connection, and ping its own agent.
+
+Instead, the worker can run a `LivenessMonitor`, which the operations
+(running in subprocesses of the worker) ask to wait for their agent, over
+a unix socket. The monitor waits for all the agents of a vhost using one
+connection and one queue, which receives both the started events of the
+agents, and the replies to the pings, which are sent to all the awaited
+agents at once, every PING_INTERVAL.
+
+The worker serves the monitor when LIVENESS_SOCKET_ENV is set, and the
+operations find it through the same variable. Nothing in this package
+sets it: it's up to whoever runs the worker that runs the installer
+operations (eg. the mgmtworker) to set it in the worker environment.
+`AgentWaiter` uses the monitor if there is one, and otherwise waits for
+the agent on a connection of its own.
+"""
+
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+import pika
+
+from cloudify.amqp_client import OLD_PIKA, get_client
+
+from cloudify_agent import readiness
+
+logger = logging.getLogger(__name__)
+
+LIVENESS_SOCKET_ENV = 'CFY_LIVENESS_SOCKET'
+# how often to ping an agent that is being waited for
+PING_INTERVAL = 10
+# keep watching an agent for this long after its last wait ended, so that
+# the next wait for it (the start operation waits in a loop) doesn't
+# have to bind the queue again, and doesn't miss its started event
+AGENT_GRACE = 30
+# close the connection to a vhost that had no awaited agents for this long
+VHOST_IDLE_TIMEOUT = 60
+
+
+class _Agent(object):
+    def __init__(self):
+        self.waiters = set()
+        self.started = False
+        # whether the monitor's queue is bound to the agent's exchange
+        self.bound = False
+        self.last_ping = 0
+        self.last_wait = time.time()
+
+
+class _VhostMonitor(object):
+    """The awaited agents of one vhost, and the connection to it.
+
+    This is the handler of the connection: it consumes from a queue that
+    is bound to the exchange of every awaited agent, both for its started
+    event, and for the replies to the pings, which have this queue as the
+    reply-to.
+    """
+
+    def __init__(self, client):
+        self.queue = 'cloudify-liveness_{0}'.format(uuid.uuid4().hex)
+        self.idle_since = time.time()
+        self._agents = {}
+        self._lock = threading.Lock()
+        self._client = client
+        self._client.add_handler(self)
+        self._client.consume_in_thread()
+
+    def register(self, connection, channel):
+        # also when reconnecting: the queue is gone with the old connection
+        channel.queue_declare(queue=self.queue,
+                              exclusive=True,
+                              auto_delete=True)
+        with self._lock:
+            names = list(self._agents)
+        for name in names:
+            self._bind(channel, name)
+        if OLD_PIKA:
+            channel.basic_consume(self.process, self.queue)
+        else:
+            channel.basic_consume(self.queue, self.process)
+
+    def _bind(self, channel, name):
+        # same as the agent's consumers declare it
+        channel.exchange_declare(exchange=name,
+                                 auto_delete=False,
+                                 durable=True,
+                                 exchange_type='direct')
+        for routing_key in (readiness.STARTED_ROUTING_KEY, self.queue):
+            channel.queue_bind(queue=self.queue,
+                               exchange=name,
+                               routing_key=routing_key)
+
+    def _unbind(self, connection, channel, name):
+        for routing_key in (readiness.STARTED_ROUTING_KEY, self.queue):
+            channel.queue_unbind(queue=self.queue,
+                                 exchange=name,
+                                 routing_key=routing_key)
+
+    def process(self, channel, method, properties, body):
+        channel.basic_ack(method.delivery_tag)
+        with self._lock:
+            agent = self._agents.get(method.exchange)
+            if agent is None:
+                return
+            agent.started = True
+            for waiter in agent.waiters:
+                waiter.set()
+
+    def wait(self, name, timeout):
+        """Wait up to timeout seconds for the agent to start.
+
+        :return: whether the agent has started
+        """
+        waiter = threading.Event()
+        with self._lock:
+            agent = self._agents.get(name)
+            if agent is None:
+                agent = self._agents[name] = _Agent()
+            if agent.started:
+                return True
+            agent.waiters.add(waiter)
+            bind = not agent.bound
+        try:
+            if bind:
+                # if this fails (eg. times out), the next wait binds again
+                self._client.channel_method(
+                    lambda connection, channel: self._bind(channel, name),
+                    timeout=timeout)
+                with self._lock:
+                    agent.bound = True
+                # it might have started already
+                self.ping([name])
+            return waiter.wait(timeout)
+        finally:
+            with self._lock:
+                agent.waiters.discard(waiter)
+                agent.last_wait = time.time()
+
+    def ping(self, names=None, interval=PING_INTERVAL):
+        """Ping the agents, or the awaited ones not pinged within interval.
+
+        All the pings are sent together, by the connection thread.
+        """
+        now = time.time()
+        with self._lock:
+            if names is None:
+                names = [
+                    name for name, agent in self._agents.items()
+                    if agent.waiters and not agent.started
+                    and now - agent.last_ping >= interval
+                ]
+            names = [name for name in names if name in self._agents]
+            for name in names:
+                self._agents[name].last_ping = now
+        if names:
+            self._client.channel_method(
+                self._send_pings, wait=False, names=names,
+                expiration=interval)
+
+    def _send_pings(self, connection, channel, names, expiration):
+        body = json.dumps({
+            'service_task': {'task_name': 'ping', 'kwargs': {}},
+        })
+        for name in names:
+            channel.basic_publish(
+                exchange=name,
+                routing_key='service',
+                body=body,
+                properties=pika.BasicProperties(
+                    reply_to=self.queue,
+                    correlation_id=uuid.uuid4().hex,
+                    expiration='{0}'.format(int(expiration * 1000))))
+
+    def expire(self, grace=AGENT_GRACE):
+        """Stop watching the agents that nobody waited for within grace"""
+        now = time.time()
+        with self._lock:
+            expired = [
+                name for name, agent in self._agents.items()
+                if not agent.waiters and now - agent.last_wait > grace
+            ]
+            for name in expired:
+                del self._agents[name]
+            if self._agents:
+                self.idle_since = None
+            elif self.idle_since is None:
+                self.idle_since = now
+        for name in expired:
+            self._client.channel_method(
+                self._unbind, wait=False, name=name)
+
+    def close(self):
+        self._client.close()
+
+
+class LivenessMonitor(object):
+    """Waits for agents to start, with one _VhostMonitor per vhost."""
+
+    def __init__(self, ping_interval=PING_INTERVAL, grace=AGENT_GRACE,
+                 idle_timeout=VHOST_IDLE_TIMEOUT):
+        self.ping_interval = ping_interval
+        self.grace = grace
+        self.idle_timeout = idle_timeout
+        self._vhosts = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def wait(self, name, timeout, vhost, user, password):
+        key = (vhost, user, password)
+        with self._lock:
+            monitor = self._vhosts.get(key)
+            if monitor is None:
+                monitor = self._vhosts[key] = _VhostMonitor(get_client(
+                    amqp_user=user,
+                    amqp_pass=password,
+                    amqp_vhost=vhost,
+                    name='liveness-monitor',
+                ))
+            # not idle anymore, so that .tick() doesn't close it
+            monitor.idle_since = None
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._ping_loop, name='liveness-pings')
+                self._thread.daemon = True
+                self._thread.start()
+        return monitor.wait(name, timeout)
+
+    def _ping_loop(self):
+        while True:
+            time.sleep(1)
+            try:
+                self.tick()
+            except Exception:
+                logger.exception('Error in the liveness monitor')
+
+    def tick(self):
+        """Send the pings that are due, and forget about idle agents"""
+        with self._lock:
+            vhosts = list(self._vhosts.items())
+        for key, monitor in vhosts:
+            monitor.ping(interval=self.ping_interval)
+            monitor.expire(self.grace)
+        now = time.time()
+        with self._lock:
+            idle = [
+                (key, monitor) for key, monitor in self._vhosts.items()
+                if monitor.idle_since is not None
+                and now - monitor.idle_since > self.idle_timeout
+            ]
+            for key, _ in idle:
+                del self._vhosts[key]
+        for _, monitor in idle:
+            monitor.close()
+
+
+class LivenessServer(object):
+    """Serves a LivenessMonitor on a unix socket, see `AgentWaiter`.
+
+    A request is a line of json, with the name of the agent, the timeout,
+    and the vhost and credentials to use; the response is a line of json,
+    with whether the agent has started.
+    """
+
+    def __init__(self, path, monitor=None):
+        self.path = path
+        self.monitor = monitor or LivenessMonitor()
+        self._sock = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        os.chmod(self.path, 0o600)
+        sock.listen(128)
+        self._sock = sock
+        thread = threading.Thread(
+            target=self._accept_loop, args=(sock, ), name='liveness-server')
+        thread.daemon = True
+        thread.start()
+        logger.info('Serving the liveness monitor on %s', self.path)
+
+    def _accept_loop(self, sock):
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except OSError:
+                # closed
+                return
+            thread = threading.Thread(target=self._handle, args=(conn, ))
+            thread.daemon = True
+            thread.start()
+
+    def _handle(self, conn):
+        try:
+            request = json.loads(_read_line(conn).decode('utf-8'))
+            started = self.monitor.wait(
+                request['name'], request['timeout'], request['vhost'],
+                request['user'], request['password'])
+            response = {'started': started}
+        except Exception as e:
+            logger.error('Liveness request failed: %s', e)
+            response = {'error': str(e)}
+        try:
+            conn.sendall(json.dumps(response).encode('utf-8') + b'\n')
+        except OSError as e:
+            logger.debug('Could not send the liveness response: %s', e)
+        finally:
+            conn.close()
+
+    def close(self):
+        if self._sock is None:
+            return
+        self._sock.close()
+        self._sock = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def serve_from_env():
+    """Serve a LivenessMonitor, if LIVENESS_SOCKET_ENV is set.
+
+    :return: the LivenessServer, or None
+    """
+    path = os.environ.get(LIVENESS_SOCKET_ENV)
+    if not path or not hasattr(socket, 'AF_UNIX'):
+        return None
+    server = LivenessServer(path)
+    try:
+        server.start()
+    except (IOError, OSError) as e:
+        logger.error('Cannot serve the liveness monitor on %s: %s', path, e)
+        return None
+    return server
+
+
+def _read_line(conn):
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = conn.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+class AgentWaiter(object):
+    """Waits for an agent to start, see `installer.operations.start`.
+
+    Using the LivenessMonitor of the worker, if it serves one, or else
+    (or if the monitor fails) on a connection of its own, with
+    `readiness.AgentStartedListener`.
+    """
+
+    def __init__(self, name, vhost, user, password, socket_path=None):
+        self.name = name
+        self._vhost = vhost
+        self._user = user
+        self._password = password
+        if socket_path is None:
+            socket_path = os.environ.get(LIVENESS_SOCKET_ENV)
+        if not hasattr(socket, 'AF_UNIX'):
+            socket_path = None
+        self._socket_path = socket_path
+        self._client = None
+        self._listener = None
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for the agent to start.
+
+        :return: whether the agent has started
+        """
+        if self._socket_path:
+            try:
+                return self._ask_monitor(timeout)
+            except (IOError, OSError, ValueError, KeyError) as e:
+                logger.warning('Cannot use the liveness monitor on %s (%s), '
+                               'waiting for %s directly',
+                               self._socket_path, e, self.name)
+                self._socket_path = None
+        if self._client is None:
+            self._listener = readiness.AgentStartedListener(self.name)
+            self._client = get_client(
+                amqp_user=self._user,
+                amqp_pass=self._password,
+                amqp_vhost=self._vhost,
+            )
+            self._client.add_handler(self._listener)
+            self._client.consume_in_thread()
+        self._listener.ping(timeout)
+        return self._listener.wait(timeout)
+
+    def _ask_monitor(self, timeout):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # the monitor replies after at most timeout
+        sock.settimeout(timeout + 30)
+        try:
+            sock.connect(self._socket_path)
+            sock.sendall(json.dumps({
+                'name': self.name,
+                'timeout': timeout,
+                'vhost': self._vhost,
+                'user': self._user,
+                'password': self._password,
+            }).encode('utf-8') + b'\n')
+            response = json.loads(_read_line(sock).decode('utf-8'))
+        finally:
+            sock.close()
+        if 'error' in response:
+            raise IOError(response['error'])
+        return bool(response['started'])
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,127 @@
+########
+# Copyright (c) 2024 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+############
+
+"""The load of the agent and of its host, as reported in the ping task.
+
+Everything here must be cheap to compute, so that the ping response
+stays fast: only small /proc files are read for every report, and
+the installed plugins are only counted again when they might have changed.
+"""
+
+import os
+import threading
+import time
+
+from cloudify.utils import _plugins_base_dir
+
+PRESSURE_DIR = '/proc/pressure'
+MEMINFO = '/proc/meminfo'
+# count the installed plugins again at least this often, because plugins
+# are also installed on demand, by operations
+PLUGIN_COUNT_TTL = 60
+
+
+def loadavg():
+    """The 1, 5 and 15 minute host load averages, or None."""
+    try:
+        return list(os.getloadavg())
+    except (AttributeError, OSError):
+        # windows
+        return None
+
+
+def pressure(resource, pressure_dir=PRESSURE_DIR):
+    """The "some" 10 second pressure stall average of the resource.
+
+    That is the percentage of time in which at least one task was stalled
+    waiting for the resource (cpu, memory or io).
+    Returns None if PSI is not available (not linux, or an old kernel).
+    """
+    try:
+        with open(os.path.join(pressure_dir, resource)) as f:
+            line = f.readline()
+    except (IOError, OSError):
+        return None
+    # some avg10=0.00 avg60=0.00 avg300=0.00 total=0
+    for field in line.split()[1:]:
+        name, _, value = field.partition('=')
+        if name == 'avg10':
+            return float(value)
+    return None
+
+
+def memory_available(meminfo=MEMINFO):
+    """Memory available for starting new processes, in bytes, or None."""
+    try:
+        with open(meminfo) as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+class PluginCounter(object):
+    """Counts the installed managed plugins, and caches the count.
+
+    Managed plugins are installed in plugins/<tenant>/<name>/<version>.
+    Call .invalidate() after installing or uninstalling plugins.
+    """
+
+    def __init__(self, root=None, ttl=PLUGIN_COUNT_TTL):
+        self._root = root
+        self._ttl = ttl
+        self._count = None
+        self._counted_at = None
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self._count = None
+
+    def count(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._count is None or now - self._counted_at > self._ttl:
+                self._count = self._count_plugins()
+                self._counted_at = now
+            return self._count
+
+    def _count_plugins(self):
+        plugins_dir = os.path.join(
+            self._root or _plugins_base_dir(), 'plugins')
+        count = 0
+        for tenant in _subdirs(plugins_dir):
+            for name in _subdirs(tenant):
+                count += len(_subdirs(name))
+        return count
+
+
+def _subdirs(path):
+    try:
+        return [entry.path for entry in os.scandir(path) if entry.is_dir()]
+    except (IOError, OSError):
+        return []
+
+
+def host_load():
+    return {
+        'loadavg': loadavg(),
+        'cpu_pressure': pressure('cpu'),
+        'memory_pressure': pressure('memory'),
+        'io_pressure': pressure('io'),
+        'memory_available': memory_available(),
+    }
@@ -0,0 +1,176 @@
+########
+# Copyright (c) 2024 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+############
+
+"""A single worker process that serves several agents.
+
+Every agent on a host normally has its own worker process, with its own
+interpreter, connections and threads. With `--agents`, one worker
+process serves the queues of several agents instead:
+
+    python -m cloudify_agent.worker --agents agent1,agent2
+
+The agents are loaded from the daemon storage. Every agent still has its
+own connection (with its own broker credentials and vhost), consumers,
+operation registry and task journal, and its operations run with its own
+environment. The process, the threads that run the tasks, the log writer
+and the caches are shared.
+
+All the agents must belong to the same user, because they run in the same
+process. Code that runs in the worker process itself and depends on the
+agent settings (installing plugins) is run with the settings of the agent
+applied, see `worker.agent_environment`.
+
+This is a mode of the worker only: the process managers don't run such
+a worker, and `cfy-agent daemons` still starts one worker per agent.
+A shared worker has to be run by something else (eg. a service
+definition written by hand), and the agents it serves must not also be
+started by their own daemons.
+"""
+
+import argparse
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from cloudify.amqp_client import get_client
+from cloudify.logs import setup_agent_logger
+
+from cloudify_agent import worker
+from cloudify_agent.api import exceptions
+from cloudify_agent.api.factory import DaemonFactory
+from cloudify_agent.task_logging import TaskLogger, use_json_format
+
+
+def agent_env(daemon):
+    """The environment of the daemon's worker, see the pm config templates.
+
+    Only the settings that are specific to the agent are included: the
+    process-wide ones (eg. the log level) are the same for all the agents.
+    """
+    env = {
+        'AGENT_NAME': daemon.name,
+        'AGENT_WORK_DIR': daemon.workdir,
+        'AGENT_LOG_DIR': daemon.log_dir,
+        'LOCAL_REST_CERT_FILE': daemon.local_rest_cert_file,
+        'CFY_RESOURCES_ROOT': daemon.resources_root,
+        'CFY_PLUGINS_ROOT': daemon.agent_dir,
+    }
+    if daemon.executable_temp_path:
+        env['CFY_EXEC_TEMP'] = daemon.executable_temp_path
+    env.update({str(k): str(v) for k, v in daemon.extra_env.items()})
+    return env
+
+
+class HostedAgentWorker(worker.AgentWorker):
+    """An AgentWorker for one of the agents served by a MultiAgentWorker.
+
+    The connection is made using the broker settings of the daemon, which
+    is loaded again for every connection, so that a cluster-update, which
+    saves the new brokers in the daemon, moves this agent over to them.
+    """
+
+    def __init__(self, daemon, factory, journal=None, task_logger=None,
+                 executor=None):
+        args = argparse.Namespace(
+            name=daemon.name,
+            queue=daemon.queue,
+            max_workers=daemon.max_workers,
+            hooks_queue=None,
+        )
+        super(HostedAgentWorker, self).__init__(
+            args, journal=journal, task_logger=task_logger,
+            agent_env=agent_env(daemon), executor=executor)
+        self._factory = factory
+
+    def _make_connection(self, handlers, connect_timeout):
+        daemon = self._factory.load(self.args.name)
+        connection = get_client(
+            daemon.broker_ip,
+            daemon.broker_user,
+            daemon.broker_pass,
+            daemon.broker_port,
+            daemon.broker_vhost,
+            daemon.broker_ssl_enabled,
+            daemon.broker_ssl_cert_path,
+            name=daemon.name,
+            connect_timeout=connect_timeout,
+            cls=worker._WorkerConnection,
+        )
+        for handler in handlers:
+            connection.add_handler(handler)
+        return connection
+
+    def _reload_broker_config(self):
+        # the process-wide broker config is not used: the brokers are
+        # read from the daemon, when connecting
+        worker.logger.info('Connecting %s to the new brokers',
+                           self.args.name)
+
+
+class MultiAgentWorker(object):
+    """Runs a HostedAgentWorker for every agent, in one process."""
+
+    def __init__(self, names, factory=None, task_logger=None):
+        self._factory = factory or DaemonFactory()
+        self._task_logger = task_logger
+        self.daemons = [self._factory.load(name) for name in names]
+        users = {daemon.user for daemon in self.daemons}
+        if len(users) > 1:
+            raise exceptions.DaemonConfigurationError(
+                'All the agents served by one worker must belong to the '
+                'same user, but they belong to: {0}'
+                .format(', '.join(sorted(users))))
+        # every consumer still runs at most max_workers tasks at a time,
+        # so that one busy agent doesn't hold up the others; the pool is
+        # large enough for all of them, and only its threads are shared
+        self.executor = ThreadPoolExecutor(
+            max_workers=sum(2 * daemon.max_workers
+                            for daemon in self.daemons),
+            thread_name_prefix='task')
+        self.workers = [
+            HostedAgentWorker(
+                daemon, self._factory,
+                journal=worker._open_task_journal(daemon.name),
+                task_logger=task_logger,
+                executor=self.executor)
+            for daemon in self.daemons
+        ]
+
+    def run(self):
+        threads = []
+        for agent_worker in self.workers:
+            thread = threading.Thread(
+                target=agent_worker.run,
+                name='agent-{0}'.format(agent_worker.args.name))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        # the workers never return: they reconnect forever
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(1)
+
+
+def main(names):
+    log_name = os.environ.get('AGENT_NAME') or 'agents'
+    worker.logger = logging.getLogger('worker.{0}'.format(log_name))
+    setup_agent_logger(log_name)
+    task_logger = TaskLogger.from_env(worker.logger)
+    if task_logger.json_format:
+        use_json_format()
+    worker.logger.info('Serving the agents: %s', ', '.join(names))
+    MultiAgentWorker(names, task_logger=task_logger).run()
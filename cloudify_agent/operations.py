@@ -38,8 +38,8 @@ from cloudify.utils import (get_rest_token,
 
 from cloudify_agent.celery_app import get_celery_app
 from cloudify_agent.api.plugins import installer as plugin_installer
+from cloudify_agent.api.plugins import parallel
 from cloudify_agent.api.factory import DaemonFactory
-from cloudify_agent.api import exceptions
 from cloudify_agent.api import utils
 from cloudify_agent.installer.script import (
     install_script_download_link,
@@ -55,24 +55,29 @@ CELERY_TASK_RESULT_EXPIRES = 600
 
 
 @operation
-def install_plugins(plugins, **_):
-    for plugin in plugins:
-        name = plugin.get('package_name') or plugin['name']
-        ctx.logger.info('Installing plugin: %s', name)
-        try:
-            plugin_installer.install(
-                plugin=plugin,
-                deployment_id=ctx.deployment.id,
-                blueprint_id=ctx.blueprint.id)
-        except exceptions.PluginInstallationError:
-            raise
+def install_plugins(plugins, max_parallel=None, **_):
+    """Install the plugins, up to max_parallel at a time.
+
+    All the plugins are attempted, even if some of them fail.
+    """
+    def _install(plugin):
+        plugin_installer.install(
+            plugin=plugin,
+            deployment_id=ctx.deployment.id,
+            blueprint_id=ctx.blueprint.id)
+
+    results = parallel.run_for_plugins(
+        plugins, _install, 'Installing', ctx.logger, max_parallel,
+        key=parallel.install_key)
+    parallel.raise_for_errors(results, 'installing')
 
 
 @operation
-def uninstall_plugins(plugins, **_):
-    for plugin in plugins:
-        ctx.logger.info('Uninstalling plugin: %s', plugin['package_name'])
-        plugin_installer.uninstall(plugin)
+def uninstall_plugins(plugins, max_parallel=None, **_):
+    results = parallel.run_for_plugins(
+        plugins, plugin_installer.uninstall, 'Uninstalling', ctx.logger,
+        max_parallel, key=parallel.uninstall_dir)
+    parallel.raise_for_errors(results, 'uninstalling')
 
 
 @operation
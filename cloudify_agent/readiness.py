@@ -0,0 +1,327 @@
+########
+# Copyright (c) 2024 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+############
+
+"""Let the worker tell whoever started it that it is ready.
+
+Before starting a daemon, `Daemon.start` binds a unix datagram socket
+in the daemon storage directory, and the worker sends a message to it
+as soon as its consumers are attached. That way, start doesn't have to
+ping the worker over AMQP again and again, until it replies.
+
+This is only an optimization: if the socket can't be used (eg. on
+windows, or when the worker is an older version), start still pings
+the worker over AMQP.
+
+Agents that are started by something else than `Daemon.start` (eg. a
+userdata script) can't be reached over a local socket, so the worker also
+publishes a "started" event to its exchange, once, when its consumers
+are first attached. The installer's start operation waits for that event
+with `AgentStartedListener`, rather than pinging the agent every few
+seconds until it replies.
+
+Under systemd, the worker also tells systemd itself that it is ready,
+and keeps pinging the systemd watchdog, see `SystemdNotifier`.
+"""
+
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+import pika
+
+from cloudify.amqp_client import OLD_PIKA
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_SOCKET_ENV = 'NOTIFY_SOCKET'
+WATCHDOG_USEC_ENV = 'WATCHDOG_USEC'
+WATCHDOG_PID_ENV = 'WATCHDOG_PID'
+# the routing key of the started event, on the agent's exchange
+STARTED_ROUTING_KEY = 'started'
+
+
+def ready_socket_path(storage_dir, name):
+    return os.path.join(storage_dir, '{0}.ready'.format(name))
+
+
+class ReadinessListener(object):
+    """Waits for the ready message of a worker.
+
+    Use as a context manager, which removes the socket on exit.
+    If the socket can't be bound, `.wait()` just sleeps, so that it can
+    be used for pacing the AMQP checks either way.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._sock = None
+        if not hasattr(socket, 'AF_UNIX'):
+            return
+        try:
+            if os.path.exists(path):
+                # left over by a start that was interrupted
+                os.unlink(path)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.bind(path)
+        except (IOError, OSError) as e:
+            logger.debug('Cannot listen for the worker being ready on %s: '
+                         '%s', path, e)
+            return
+        self._sock = sock
+
+    @property
+    def listening(self):
+        return self._sock is not None
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for the worker to be ready.
+
+        :return: the ready message sent by the worker, or None
+        """
+        if self._sock is None:
+            time.sleep(timeout)
+            return None
+        self._sock.settimeout(max(timeout, 0))
+        try:
+            data = self._sock.recv(4096)
+        except socket.timeout:
+            return None
+        try:
+            return json.loads(data.decode('utf-8'))
+        except ValueError:
+            return {}
+
+    def close(self):
+        if self._sock is None:
+            return
+        self._sock.close()
+        self._sock = None
+        try:
+            os.unlink(self.path)
+        except (IOError, OSError):
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def notify_ready(path):
+    """Tell the listener on path, if there is one, that we're ready.
+
+    :return: whether the message was sent
+    """
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(path):
+        return False
+    message = json.dumps({'pid': os.getpid(), 'time': time.time()})
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.sendto(message.encode('utf-8'), path)
+    except (IOError, OSError) as e:
+        # nobody is waiting (anymore), eg. the worker was restarted by
+        # the process manager rather than by `cfy-agent daemons start`
+        logger.debug('Could not send the ready message to %s: %s', path, e)
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+def publish_started(connection, exchange, name):
+    """Publish the started event of the agent to its exchange.
+
+    Nobody might be listening, in which case the event is dropped.
+    This doesn't wait for the event to be sent: the caller can be the
+    connection thread itself, which is the one that sends it.
+
+    :param connection: a connected AMQPConnection
+    :return: whether the event was scheduled to be published
+    """
+    try:
+        connection.publish({
+            'exchange': exchange,
+            'routing_key': STARTED_ROUTING_KEY,
+            'body': json.dumps({
+                'name': name, 'pid': os.getpid(), 'time': time.time()}),
+        }, wait=False)
+    except Exception as e:
+        logger.debug('Could not publish the started event: %s', e)
+        return False
+    return True
+
+
+class AgentStartedListener(object):
+    """Waits for an agent to start, over AMQP.
+
+    A handler for an AMQPClient on the agent's vhost: it consumes from a
+    temporary queue, bound to the agent's exchange, that receives the
+    started event (see `publish_started`). `.ping()` sends a ping task
+    that the agent replies to on the same queue, so that an agent that
+    was already running, or is too old to send the event, is noticed too.
+    Either way, `.wait()` returns as soon as the message arrives.
+    """
+
+    def __init__(self, exchange):
+        self.exchange = exchange
+        self.queue = '{0}_started_{1}'.format(exchange, uuid.uuid4().hex)
+        self.message = None
+        self._connection = None
+        self._started = threading.Event()
+
+    def register(self, connection, channel):
+        self._connection = connection
+        # same as the agent's consumers declare it
+        channel.exchange_declare(exchange=self.exchange,
+                                 auto_delete=False,
+                                 durable=True,
+                                 exchange_type='direct')
+        channel.queue_declare(queue=self.queue,
+                              exclusive=True,
+                              auto_delete=True)
+        # the started event, and the reply to the ping, which the agent
+        # sends with the reply-to queue as the routing key
+        for routing_key in (STARTED_ROUTING_KEY, self.queue):
+            channel.queue_bind(queue=self.queue,
+                               exchange=self.exchange,
+                               routing_key=routing_key)
+        if OLD_PIKA:
+            channel.basic_consume(self.process, self.queue)
+        else:
+            channel.basic_consume(self.queue, self.process)
+
+    def process(self, channel, method, properties, body):
+        channel.basic_ack(method.delivery_tag)
+        try:
+            self.message = json.loads(body.decode('utf-8'))
+        except ValueError:
+            self.message = {}
+        self._started.set()
+
+    def ping(self, timeout):
+        """Send a ping task, which expires if not handled within timeout"""
+        self._connection.publish({
+            'exchange': self.exchange,
+            'routing_key': 'service',
+            'body': json.dumps({
+                'service_task': {'task_name': 'ping', 'kwargs': {}},
+            }),
+            'properties': pika.BasicProperties(
+                reply_to=self.queue,
+                correlation_id=uuid.uuid4().hex,
+                # milliseconds, as a string
+                expiration='{0}'.format(int(timeout * 1000))),
+        })
+
+    @property
+    def started(self):
+        return self._started.is_set()
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for the agent to start.
+
+        :return: whether the agent has started
+        """
+        return self._started.wait(timeout)
+
+
+class SystemdNotifier(object):
+    """Sends service notifications to systemd, same as sd_notify(3).
+
+    When the service isn't run by systemd with Type=notify, there is no
+    NOTIFY_SOCKET, and all the notifications are no-ops.
+    """
+
+    def __init__(self, address=None, watchdog_usec=None):
+        if address and address.startswith('@'):
+            # an abstract namespace socket
+            address = '\0' + address[1:]
+        self.address = address
+        self.watchdog_usec = watchdog_usec
+
+    @classmethod
+    def from_env(cls, environ=None, unset=True):
+        """Make a notifier from the environment that systemd sets.
+
+        :param unset: remove the variables from the environment, so that
+                      they are not inherited by subprocesses, which
+                      are not allowed to notify anyway
+        """
+        environ = os.environ if environ is None else environ
+        address = environ.get(NOTIFY_SOCKET_ENV)
+        watchdog_usec = None
+        watchdog_pid = environ.get(WATCHDOG_PID_ENV)
+        if not watchdog_pid or watchdog_pid == str(os.getpid()):
+            try:
+                watchdog_usec = int(environ.get(WATCHDOG_USEC_ENV) or 0)
+            except ValueError:
+                pass
+        if unset:
+            for key in (NOTIFY_SOCKET_ENV, WATCHDOG_USEC_ENV,
+                        WATCHDOG_PID_ENV):
+                environ.pop(key, None)
+        return cls(address, watchdog_usec or None)
+
+    @property
+    def enabled(self):
+        return bool(self.address)
+
+    @property
+    def watchdog_interval(self):
+        """How often to ping the watchdog, in seconds, or None.
+
+        That is half of the watchdog timeout, as sd_watchdog_enabled(3)
+        recommends.
+        """
+        if not self.enabled or not self.watchdog_usec:
+            return None
+        return self.watchdog_usec / 2e6
+
+    def notify(self, **fields):
+        """Send the fields, eg. notify(READY=1, STATUS='Running')
+
+        :return: whether the notification was sent
+        """
+        if not self.enabled:
+            return False
+        message = ''.join('{0}={1}\n'.format(key, value)
+                          for key, value in fields.items())
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.sendto(message.encode('utf-8'), self.address)
+        except (IOError, OSError) as e:
+            logger.debug('Could not notify systemd: %s', e)
+            return False
+        finally:
+            sock.close()
+        return True
+
+    def ready(self, status=None):
+        fields = {'READY': 1}
+        if status:
+            fields['STATUS'] = status
+        return self.notify(**fields)
+
+    def status(self, status):
+        return self.notify(STATUS=status)
+
+    def watchdog(self):
+        return self.notify(WATCHDOG=1)
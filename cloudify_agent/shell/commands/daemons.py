@@ -16,14 +16,43 @@
 import click
 import json
 import os
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from cloudify_agent.api import defaults
+from cloudify_agent.api import defaults, exceptions
 from cloudify_agent.api.factory import DaemonFactory
 from cloudify_agent.shell import env
 from cloudify_agent.shell.decorators import handle_failures
 from cloudify_agent.shell.commands import cfy
 
 
+# how many daemons --names/--all operate on at the same time
+DEFAULT_MAX_PARALLEL = 8
+
+DaemonResult = namedtuple('DaemonResult',
+                          ['name', 'result', 'error', 'duration'])
+
+
+def _multi_daemon_options(func):
+    """The options for operating on several daemons, see _run_for_daemons"""
+    func = click.option(
+        '--max-parallel',
+        help='With --names or --all: the maximum number of daemons '
+             'to operate on at the same time.',
+        type=int,
+        default=DEFAULT_MAX_PARALLEL)(func)
+    func = click.option(
+        '--all', 'all_daemons',
+        help='Operate on all the daemons concurrently, instead of on --name.',
+        is_flag=True)(func)
+    func = click.option(
+        '--names',
+        help='Comma separated names of several daemons, to operate on '
+             'concurrently, instead of --name.')(func)
+    return func
+
+
 class _ExpandUserPath(click.Path):
     """Like click.Path but also calls os.path.expanduser"""
     def convert(self, value, param, ctx):
@@ -57,8 +86,8 @@ def create(name, user, **params):
 @cfy.command()
 @click.option('--name',
               help='The name of the daemon. [env {0}]'.format(env.AGENT_NAME),
-              required=True,
               envvar=env.AGENT_NAME)
+@_multi_daemon_options
 @click.option('--user',
               help='The user to load the configuration from. Defaults to '
                    'current user. [env {0}]'
@@ -78,13 +107,28 @@ def create(name, user, **params):
               is_flag=True,
               default=not defaults.DELETE_AMQP_QUEUE_BEFORE_START)
 @handle_failures
-def start(name, interval, timeout, no_delete_amqp_queue, user=None):
+def start(name, names, all_daemons, max_parallel, interval, timeout,
+          no_delete_amqp_queue, user=None):
 
     """
     Starts the daemon.
 
     """
 
+    if names or all_daemons:
+        def _start(daemon):
+            daemon.start(
+                interval=interval,
+                timeout=timeout,
+                delete_amqp_queue=not no_delete_amqp_queue
+            )
+            return 'started'
+        _run_for_daemons(_daemon_names(names, all_daemons, user=user),
+                         'start', _start, user=user,
+                         max_parallel=max_parallel)
+        return
+
+    _require_name(name)
     click.echo('Starting...')
     daemon = _load_daemon(name, user=user)
     daemon.start(
@@ -98,8 +142,8 @@ def start(name, interval, timeout, no_delete_amqp_queue, user=None):
 @cfy.command()
 @click.option('--name',
               help='The name of the daemon. [env {0}]'.format(env.AGENT_NAME),
-              required=True,
               envvar=env.AGENT_NAME)
+@_multi_daemon_options
 @click.option('--interval',
               help='The interval in seconds to sleep when waiting '
                    'for the daemon to stop.',
@@ -109,13 +153,22 @@ def start(name, interval, timeout, no_delete_amqp_queue, user=None):
                    'for the daemon to stop.',
               default=defaults.STOP_TIMEOUT)
 @handle_failures
-def stop(name, interval, timeout):
+def stop(name, names, all_daemons, max_parallel, interval, timeout):
 
     """
     Stops the daemon.
 
     """
 
+    if names or all_daemons:
+        def _stop(daemon):
+            daemon.stop(interval=interval, timeout=timeout)
+            return 'stopped'
+        _run_for_daemons(_daemon_names(names, all_daemons), 'stop', _stop,
+                         max_parallel=max_parallel)
+        return
+
+    _require_name(name)
     click.echo('Stopping...')
     daemon = _load_daemon(name)
     daemon.stop(interval=interval, timeout=timeout)
@@ -125,16 +178,25 @@ def stop(name, interval, timeout):
 @cfy.command()
 @click.option('--name',
               help='The name of the daemon. [env {0}]'.format(env.AGENT_NAME),
-              required=True,
               envvar=env.AGENT_NAME)
+@_multi_daemon_options
 @handle_failures
-def restart(name):
+def restart(name, names, all_daemons, max_parallel):
 
     """
     Restarts the daemon.
 
     """
 
+    if names or all_daemons:
+        def _restart(daemon):
+            daemon.restart()
+            return 'restarted'
+        _run_for_daemons(_daemon_names(names, all_daemons), 'restart',
+                         _restart, max_parallel=max_parallel)
+        return
+
+    _require_name(name)
     click.echo('Restarting...')
     daemon = _load_daemon(name)
     daemon.restart()
@@ -187,22 +249,106 @@ def ls():
 
     """
 
-    from cloudify_agent.shell.main import get_logger
-    daemons = DaemonFactory().load_all(logger=get_logger())
-    for daemon in daemons:
+    for daemon in DaemonFactory().list_daemons():
         click.echo(daemon.name)
 
 
 @cfy.command()
 @click.option('--name',
               help='The name of the daemon. [env {0}]'.format(env.AGENT_NAME),
-              required=True,
               envvar=env.AGENT_NAME)
+@_multi_daemon_options
 @handle_failures
-def status(name):
+def status(name, names, all_daemons, max_parallel):
+    if names or all_daemons:
+        def _status(daemon):
+            return 'running' if daemon.status() else 'not running'
+        _run_for_daemons(_daemon_names(names, all_daemons), 'status',
+                         _status, max_parallel=max_parallel)
+        return
+
+    _require_name(name)
     _load_daemon(name).status()
 
 
+def _require_name(name):
+    if not name:
+        raise click.UsageError(
+            'One of --name, --names or --all is required')
+
+
+def _daemon_names(names, all_daemons, user=None):
+    if all_daemons:
+        return [summary.name for summary
+                in DaemonFactory(username=user).list_daemons()]
+    return [name.strip() for name in names.split(',') if name.strip()]
+
+
+def _run_for_daemons(names, action, func, user=None,
+                     max_parallel=DEFAULT_MAX_PARALLEL):
+    """Call func(daemon) for all the daemons, concurrently.
+
+    Every result is printed as soon as it's known, followed by a summary
+    of all of them. A failure for one daemon doesn't stop the others.
+
+    :param func: returns a description of the result, eg. "started"
+    :raise ClickException: if func failed for any of the daemons
+    """
+    if not names:
+        click.echo('No daemons found')
+        return
+
+    def _run(name):
+        started = time.time()
+        result, error = None, None
+        try:
+            result = func(_load_daemon(name, user=user))
+        except (Exception,
+                exceptions.DaemonException,
+                exceptions.DaemonError) as e:
+            error = e
+        return DaemonResult(name, result, error, time.time() - started)
+
+    max_parallel = max(1, min(max_parallel, len(names)))
+    click.echo('Running {0} for {1} daemons, {2} at a time...'
+               .format(action, len(names), max_parallel))
+    results = []
+    with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+        futures = [executor.submit(_run, name) for name in names]
+        for future in as_completed(futures):
+            result = future.result()
+            if result.error is None:
+                click.echo('{0}: {1} ({2:.1f}s)'.format(
+                    result.name, result.result, result.duration))
+            else:
+                click.echo('{0}: {1} failed ({2:.1f}s): {3}'.format(
+                    result.name, action, result.duration, result.error),
+                    err=True)
+            results.append(result)
+
+    _echo_summary(results)
+    failed = sorted(r.name for r in results if r.error is not None)
+    if failed:
+        raise click.ClickException('{0} failed for {1} of {2} daemons: {3}'
+                                   .format(action, len(failed), len(results),
+                                           ', '.join(failed)))
+
+
+def _echo_summary(results):
+    rows = [('NAME', 'RESULT', 'TIME')]
+    for result in sorted(results, key=lambda r: r.name):
+        rows.append((
+            result.name,
+            result.result if result.error is None else 'failed',
+            '{0:.1f}s'.format(result.duration),
+        ))
+    widths = [max(len(row[column]) for row in rows) for column in range(3)]
+    click.echo('')
+    for row in rows:
+        click.echo('  '.join(value.ljust(width)
+                             for value, width in zip(row, widths)).rstrip())
+
+
 def _load_daemon(name, user=None):
     from cloudify_agent.shell.main import get_logger
     return DaemonFactory(username=user).load(name, logger=get_logger())
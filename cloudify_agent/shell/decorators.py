@@ -47,6 +47,9 @@ def handle_failures(func):
     def wrapper(*args, **kwargs):
         try:
             func(*args, **kwargs)
+        except click.UsageError:
+            # keep the exit code of click's own usage errors
+            raise
         except BaseException as e:
             tpe, value, tb = sys.exc_info()
 
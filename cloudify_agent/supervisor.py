@@ -0,0 +1,263 @@
+########
+# Copyright (c) 2024 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+############
+
+"""A minimal supervisor for workers that have no process manager.
+
+The detach process management can run the worker under this supervisor:
+
+    python -m cloudify_agent.supervisor --pid-file agent.pid \\
+        --status-socket agent.status -- python -m cloudify_agent.worker ...
+
+The supervisor runs the worker as its child, and restarts it as soon as
+it exits, with an exponential backoff, so that a worker that keeps
+crashing doesn't spin. It doesn't need any privileges.
+
+The pid file contains the pid of the supervisor: SIGTERM stops the worker
+and then the supervisor. The status of the worker can be queried on the
+status socket, see `query_status`, which is much cheaper than running
+a status command.
+"""
+
+import argparse
+import json
+import logging
+import os
+import signal
+import socket
+import subprocess
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# wait this long before the first restart, and double it after every
+# restart, up to MAX_BACKOFF
+MIN_BACKOFF = 0.5
+MAX_BACKOFF = 30
+# a worker that ran for this long is considered to have started fine, so
+# the backoff starts over if it exits
+STABLE_AFTER = 60
+# wait this long for the worker to exit after SIGTERM, before killing it
+STOP_TIMEOUT = 10
+
+
+class Supervisor(object):
+    """Runs a command, and restarts it when it exits, until stopped."""
+
+    def __init__(self, command, pid_file=None, status_socket=None,
+                 min_backoff=MIN_BACKOFF, max_backoff=MAX_BACKOFF,
+                 stable_after=STABLE_AFTER, stop_timeout=STOP_TIMEOUT):
+        self.command = command
+        self.pid_file = pid_file
+        self.status_socket = status_socket
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.stable_after = stable_after
+        self.stop_timeout = stop_timeout
+        self.restarts = 0
+        self.last_exit_code = None
+        self._child = None
+        self._child_started = None
+        self._stopping = threading.Event()
+        # reentrant, because .stop() also runs as a signal handler
+        self._lock = threading.RLock()
+        self._server = None
+
+    def status(self):
+        with self._lock:
+            child = self._child
+            running = child is not None and child.poll() is None
+            return {
+                'pid': os.getpid(),
+                'worker_pid': child.pid if running else None,
+                'running': running,
+                'started_at': self._child_started if running else None,
+                'restarts': self.restarts,
+                'last_exit_code': self.last_exit_code,
+            }
+
+    def run(self):
+        self._write_pid_file()
+        self._serve_status()
+        backoff = self.min_backoff
+        try:
+            while not self._stopping.is_set():
+                started = self._spawn()
+                if self._stopping.is_set():
+                    # stopped while the worker was being started
+                    self.stop()
+                exit_code = self._child.wait()
+                with self._lock:
+                    self.last_exit_code = exit_code
+                if self._stopping.is_set():
+                    break
+                if time.time() - started >= self.stable_after:
+                    backoff = self.min_backoff
+                logger.warning('Worker exited with %s, restarting in %.1fs',
+                               exit_code, backoff)
+                if self._stopping.wait(backoff):
+                    break
+                backoff = min(backoff * 2, self.max_backoff)
+                with self._lock:
+                    self.restarts += 1
+        finally:
+            self._close()
+
+    def stop(self, *_):
+        """Stop the worker, and then the supervisor. Also a signal handler."""
+        self._stopping.set()
+        with self._lock:
+            child = self._child
+        if child is not None and child.poll() is None:
+            child.terminate()
+            threading.Thread(target=self._kill_after_timeout,
+                             args=(child,), daemon=True).start()
+
+    def _kill_after_timeout(self, child):
+        try:
+            child.wait(self.stop_timeout)
+        except subprocess.TimeoutExpired:
+            logger.warning('Worker did not exit in %ss, killing it',
+                           self.stop_timeout)
+            child.kill()
+
+    def _spawn(self):
+        with self._lock:
+            self._child = subprocess.Popen(
+                self.command, stdin=subprocess.DEVNULL)
+            self._child_started = time.time()
+        logger.info('Started the worker: pid %s', self._child.pid)
+        return self._child_started
+
+    def _write_pid_file(self):
+        if not self.pid_file:
+            return
+        with open(self.pid_file, 'w') as f:
+            f.write(str(os.getpid()))
+
+    def _serve_status(self):
+        if not self.status_socket or not hasattr(socket, 'AF_UNIX'):
+            return
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            if os.path.exists(self.status_socket):
+                os.unlink(self.status_socket)
+            server.bind(self.status_socket)
+            server.listen(5)
+        except OSError as e:
+            # the status is only a convenience: supervise the worker anyway
+            logger.error('Cannot serve the status on %s: %s',
+                         self.status_socket, e)
+            server.close()
+            return
+        self._server = server
+        thread = threading.Thread(target=self._status_loop, args=(
+            self._server,), name='supervisor-status', daemon=True)
+        thread.start()
+
+    def _status_loop(self, server):
+        while True:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                # closed
+                return
+            try:
+                conn.sendall(json.dumps(self.status()).encode('utf-8'))
+            except OSError as e:
+                logger.debug('Could not send the status: %s', e)
+            finally:
+                conn.close()
+
+    def _close(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+            try:
+                os.unlink(self.status_socket)
+            except OSError:
+                pass
+        if self.pid_file and \
+                _read_pid(self.pid_file) == os.getpid():
+            os.unlink(self.pid_file)
+
+
+def _read_pid(path):
+    try:
+        with open(path) as f:
+            return int(f.read().strip())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def query_status(path, timeout=1):
+    """The status of the supervised worker, or None if not supervised.
+
+    :return: a dict, with `running` telling whether the worker is running
+    """
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        chunks = []
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    except (IOError, OSError) as e:
+        logger.debug('Could not query the supervisor on %s: %s', path, e)
+        return None
+    finally:
+        sock.close()
+    try:
+        return json.loads(b''.join(chunks).decode('utf-8'))
+    except ValueError:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pid-file')
+    parser.add_argument('--status-socket')
+    parser.add_argument('--log-file')
+    parser.add_argument('--max-backoff', type=float, default=MAX_BACKOFF)
+    parser.add_argument('command', nargs=argparse.REMAINDER)
+    args = parser.parse_args(argv)
+    command = args.command
+    if command and command[0] == '--':
+        command = command[1:]
+    if not command:
+        parser.error('the command to supervise is required')
+    if args.log_file and not os.path.isdir(os.path.dirname(args.log_file)):
+        os.makedirs(os.path.dirname(args.log_file))
+    logging.basicConfig(
+        filename=args.log_file,
+        level=logging.INFO,
+        format='%(asctime)s [%(process)d] %(levelname)s: %(message)s')
+
+    supervisor = Supervisor(command, pid_file=args.pid_file,
+                            status_socket=args.status_socket,
+                            max_backoff=args.max_backoff)
+    signal.signal(signal.SIGTERM, supervisor.stop)
+    signal.signal(signal.SIGINT, supervisor.stop)
+    supervisor.run()
+
+
+if __name__ == '__main__':
+    main()
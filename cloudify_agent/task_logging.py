@@ -0,0 +1,136 @@
+########
+# Copyright (c) 2024 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+############
+
+import json
+import logging
+import os
+import random
+
+# 'text' (the default) or 'json': one json object per line, for every
+# log record of the worker
+LOG_FORMAT_ENV = 'AGENT_LOG_FORMAT'
+# the fraction of the successful tasks for which the start and the finish
+# are logged. Failed tasks are always logged.
+TASK_LOG_SAMPLE_RATE_ENV = 'AGENT_LOG_TASK_SAMPLE_RATE'
+
+TEXT_FORMAT = 'text'
+JSON_FORMAT = 'json'
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats log records as single-line json objects.
+
+    Records that describe a task (see `TaskLogger`) also contain all the
+    task fields, so that they can be easily filtered and aggregated.
+    """
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        task = getattr(record, 'task', None)
+        if task:
+            data.update(task)
+        if record.exc_info:
+            data['traceback'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+def use_json_format(logger=None):
+    """Format the records of all the handlers of `logger` as json.
+
+    :param logger: the logger whose handlers to change, the root logger
+                   by default.
+    """
+    logger = logger or logging.getLogger()
+    formatter = JSONFormatter()
+    for handler in logger.handlers:
+        handler.setFormatter(formatter)
+
+
+def rusage_fields(rusage):
+    """The interesting parts of a resource.struct_rusage, as a dict."""
+    if rusage is None:
+        return None
+    return {
+        'utime': rusage.ru_utime,
+        'stime': rusage.ru_stime,
+        'maxrss': rusage.ru_maxrss,
+        'majflt': rusage.ru_majflt,
+        'nvcsw': rusage.ru_nvcsw,
+        'nivcsw': rusage.ru_nivcsw,
+    }
+
+
+class TaskLogger(object):
+    """Logs the start and the finish of tasks, in the text or json format.
+
+    In the text format, the human readable message is logged. In the json
+    format, the message is only the event name, and the task fields are
+    logged along: execution_id, task, deployment, duration, rc, rusage...
+
+    The message arguments and the fields are only formatted when
+    the record is actually emitted.
+    """
+
+    def __init__(self, logger, log_format=TEXT_FORMAT, sample_rate=1.0):
+        self.logger = logger
+        self.json_format = log_format == JSON_FORMAT
+        self.sample_rate = sample_rate
+
+    @classmethod
+    def from_env(cls, logger, environ=None):
+        environ = os.environ if environ is None else environ
+        log_format = environ.get(LOG_FORMAT_ENV) or TEXT_FORMAT
+        if log_format not in (TEXT_FORMAT, JSON_FORMAT):
+            logger.warning('Unknown log format: %s, using %s',
+                           log_format, TEXT_FORMAT)
+            log_format = TEXT_FORMAT
+        try:
+            sample_rate = float(environ.get(TASK_LOG_SAMPLE_RATE_ENV) or 1)
+        except ValueError:
+            logger.warning('Invalid task log sample rate: %s',
+                           environ.get(TASK_LOG_SAMPLE_RATE_ENV))
+            sample_rate = 1.0
+        return cls(logger, log_format=log_format, sample_rate=sample_rate)
+
+    def sample(self):
+        """Decide whether to log a task.
+
+        This is decided once for every task, so that either both its start
+        and finish are logged, or none of them.
+        """
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def log(self, event, fields, message, *args, **kwargs):
+        """Log a task event.
+
+        :param event: the event name, used as the message in json
+        :param fields: the task fields, only used in json
+        :param message: the message format string, only used in text
+        :param args: the message arguments
+        :param level: the log level, INFO by default
+        """
+        level = kwargs.pop('level', logging.INFO)
+        if not self.logger.isEnabledFor(level):
+            return
+        if self.json_format:
+            self.logger.log(level, '%s', event, extra={'task': fields})
+        else:
+            self.logger.log(level, message, *args)
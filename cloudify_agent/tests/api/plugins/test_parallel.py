@@ -0,0 +1,107 @@
+import threading
+import time
+
+import pytest
+from unittest import mock
+
+from cloudify import manager, plugin_installer
+from cloudify.exceptions import PluginInstallationError
+from cloudify.state import ctx, current_ctx
+
+from cloudify_agent.api.plugins import parallel
+
+
+def _plugins(*names):
+    return [{'name': name, 'package_name': name} for name in names]
+
+
+def test_installer_not_patched():
+    assert not hasattr(parallel, 'install_lock')
+    assert isinstance(plugin_installer.PLUGIN_INSTALL_LOCK,
+                      type(threading.Lock()))
+
+
+def _track_overlap(running, overlapped):
+    def _install(plugin):
+        running.append(plugin['name'])
+        overlapped.append(len(running) > 1)
+        time.sleep(0.05)
+        running.remove(plugin['name'])
+    return _install
+
+
+def test_different_plugins_in_parallel():
+    overlapped = []
+    results = parallel.run_for_plugins(
+        _plugins('p1', 'p2', 'p3'), _track_overlap([], overlapped),
+        'Installing', mock.Mock(), max_parallel=3)
+    assert [r.name for r in results] == ['p1', 'p2', 'p3']
+    assert all(r.error is None for r in results)
+    assert any(overlapped)
+
+
+def test_same_plugin_serialized():
+    overlapped = []
+    plugins = [{'name': 'p1'}, {'name': 'p1', 'package_name': 'p1'},
+               {'name': 'other', 'package_name': 'p1'}]
+    with current_ctx.push(mock.Mock(tenant_name='tenant1')):
+        results = parallel.run_for_plugins(
+            plugins, _track_overlap([], overlapped), 'Installing',
+            mock.Mock(), max_parallel=3, key=parallel.install_key)
+    assert all(r.error is None for r in results)
+    assert overlapped == [False] * 3
+
+
+def test_install_key_without_lookup():
+    with current_ctx.push(mock.Mock(tenant_name='tenant1')), \
+            mock.patch.object(plugin_installer, 'get_managed_plugin') as get, \
+            mock.patch.object(manager, 'get_rest_client') as client:
+        assert parallel.install_key(
+            {'name': 'x', 'package_name': 'p1', 'package_version': '2'}) \
+            == ('tenant1', 'p1', '2')
+        assert parallel.install_key({'name': 'p1'}) == \
+            ('tenant1', 'p1', None)
+    get.assert_not_called()
+    client.assert_not_called()
+
+
+def test_uninstall_dir_same_as_installer(tmp_path, monkeypatch):
+    monkeypatch.setenv('CFY_PLUGINS_ROOT', str(tmp_path))
+    with current_ctx.push(mock.Mock(tenant_name='tenant1')):
+        assert parallel.uninstall_dir(
+            {'name': 'x', 'package_name': 'p1', 'package_version': '2'}
+        ) == str(tmp_path / 'plugins' / 'tenant1' / 'p1' / '2')
+        assert parallel.uninstall_dir(
+            {'name': 'p1', 'package_version': '2'}, 'd1'
+        ) == str(tmp_path / 'source_plugins' / 'tenant1' / 'd1' / 'p1' / '2')
+
+
+def test_context_in_threads():
+    seen = []
+    with current_ctx.push(mock.Mock(tenant_name='tenant1')):
+        parallel.run_for_plugins(
+            _plugins('p1', 'p2'), lambda p: seen.append(ctx.tenant_name),
+            'Installing', mock.Mock(), max_parallel=2)
+    assert seen == ['tenant1', 'tenant1']
+
+
+def test_errors_aggregated():
+    def _install(plugin):
+        if plugin['name'] != 'ok':
+            raise RuntimeError('broken ' + plugin['name'])
+
+    results = parallel.run_for_plugins(
+        _plugins('bad1', 'ok', 'bad2'), _install, 'Installing', mock.Mock())
+    assert [r.error is None for r in results] == [False, True, False]
+    with pytest.raises(PluginInstallationError) as e:
+        parallel.raise_for_errors(results, 'installing')
+    assert 'Failed installing 2 of 3 plugins' in str(e.value)
+    assert 'broken bad1' in str(e.value)
+
+    with pytest.raises(RuntimeError):
+        parallel.raise_for_errors(results[:2], 'installing')
+    parallel.raise_for_errors(results[1:2], 'installing')
+
+
+def test_installer_rest_client_not_patched():
+    assert plugin_installer.get_rest_client is manager.get_rest_client
@@ -2,7 +2,9 @@ import getpass
 import os
 
 import pytest
+from unittest import mock
 
+from cloudify_agent import readiness
 from cloudify_agent.api.pm.base import Daemon
 from cloudify_agent.api import exceptions
 
@@ -67,3 +69,65 @@ def test_configure(agent_ssl_cert):
 
 def test_delete(agent_ssl_cert):
     pytest.raises(NotImplementedError, get_daemon(agent_ssl_cert).delete)
+
+
+@pytest.mark.only_posix
+def test_start_waits_for_ready_message(agent_ssl_cert,
+                                       get_storage_directory):
+    os.makedirs(get_storage_directory)
+    daemon = get_daemon(agent_ssl_cert)
+    ready_path = readiness.ready_socket_path(
+        get_storage_directory, daemon.name)
+    daemon.start_command = lambda: 'start'
+    daemon._runner = mock.Mock()
+    daemon._runner.run.side_effect = \
+        lambda command: readiness.notify_ready(ready_path)
+    with mock.patch.object(daemon, '_get_client') as get_client:
+        daemon.start(interval=5, timeout=10)
+    # the worker said it's ready, so it didn't need to be pinged
+    get_client.assert_not_called()
+    assert not os.path.exists(ready_path)
+
+
+def test_start_falls_back_to_ping(agent_ssl_cert, get_storage_directory):
+    os.makedirs(get_storage_directory)
+    daemon = get_daemon(agent_ssl_cert)
+    daemon.start_command = lambda: 'start'
+    daemon._runner = mock.Mock()
+    with mock.patch.object(daemon, '_get_client') as get_client, \
+            mock.patch.object(daemon, '_is_daemon_running',
+                              side_effect=[False, False, True]) as running:
+        daemon.start(interval=0.01, timeout=10)
+    assert running.call_count == 3
+    # all the checks use a single connection
+    get_client.assert_called_once_with()
+    get_client.return_value.close.assert_called_once_with()
+
+
+def test_stop_waits_for_worker_process(agent_ssl_cert):
+    daemon = get_daemon(agent_ssl_cert)
+    daemon.stop_command = lambda: 'stop'
+    daemon._runner = mock.Mock()
+    with mock.patch.object(daemon, '_get_worker_pid', return_value=1234), \
+            mock.patch.object(daemon, 'status', return_value=False) \
+            as status, \
+            mock.patch('cloudify_agent.api.pm.process.wait_for_exit',
+                       return_value=True) as wait:
+        daemon.stop(interval=1, timeout=10)
+    wait.assert_called_once_with(1234, 10, max_interval=1)
+    # the status is only queried to confirm that the daemon is down
+    assert status.call_count == 1
+
+
+def test_stop_unknown_pid(agent_ssl_cert):
+    daemon = get_daemon(agent_ssl_cert)
+    daemon.stop_command = lambda: 'stop'
+    daemon._runner = mock.Mock()
+    with mock.patch.object(daemon, '_get_worker_pid', return_value=None), \
+            mock.patch.object(daemon, 'status',
+                              side_effect=[True, True, False]) as status, \
+            mock.patch('cloudify_agent.api.pm.process.wait_for_exit') \
+            as wait:
+        daemon.stop(interval=0.01, timeout=10)
+    wait.assert_not_called()
+    assert status.call_count == 3
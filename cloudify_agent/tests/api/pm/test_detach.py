@@ -1,6 +1,7 @@
 import os
 
 import pytest
+from unittest import mock
 
 from cloudify_agent.tests.daemon import (
     wait_for_daemon_alive,
@@ -19,6 +20,35 @@ def test_configure(detach_daemon):
     assert os.path.exists(daemon.config_path)
 
 
+@pytest.mark.only_posix
+def test_configure_supervised(detach_daemon):
+    daemon = detach_daemon.create_daemon(supervise=True)
+    daemon.create()
+    daemon.configure()
+    with open(daemon.script_path) as f:
+        script = f.read()
+    assert '-m cloudify_agent.supervisor' in script
+    assert daemon.status_socket in script
+
+    with open(daemon.pid_file, 'w') as f:
+        f.write('1234')
+    # the supervisor must get to stop the worker
+    assert daemon.stop_command() == 'kill 1234'
+
+
+@pytest.mark.only_posix
+def test_status_supervised(detach_daemon):
+    daemon = detach_daemon.create_daemon(supervise=True)
+    with mock.patch('cloudify_agent.supervisor.query_status',
+                    return_value={'running': True}) as query_status, \
+            mock.patch.object(daemon, '_runner') as runner:
+        assert daemon.status()
+        query_status.return_value = {'running': False}
+        assert not daemon.status()
+    query_status.assert_called_with(daemon.status_socket)
+    runner.run.assert_not_called()
+
+
 @pytest.mark.only_rabbit
 @pytest.mark.only_posix
 def test_delete(detach_daemon):
@@ -0,0 +1,67 @@
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+from unittest import mock
+
+from cloudify_agent.api.pm import process
+
+
+def _short_lived_process():
+    proc = subprocess.Popen(
+        [sys.executable, '-c', 'import time; time.sleep(0.2)'])
+    # reap it as soon as it exits, same as its parent would
+    threading.Thread(target=proc.wait).start()
+    return proc
+
+
+@pytest.mark.only_posix
+def test_wait_for_exit():
+    proc = _short_lived_process()
+    assert process.wait_for_exit(proc.pid, timeout=10)
+
+
+@pytest.mark.only_posix
+def test_wait_for_exit_polling():
+    proc = _short_lived_process()
+    with mock.patch.object(os, 'pidfd_open', side_effect=OSError,
+                           create=True):
+        assert process.wait_for_exit(proc.pid, timeout=10, max_interval=0.1)
+
+
+@pytest.mark.only_posix
+def test_wait_for_exit_timeout():
+    assert not process.wait_for_exit(os.getpid(), timeout=0.05)
+    with mock.patch.object(os, 'pidfd_open', side_effect=OSError,
+                           create=True):
+        assert not process.wait_for_exit(os.getpid(), timeout=0.05)
+
+
+def test_read_pid_file(tmp_path):
+    pid_file = tmp_path / 'agent.pid'
+    assert process.read_pid_file(str(pid_file)) is None
+    pid_file.write_text('1234\n')
+    assert process.read_pid_file(str(pid_file)) == 1234
+    pid_file.write_text('')
+    assert process.read_pid_file(str(pid_file)) is None
+
+
+@pytest.mark.only_posix
+def test_is_worker_process():
+    other = subprocess.Popen(
+        [sys.executable, '-c', 'import time; time.sleep(10)'])
+    worker = subprocess.Popen(
+        [sys.executable, '-c', 'import time; time.sleep(10)',
+         'cloudify_agent.worker'])
+    try:
+        assert process.is_worker_process(worker.pid)
+        if os.path.exists('/proc'):
+            # eg. the pid from a stale pid file was reused
+            assert not process.is_worker_process(other.pid)
+    finally:
+        for proc in (other, worker):
+            proc.kill()
+            proc.wait()
+    assert not process.is_worker_process(worker.pid)
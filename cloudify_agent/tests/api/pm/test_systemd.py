@@ -0,0 +1,72 @@
+import os
+import subprocess
+
+import pytest
+from unittest import mock
+
+from cloudify_agent.api.pm.systemd import SystemDDaemon
+
+
+def _daemon(agent_ssl_cert, **params):
+    return SystemDDaemon(
+        name='agent1',
+        queue='agent1',
+        broker_ip='127.0.0.1',
+        local_rest_cert_file=agent_ssl_cert.local_cert_path(),
+        broker_ssl_cert_path=agent_ssl_cert.local_cert_path(),
+        **params)
+
+
+def _rendered_script(daemon):
+    with open(daemon._get_rendered_script()) as f:
+        return f.read()
+
+
+def test_notify_and_watchdog(agent_ssl_cert):
+    script = _rendered_script(_daemon(agent_ssl_cert))
+    assert 'Type=notify\n' in script
+    assert 'WatchdogSec=60\n' in script
+
+
+def test_watchdog_disabled(agent_ssl_cert):
+    script = _rendered_script(_daemon(agent_ssl_cert, watchdog_timeout=0))
+    assert 'Type=notify\n' in script
+    assert 'WatchdogSec' not in script
+
+
+@pytest.mark.only_posix
+def test_configure_installs_files_once(agent_ssl_cert, tmp_path):
+    daemon = _daemon(agent_ssl_cert)
+    daemon.script_path = str(tmp_path / 'system' / 'agent1.service')
+    daemon.config_path = str(tmp_path / 'sysconfig' / 'agent1')
+    commands = []
+
+    def _run(command):
+        commands.append(command)
+        if command.startswith('sudo sh '):
+            subprocess.check_call(command[len('sudo '):], shell=True)
+
+    daemon._runner = mock.Mock()
+    daemon._runner.run.side_effect = _run
+
+    assert daemon.configure()
+    # both files are installed with one sudo call
+    assert [c for c in commands if c.startswith('sudo sh ')] == \
+        [commands[0]]
+    assert 'Type=notify' in (tmp_path / 'system' / 'agent1.service') \
+        .read_text()
+    assert os.stat(daemon.config_path).st_mode & 0o777 == 0o600
+    assert not os.path.exists(daemon.script_path + '.cfy-tmp')
+
+    # nothing changed: no sudo, and no daemon-reload
+    commands[:] = []
+    assert not daemon.configure()
+    assert commands == ['sudo systemctl enable {0}'.format(
+        daemon.service_name)]
+
+    daemon.max_workers = 10
+    commands[:] = []
+    assert daemon.configure()
+    assert '--max-workers 10' in (tmp_path / 'system' / 'agent1.service') \
+        .read_text()
+    assert 'sudo systemctl daemon-reload' in commands
@@ -1,6 +1,8 @@
+import json
 import os
 import pytest
 import shutil
+from unittest import mock
 
 from cloudify_agent.api import exceptions
 from cloudify_agent.api import utils
@@ -97,3 +99,43 @@ def get_daemon_params(name, ssl_cert):
         'local_rest_cert_file': ssl_cert.local_cert_path(),
         'broker_ssl_cert_path': ssl_cert.local_cert_path(),
     }
+
+
+def test_list_daemons(daemon_factory, agent_ssl_cert):
+    for name in ('daemon-b', 'daemon-a'):
+        params = get_daemon_params(name, agent_ssl_cert)
+        daemon_factory.save(daemon_factory.new(**params))
+
+    summaries = daemon_factory.list_daemons()
+    assert [s.name for s in summaries] == ['daemon-a', 'daemon-b']
+    assert summaries[0].process_management == 'init.d'
+    assert summaries[0].queue == 'queue'
+
+    # the index is used, and the daemon files are not read again
+    with mock.patch.object(utils, 'json_load') as json_load:
+        assert daemon_factory.list_daemons() == summaries
+    json_load.assert_not_called()
+
+    daemon_factory.delete('daemon-a')
+    assert [s.name for s in daemon_factory.list_daemons()] == ['daemon-b']
+
+
+def test_list_daemons_stale_index(daemon_factory, agent_ssl_cert):
+    daemon = daemon_factory.new(
+        **get_daemon_params('daemon-a', agent_ssl_cert))
+    daemon_factory.save(daemon)
+    daemon_factory.list_daemons()
+
+    # changed by something that didn't update the index
+    daemon_path = os.path.join(daemon_factory.storage, 'daemon-a.json')
+    with open(daemon_path) as f:
+        daemon_as_json = json.load(f)
+    daemon_as_json['queue'] = 'other-queue'
+    with open(daemon_path, 'w') as f:
+        json.dump(daemon_as_json, f)
+    with open(os.path.join(daemon_factory.storage, 'broken.json'), 'w') as f:
+        f.write('{')
+
+    summaries = daemon_factory.list_daemons()
+    assert [(s.name, s.queue) for s in summaries] == \
+        [('daemon-a', 'other-queue')]
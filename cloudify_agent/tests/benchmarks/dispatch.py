@@ -0,0 +1,464 @@
+"""Operation dispatch throughput benchmark.
+
+Drives `CloudifyOperationConsumer` with synthetic operations, delivered
+through an in-process stand-in for the AMQP broker, with the REST calls
+that the worker makes for every operation replaced by a stub. The
+operations are really dispatched: each one runs `cloudify.dispatch` in a
+subprocess, using the python of a plugin virtualenv.
+
+No broker, manager or network access is needed, so this can be run
+anywhere the agent is installed:
+
+    python -m cloudify_agent.tests.benchmarks.dispatch \\
+        --tasks 200 --max-workers 1,5,10
+
+For every --max-workers level, this reports the throughput, the
+publish-to-response latency, and the resource usage of the worker.
+Use --json to store the results, and --baseline to compare a run
+against stored results: the exit code is non-zero if the throughput or
+the p99 latency regressed by more than --tolerance.
+"""
+
+import argparse
+import collections
+import importlib.metadata
+import itertools
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from unittest import mock
+
+import pika
+
+from cloudify import constants
+from cloudify.context import CloudifyContext
+from cloudify.utils import get_python_path
+
+from cloudify_agent import journal, worker
+
+QUEUE = 'benchmark'
+TASK_NAMES = {
+    'noop': 'cloudify_agent.tests.benchmarks.tasks.noop',
+    'sleep': 'cloudify_agent.tests.benchmarks.tasks.sleep',
+}
+
+_Method = collections.namedtuple('_Method', ['delivery_tag'])
+
+
+class FakeChannel(object):
+    """A pika channel that only records the consumers registered on it."""
+
+    def __init__(self):
+        self.consumers = {}
+
+    def basic_consume(self, queue, on_message_callback):
+        self.consumers[queue] = on_message_callback
+
+    def __getattr__(self, name):
+        # qos, declares, binds: nothing to do without a broker
+        return lambda *args, **kwargs: None
+
+
+class FakeBrokerConnection(object):
+    """Stands in for AMQPConnection, without a broker.
+
+    Messages published to a queue are passed straight to the consumer
+    registered on it, the same way pika would call it from the connection
+    thread. The responses sent by the consumer are collected, and the
+    time from publishing a task to receiving its response is recorded.
+    """
+
+    def __init__(self):
+        self.channel = FakeChannel()
+        self.latencies = []
+        self.responses = {}
+        self.acks = 0
+        self._sent = {}
+        self._lock = threading.Lock()
+        self._done = threading.Condition(self._lock)
+        self._delivery_tags = itertools.count(1)
+
+    def add_handler(self, handler):
+        handler.register(self, self.channel)
+
+    def send_task(self, routing_key, task, correlation_id):
+        callback = self.channel.consumers[
+            '{0}_{1}'.format(QUEUE, routing_key)]
+        properties = pika.BasicProperties(
+            reply_to='{0}_response_{1}'.format(QUEUE, correlation_id),
+            correlation_id=correlation_id)
+        with self._lock:
+            self._sent[correlation_id] = time.monotonic()
+        callback(self.channel, _Method(next(self._delivery_tags)),
+                 properties, json.dumps(task).encode('utf-8'))
+
+    def wait_for_responses(self, count, timeout):
+        with self._done:
+            return self._done.wait_for(
+                lambda: len(self.responses) >= count, timeout)
+
+    def ack(self, channel, delivery_tag, wait=True, timeout=None):
+        with self._lock:
+            self.acks += 1
+
+    def publish(self, message, wait=True, timeout=None):
+        received = time.monotonic()
+        correlation_id = message['properties'].correlation_id
+        with self._done:
+            self.latencies.append(received - self._sent.pop(correlation_id))
+            self.responses[correlation_id] = json.loads(message['body'])
+            self._done.notify_all()
+
+    def channel_method(self, method, channel=None, wait=True,
+                       timeout=None, **kwargs):
+        if method == 'basic_get':
+            # the consumer watchdog found the queue empty
+            return None, None, None
+
+
+class RestStub(object):
+    """Replaces the REST calls the worker makes for every operation.
+
+    Every call takes `latency` seconds, to simulate the manager round trip.
+    """
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.calls = collections.Counter()
+        self._lock = threading.Lock()
+
+    def _call(self, name):
+        with self._lock:
+            self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_execution(self, execution_id=None):
+        self._call('get_execution')
+        return mock.Mock(status='started')
+
+    def get_operation(self):
+        self._call('get_operation')
+        return mock.Mock(state=constants.TASK_SENT)
+
+    def update_operation(self, state):
+        self._call('update_operation')
+
+    @contextmanager
+    def patched(self):
+        # the worker creates a new context for every operation, so the
+        # context methods are replaced on the class
+        with mock.patch.object(CloudifyContext, 'get_execution',
+                               lambda ctx, *a, **kw: self.get_execution(
+                                   *a, **kw)), \
+                mock.patch.object(CloudifyContext, 'get_operation',
+                                  lambda ctx: self.get_operation()), \
+                mock.patch.object(CloudifyContext, 'update_operation',
+                                  lambda ctx, state: self.update_operation(
+                                      state)):
+            yield self
+
+
+class ResourceSampler(object):
+    """Samples the thread count and the RSS of this process in a thread."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.max_threads = 0
+        self.max_rss = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.max_threads = max(self.max_threads, threading.active_count())
+            self.max_rss = max(self.max_rss, current_rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+def current_rss():
+    """The resident set size of this process, in bytes."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):
+        # not linux: only the peak is available
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def syscall_count():
+    """The number of read and write syscalls made by this process.
+
+    Only available on linux, returns None elsewhere.
+    """
+    try:
+        with open('/proc/self/io') as f:
+            io = dict(line.split(': ') for line in f.read().splitlines())
+    except (IOError, OSError):
+        return None
+    return int(io['syscr']) + int(io['syscw'])
+
+
+def make_plugin_venv(path):
+    """Create a plugin virtualenv, that reuses the installed packages.
+
+    This is done offline: the venv sees the packages of the current
+    interpreter, including cloudify-common and the benchmark tasks.
+    """
+    subprocess.check_call([
+        sys.executable, '-m', 'venv', '--system-site-packages',
+        '--without-pip', path])
+    return path
+
+
+class BenchmarkConsumer(worker.CloudifyOperationConsumer):
+    """Dispatches every operation to the benchmark plugin venv."""
+
+    def __init__(self, *args, **kwargs):
+        self.plugin_dir = kwargs.pop('plugin_dir')
+        super(BenchmarkConsumer, self).__init__(*args, **kwargs)
+
+    def _extract_plugin_dir(self, ctx):
+        return self.plugin_dir
+
+    def _plugin_common_version(self, executable, env):
+        # the plugin venv uses the cloudify-common of the worker. Asking
+        # pkg_resources for it in a subprocess can fail, eg. with a
+        # VersionConflict in a development venv, and then the operation
+        # state updates would be skipped, as for a very old plugin
+        return worker.parse_version(
+            importlib.metadata.version('cloudify-common'))
+
+
+def make_task(task_id, task_name, task_kwargs=None):
+    kwargs = dict(task_kwargs or {})
+    kwargs['__cloudify_context'] = {
+        'type': 'operation',
+        'task_id': task_id,
+        'task_name': task_name,
+        'task_target': QUEUE,
+        'execution_id': 'benchmark-execution',
+        'workflow_id': 'benchmark',
+        'tenant': {'name': 'default_tenant'},
+        'plugin': {'name': 'benchmark-plugin'},
+    }
+    return {'cloudify_task': {'kwargs': kwargs}}
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def run_level(max_workers, tasks, plugin_dir, task_name, task_kwargs=None,
+              rest_latency=0, use_journal=False, timeout=600):
+    """Dispatch `tasks` operations with the given threadpool size.
+
+    :return: a dict of the measured results
+    """
+    workdir = tempfile.mkdtemp(prefix='dispatch-benchmark-')
+    task_journal = None
+    if use_journal:
+        task_journal = journal.TaskJournal(
+            os.path.join(workdir, 'benchmark.journal'))
+    connection = FakeBrokerConnection()
+    consumer = BenchmarkConsumer(
+        QUEUE, max_workers, plugin_dir=plugin_dir, journal=task_journal)
+    connection.add_handler(consumer)
+    rest = RestStub(rest_latency)
+
+    env = {'AGENT_LOG_DIR': workdir}
+    try:
+        # the worker logger is only set up in worker.main()
+        with mock.patch.dict(os.environ, env), rest.patched(), \
+                mock.patch.object(worker, 'logger', create=True,
+                                  new=logging.getLogger(worker.__name__)):
+            # warm up: this also resolves the plugin's cloudify-common
+            # version, which is cached for all the following operations
+            connection.send_task('operation', make_task(
+                'warmup', task_name, task_kwargs), 'warmup')
+            connection.wait_for_responses(1, timeout)
+            connection.latencies = []
+            connection.responses = {}
+            rest.calls.clear()
+
+            syscalls_before = syscall_count()
+            usage_before = resource.getrusage(resource.RUSAGE_SELF)
+            with ResourceSampler() as sampler:
+                started = time.monotonic()
+                for i in range(tasks):
+                    task_id = 'task-{0}'.format(i)
+                    connection.send_task('operation', make_task(
+                        task_id, task_name, task_kwargs), task_id)
+                finished = connection.wait_for_responses(tasks, timeout)
+                elapsed = time.monotonic() - started
+            usage_after = resource.getrusage(resource.RUSAGE_SELF)
+            syscalls_after = syscall_count()
+    finally:
+        if task_journal is not None:
+            task_journal.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if not finished:
+        raise RuntimeError('Only {0} of {1} operations finished in {2}s'
+                           .format(len(connection.responses), tasks, timeout))
+    failed = [r for r in connection.responses.values() if not r.get('ok')]
+    if failed:
+        raise RuntimeError('{0} operations failed, eg.: {1}'
+                           .format(len(failed), failed[0]))
+
+    syscalls = None
+    if syscalls_before is not None:
+        syscalls = syscalls_after - syscalls_before
+    return {
+        'max_workers': max_workers,
+        'tasks': tasks,
+        'elapsed': elapsed,
+        'tasks_per_sec': tasks / elapsed,
+        'latency_p50': percentile(connection.latencies, 50),
+        'latency_p99': percentile(connection.latencies, 99),
+        'max_threads': sampler.max_threads,
+        'max_rss': sampler.max_rss,
+        'syscalls': syscalls,
+        'context_switches': (
+            (usage_after.ru_nvcsw - usage_before.ru_nvcsw)
+            + (usage_after.ru_nivcsw - usage_before.ru_nivcsw)),
+        'rest_calls': sum(rest.calls.values()),
+    }
+
+
+def format_results(results):
+    header = ('workers', 'tasks/s', 'p50 [ms]', 'p99 [ms]', 'threads',
+              'rss [MB]', 'syscalls', 'ctx sw')
+    rows = [header]
+    for r in results:
+        rows.append((
+            str(r['max_workers']),
+            '{0:.1f}'.format(r['tasks_per_sec']),
+            '{0:.1f}'.format(r['latency_p50'] * 1000),
+            '{0:.1f}'.format(r['latency_p99'] * 1000),
+            str(r['max_threads']),
+            '{0:.1f}'.format(r['max_rss'] / 1024.0 / 1024),
+            '-' if r['syscalls'] is None else str(r['syscalls']),
+            str(r['context_switches']),
+        ))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    return '\n'.join(
+        '  '.join(cell.rjust(width) for cell, width in zip(row, widths))
+        for row in rows)
+
+
+def find_regressions(results, baseline, tolerance):
+    """Compare the results to the baseline results, at each level.
+
+    :return: a list of descriptions of the regressions found
+    """
+    baseline_by_level = {b['max_workers']: b for b in baseline}
+    regressions = []
+    for r in results:
+        base = baseline_by_level.get(r['max_workers'])
+        if base is None:
+            continue
+        if r['tasks_per_sec'] < base['tasks_per_sec'] * (1 - tolerance):
+            regressions.append(
+                'max_workers={0}: throughput {1:.1f} tasks/s, baseline '
+                '{2:.1f} tasks/s'.format(r['max_workers'],
+                                         r['tasks_per_sec'],
+                                         base['tasks_per_sec']))
+        if r['latency_p99'] > base['latency_p99'] * (1 + tolerance):
+            regressions.append(
+                'max_workers={0}: p99 latency {1:.1f}ms, baseline {2:.1f}ms'
+                .format(r['max_workers'], r['latency_p99'] * 1000,
+                        base['latency_p99'] * 1000))
+    return regressions
+
+
+def _parse_levels(value):
+    return [int(level) for level in value.split(',')]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--tasks', type=int, default=100,
+                        help='operations to dispatch at each level')
+    parser.add_argument('--max-workers', type=_parse_levels,
+                        default=[1, 5, worker.DEFAULT_MAX_WORKERS],
+                        help='comma-separated threadpool sizes to measure')
+    parser.add_argument('--task', choices=sorted(TASK_NAMES), default='noop')
+    parser.add_argument('--task-duration', type=float, default=0.1,
+                        help='how long the "sleep" task takes, in seconds')
+    parser.add_argument('--rest-latency', type=float, default=0,
+                        help='simulated REST round trip, in seconds')
+    parser.add_argument('--journal', action='store_true',
+                        help='record the operations in a task journal')
+    parser.add_argument('--plugin-venv',
+                        help='plugin virtualenv to dispatch the operations '
+                             'in. Default: create one for this run')
+    parser.add_argument('--json', help='store the results in this file')
+    parser.add_argument('--baseline',
+                        help='compare the results to the results stored '
+                             'in this file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed regression against the baseline, as '
+                             'a fraction')
+    args = parser.parse_args(argv)
+
+    task_kwargs = {}
+    if args.task == 'sleep':
+        task_kwargs['duration'] = args.task_duration
+
+    venv_dir = None
+    plugin_dir = args.plugin_venv
+    if not plugin_dir:
+        venv_dir = tempfile.mkdtemp(prefix='dispatch-benchmark-venv-')
+        plugin_dir = make_plugin_venv(venv_dir)
+    print('Plugin venv: {0}'.format(get_python_path(plugin_dir)))
+
+    results = []
+    try:
+        for level in args.max_workers:
+            results.append(run_level(
+                level, args.tasks, plugin_dir, TASK_NAMES[args.task],
+                task_kwargs=task_kwargs,
+                rest_latency=args.rest_latency,
+                use_journal=args.journal))
+    finally:
+        if venv_dir:
+            shutil.rmtree(venv_dir, ignore_errors=True)
+
+    print(format_results(results))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(results, baseline, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION: {0}'.format(regression))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,161 @@
+"""Import time of the cfy-agent CLI and of the worker.
+
+Every cfy-agent invocation, and every worker (re)start, pays for the
+import of its module. This runs a fresh interpreter with
+`python -X importtime` for each module, and reports the total import
+time, and the slowest imports:
+
+    python -m cloudify_agent.tests.benchmarks.importtime --top 10
+
+Absolute times depend on the machine, so the budgets are relative: the
+import time of a module must stay under a multiple of the import time of
+a fixed set of standard library modules, measured the same way. The exit
+code is non-zero if a module is over its budget, or if it imports any of
+the modules that it is expected to import lazily.
+"""
+
+import argparse
+import collections
+import subprocess
+import sys
+
+# slow to import, and only needed by some of the commands/tasks
+_LAZY = ['pkg_resources', 'jinja2', 'fabric', 'winrm',
+         'cloudify.plugin_installer', 'cloudify.workflows',
+         'cloudify_agent.installer', 'cloudify_agent.operations']
+
+# what the budgets are relative to: these take about as long to import as
+# the CLI does, and don't depend on what else is installed
+REFERENCE_MODULES = ['asyncio', 'decimal', 'email.parser', 'http.client',
+                     'json', 'logging', 'subprocess']
+
+# module name: (budget, as a multiple of the import time of the reference
+# modules, modules that must not be imported)
+# At the time of writing, the CLI takes about 2.3 times as long as the
+# reference, and the worker about 3 times: the budgets leave room for
+# noise, and catch a new eager import of something large.
+BUDGETS = {
+    'cloudify_agent.shell.main': (
+        5, _LAZY + ['cloudify_rest_client', 'pika']),
+    'cloudify_agent.worker': (6, _LAZY),
+}
+
+ImportTime = collections.namedtuple(
+    'ImportTime', ['module', 'self_us', 'cumulative_us'])
+
+
+def measure(module, python=sys.executable):
+    """Import `module` in a new interpreter.
+
+    :return: an ImportTime for every module that was imported, in the
+             order they finished importing
+    """
+    proc = subprocess.run(
+        [python, '-X', 'importtime', '-c', 'import {0}'.format(module)],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    if proc.returncode != 0:
+        raise RuntimeError('Importing {0} failed:\n{1}'
+                           .format(module, proc.stderr))
+    times = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        self_us, cumulative_us, name = \
+            line[len('import time:'):].split('|')
+        if not self_us.strip().isdigit():
+            # the header line
+            continue
+        times.append(ImportTime(name.strip(), int(self_us),
+                                int(cumulative_us)))
+    return times
+
+
+def reference_time(times=None):
+    """The import time of the reference modules, in seconds.
+
+    :param times: the measured import times of the reference modules, if
+                  already measured
+    """
+    if times is None:
+        times = measure(', '.join(REFERENCE_MODULES))
+    # those that the interpreter imported at startup already cost nothing
+    return sum(t.cumulative_us for t in times
+               if t.module in REFERENCE_MODULES) / 1e6
+
+
+def total_time(times, module):
+    """The cumulative import time of `module`, in seconds."""
+    for t in times:
+        if t.module == module:
+            return t.cumulative_us / 1e6
+    raise ValueError('{0} was not imported'.format(module))
+
+
+def eager_imports(times, lazy_modules):
+    """The modules in `lazy_modules` (or their submodules) were imported."""
+    imported = []
+    for t in times:
+        for lazy in lazy_modules:
+            if t.module == lazy or t.module.startswith(lazy + '.'):
+                imported.append(t.module)
+                break
+    return imported
+
+
+def check_budget(module, times=None, reference=None, repeat=3):
+    """Check the import of `module` against its budget.
+
+    The module and the reference are each measured `repeat` times, and
+    the fastest of the runs is used, to cancel out some of the noise.
+
+    :param times: the measured import times, if already measured
+    :param reference: the import time of the reference, if already measured
+    :return: a list of descriptions of the budget violations
+    """
+    budget, lazy_modules = BUDGETS[module]
+    if times is None:
+        runs = [measure(module) for _ in range(repeat)]
+        times = min(runs, key=lambda run: total_time(run, module))
+    if reference is None:
+        reference = min(reference_time() for _ in range(repeat))
+    problems = []
+    total = total_time(times, module)
+    if total > budget * reference:
+        problems.append(
+            '{0}: imported in {1:.3f}s, {2:.1f} times the reference {3:.3f}s,'
+            ' budget is {4} times'.format(
+                module, total, total / reference, reference, budget))
+    for name in eager_imports(times, lazy_modules):
+        problems.append('{0}: imports {1}, which should be imported lazily'
+                        .format(module, name))
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('modules', nargs='*', default=sorted(BUDGETS),
+                        help='modules to measure')
+    parser.add_argument('--top', type=int, default=5,
+                        help='show this many of the slowest imports')
+    args = parser.parse_args(argv)
+
+    reference = reference_time()
+    print('reference: {0:.3f}s'.format(reference))
+    problems = []
+    for module in args.modules:
+        times = measure(module)
+        print('{0}: {1:.3f}s'.format(module, total_time(times, module)))
+        slowest = sorted(times, key=lambda t: t.self_us, reverse=True)
+        for t in slowest[:args.top]:
+            print('    {0:8.1f}ms  {1}'.format(t.self_us / 1000.0, t.module))
+        if module in BUDGETS:
+            problems.extend(check_budget(module, times, reference))
+
+    for problem in problems:
+        print('OVER BUDGET: {0}'.format(problem))
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
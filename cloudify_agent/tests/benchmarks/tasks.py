@@ -0,0 +1,12 @@
+"""Trivial operations, run by the dispatch benchmark in the plugin venv."""
+
+import time
+
+
+def noop(**_):
+    return 'ok'
+
+
+def sleep(duration=0.1, **_):
+    time.sleep(duration)
+    return 'ok'
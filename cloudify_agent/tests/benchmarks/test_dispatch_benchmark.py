@@ -0,0 +1,26 @@
+import json
+import sys
+
+from cloudify_agent.tests.benchmarks import dispatch
+
+
+def test_run_level():
+    result = dispatch.run_level(2, 4, sys.prefix, dispatch.TASK_NAMES['noop'])
+    assert result['tasks'] == 4
+    assert result['tasks_per_sec'] > 0
+    assert result['latency_p50'] <= result['latency_p99']
+    # get_execution, get_operation, and two updates, for every operation
+    assert result['rest_calls'] == 4 * 4
+
+
+def test_baseline_regression(tmp_path):
+    results = tmp_path / 'results.json'
+    argv = ['--tasks', '2', '--max-workers', '1',
+            '--plugin-venv', sys.prefix, '--json', str(results)]
+    assert dispatch.main(argv) == 0
+
+    baseline = json.loads(results.read_text())
+    baseline[0]['tasks_per_sec'] *= 100
+    baseline_file = tmp_path / 'baseline.json'
+    baseline_file.write_text(json.dumps(baseline))
+    assert dispatch.main(argv + ['--baseline', str(baseline_file)]) == 1
@@ -0,0 +1,29 @@
+import pytest
+
+from cloudify_agent.tests.benchmarks import importtime
+
+
+@pytest.mark.parametrize('module', sorted(importtime.BUDGETS))
+def test_import_budget(module):
+    assert importtime.check_budget(module) == []
+
+
+def test_budget_relative_to_reference():
+    times = [importtime.ImportTime('cloudify_agent.worker', 10, 500000)]
+    assert importtime.check_budget(
+        'cloudify_agent.worker', times, reference=0.1) == []
+    problems = importtime.check_budget(
+        'cloudify_agent.worker', times, reference=0.05)
+    assert len(problems) == 1
+    assert '10.0 times the reference' in problems[0]
+
+
+def test_eager_imports():
+    times = [
+        importtime.ImportTime('jinja2.environment', 10, 10),
+        importtime.ImportTime('jinja2', 5, 15),
+        importtime.ImportTime('jinja2x', 5, 5),
+        importtime.ImportTime('click', 5, 5),
+    ]
+    assert importtime.eager_imports(times, ['jinja2']) == \
+        ['jinja2.environment', 'jinja2']
@@ -1,3 +1,5 @@
+import gzip
+import hashlib
 from unittest.mock import Mock, patch
 import pytest
 
@@ -7,11 +9,13 @@ from cloudify_agent.installer import exceptions
 # the pywin32 extensions). The tests wont run anyway because of the decorator,
 # so we can just avoid this import.
 try:
+    from cloudify_agent.installer.runners import fabric_runner
     from cloudify_agent.installer.runners.fabric_runner import FabricRunner
     from cloudify_agent.installer.runners.fabric_runner import (
         FabricCommandExecutionException,
     )
 except ImportError:
+    fabric_runner = None
     FabricRunner = None
     FabricCommandExecutionException = None
 
@@ -92,3 +96,218 @@ def test_exception_message():
             assert e.error == expected_message
         else:
             pytest.fail('FabricCommandExecutionException not raised')
+
+
+@pytest.fixture
+def connection_cache():
+    cache = fabric_runner.ConnectionCache()
+    with patch.object(fabric_runner, 'connection_cache', cache):
+        yield cache
+    cache.clear()
+
+
+def _runner(**kwargs):
+    params = dict(validate_connection=False, user='user', host='host',
+                  password='password')
+    params.update(kwargs)
+    return FabricRunner(**params)
+
+
+@pytest.mark.only_posix
+def test_connection_reused(connection_cache):
+    with patch('cloudify_agent.installer.runners.fabric_runner.Connection') \
+            as conn_factory:
+        conn_factory.return_value.run.return_value = Mock(return_code=0)
+        runner = _runner()
+        runner.run('a command')
+        runner.close()
+        runner = _runner()
+        runner.run('another command')
+        # another user: needs its own connection
+        other = _runner(user='other')
+        other.run('a command')
+    assert conn_factory.call_count == 2
+    assert conn_factory.return_value.open.call_count == 2
+
+
+@pytest.mark.only_posix
+def test_dead_connection_not_reused(connection_cache):
+    with patch('cloudify_agent.installer.runners.fabric_runner.Connection') \
+            as conn_factory:
+        conn_factory.return_value.run.return_value = Mock(return_code=0)
+        runner = _runner()
+        runner.run('a command')
+        runner.close()
+        conn_factory.return_value.transport.is_active.return_value = False
+        _runner().run('a command')
+    assert conn_factory.call_count == 2
+    conn_factory.return_value.close.assert_called_once_with()
+
+
+@pytest.mark.only_posix
+def test_idle_connection_expires(connection_cache):
+    connection = Mock()
+    connection_cache.release('key', connection)
+    assert connection_cache.prune(max_idle=60)
+    assert not connection_cache.prune(max_idle=0)
+    connection.close.assert_called_once_with()
+    new_connection = Mock()
+    assert connection_cache.acquire('key', lambda: new_connection) \
+        is new_connection
+
+
+class _FakeChannel(object):
+    """Hands out the chunks of output one by one, then the exit status"""
+
+    def __init__(self, stdout, stderr, return_code):
+        self._stdout = list(stdout)
+        self._stderr = list(stderr)
+        self._return_code = return_code
+        self.exec_command = Mock()
+        self.sendall = Mock()
+        self.shutdown_write = Mock()
+        self.close = Mock()
+
+    def recv_ready(self):
+        return bool(self._stdout)
+
+    def recv(self, size):
+        return self._stdout.pop(0)
+
+    def recv_stderr_ready(self):
+        return bool(self._stderr)
+
+    def recv_stderr(self, size):
+        return self._stderr.pop(0)
+
+    def exit_status_ready(self):
+        # a return code of None stands for a command that never exits
+        return self._return_code is not None \
+            and not self._stdout and not self._stderr
+
+    def recv_exit_status(self):
+        return self._return_code
+
+
+@pytest.mark.only_posix
+def test_run_streaming(connection_cache):
+    logger = Mock()
+    channel = _FakeChannel([b'line 1\nline', b' 2\n'], [b'warning\n'], 0)
+    with patch('cloudify_agent.installer.runners.fabric_runner.Connection') \
+            as conn_factory:
+        conn_factory.return_value.transport.open_session.return_value = \
+            channel
+        runner = _runner(logger=logger, fabric_env={'forward_agent': False})
+        response = runner.run('install', stream=True)
+    channel.exec_command.assert_called_once_with('install')
+    channel.close.assert_called_once_with()
+    logged = [c[0][1] for c in logger.log.call_args_list]
+    assert logged == ['line 1', 'line 2', 'warning']
+    assert response.std_out == 'line 1\nline 2'
+    conn_factory.return_value.run.assert_not_called()
+
+
+@pytest.mark.only_posix
+def test_run_streaming_failure(connection_cache):
+    channel = _FakeChannel([b'output\n'], [b'error\n'], 3)
+    with patch('cloudify_agent.installer.runners.fabric_runner.Connection') \
+            as conn_factory:
+        conn_factory.return_value.transport.open_session.return_value = \
+            channel
+        runner = _runner(logger=Mock(), fabric_env={'forward_agent': False})
+        with pytest.raises(FabricCommandExecutionException) as e:
+            runner.run('install', stream=True)
+    assert e.value.code == 3
+    assert e.value.error == 'error'
+    assert e.value.output == 'output'
+
+
+@pytest.mark.only_posix
+def test_run_script_timeout(connection_cache, script):
+    channel = _FakeChannel([b'installing\n'], [], None)
+    with patch('cloudify_agent.installer.runners.fabric_runner.Connection') \
+            as conn_factory, \
+            patch.object(fabric_runner, 'STREAM_POLL_INTERVAL', 0.01):
+        conn_factory.return_value.transport.open_session.return_value = \
+            channel
+        conn_factory.return_value.run.return_value = Mock(
+            return_code=0, stdout='/usr/bin/gzip\n')
+        runner = _runner(logger=Mock(), fabric_env={'forward_agent': False})
+        with pytest.raises(fabric_runner.FabricCommandExecutionError,
+                           match='Timed out'):
+            runner.run_script(script, stream=True, timeout=0.1)
+    channel.close.assert_called_once_with()
+
+
+class _Remote(object):
+    """Records the commands sent by _send_file, and their stdin"""
+
+    def __init__(self, errors=()):
+        self.commands = []
+        self.stdin = []
+        self._errors = list(errors)
+
+    def __call__(self, command, stdin=None, **kwargs):
+        self.commands.append(command)
+        self.stdin.append(b''.join(stdin))
+        if self._errors:
+            raise self._errors.pop(0)
+        return Mock(std_out='/tmp/dir/script.sh\n')
+
+
+@pytest.fixture
+def script(tmp_path):
+    path = tmp_path / 'script.sh'
+    path.write_text('#!/bin/sh\necho hello\n')
+    return str(path)
+
+
+@pytest.mark.only_posix
+def test_run_script_single_command(script):
+    runner = _runner()
+    remote = _Remote()
+    with patch.object(runner, '_ensure_connection'), \
+            patch.object(runner, 'run') as run, \
+            patch.object(runner, '_run_streaming', side_effect=remote):
+        run.return_value.std_out = '/usr/bin/gzip\n'
+        runner.run_script(script)
+    assert len(remote.commands) == 1
+    assert 'chmod +x' in remote.commands[0]
+    assert 'rm -rf "$d"' in remote.commands[0]
+    assert gzip.decompress(remote.stdin[0]) == b'#!/bin/sh\necho hello\n'
+
+
+@pytest.mark.only_posix
+def test_put_file_unchanged(script):
+    runner = _runner()
+    digest = hashlib.sha256(b'#!/bin/sh\necho hello\n').hexdigest()
+    remote = _Remote()
+    with patch.object(runner, '_ensure_connection'), \
+            patch.object(runner, 'run') as run, \
+            patch.object(runner, '_run_streaming', side_effect=remote):
+        run.return_value.std_out = '{0}  /opt/script.sh\n'.format(digest)
+        assert runner.put_file(script, '/opt/script.sh') == '/opt/script.sh'
+        assert remote.commands == []
+
+        run.return_value.std_out = ''
+        runner.put_file(script, '/opt/script.sh', sudo=True)
+    assert len(remote.commands) == 1
+    assert 'sudo sh -c' in remote.commands[0]
+
+
+@pytest.mark.only_posix
+def test_put_file_without_gzip(script):
+    runner = _runner()
+    remote = _Remote()
+    with patch.object(runner, '_ensure_connection'), \
+            patch.object(runner, 'run') as run, \
+            patch.object(runner, '_run_streaming', side_effect=remote):
+        run.return_value.std_out = ''
+        assert runner.put_file(script) == '/tmp/dir/script.sh'
+        runner.put_file(script)
+    # gzip is only looked for once, before sending the first file
+    run.assert_called_once_with('command -v gzip || true')
+    assert len(remote.commands) == 2
+    assert all('gzip' not in command for command in remote.commands)
+    assert 'cat >' in remote.commands[0]
+    assert remote.stdin == [b'#!/bin/sh\necho hello\n'] * 2
@@ -0,0 +1,113 @@
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import Mock, patch
+
+import pytest
+
+from cloudify.context import CloudifyContext
+from cloudify.state import current_ctx
+
+from cloudify_agent.installer import exceptions
+from cloudify_agent.installer.runners import local_runner
+
+CONTENT = bytes(range(256)) * 4096
+ETAG = '"v1"'
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # drop the connection after sending this many bytes, once
+    drop_after = None
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == ETAG:
+            self.send_response(304)
+            self.end_headers()
+            return
+        start, end = 0, len(CONTENT) - 1
+        requested = self.headers.get('Range')
+        if requested:
+            first, _, last = requested[len('bytes='):].partition('-')
+            start = int(first)
+            end = int(last) if last else end
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                start, end, len(CONTENT)))
+        else:
+            self.send_response(200)
+        body = CONTENT[start:end + 1]
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', ETAG)
+        self.end_headers()
+        if _Handler.drop_after is not None:
+            body = body[:_Handler.drop_after]
+            _Handler.drop_after = None
+            self.wfile.write(body)
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    _Handler.requests = []
+    _Handler.drop_after = None
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    ctx = CloudifyContext({'rest_token': 'token'})
+    with current_ctx.push(ctx), \
+            patch.object(local_runner, 'DOWNLOAD_RETRY_INTERVAL', 0):
+        yield 'http://127.0.0.1:{0}/agent.tar.gz'.format(
+            httpd.server_address[1])
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _download(url, tmp_path, **kwargs):
+    runner = local_runner.LocalCommandRunner(logger=Mock())
+    path = runner.download(url, str(tmp_path / 'agent.tar.gz'),
+                           chunk_size=64 * 1024, **kwargs)
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_download_checksum(server, tmp_path):
+    digest = hashlib.sha256(CONTENT).hexdigest()
+    assert _download(server, tmp_path, checksum=digest) == CONTENT
+    assert _download(server, tmp_path,
+                     checksum='sha256:{0}'.format(digest)) == CONTENT
+    with pytest.raises(exceptions.DownloadChecksumError):
+        _download(server, tmp_path, checksum='sha256:1234')
+
+
+def test_download_resumed(server, tmp_path):
+    _Handler.drop_after = 150000
+    assert _download(server, tmp_path) == CONTENT
+    assert len(_Handler.requests) == 2
+    # resumed after the last complete chunk
+    assert _Handler.requests[1]['Range'] == \
+        'bytes=131072-{0}'.format(len(CONTENT) - 1)
+    assert _Handler.requests[1]['If-Range'] == ETAG
+
+
+def test_download_parts(server, tmp_path):
+    assert _download(server, tmp_path, parts=4) == CONTENT
+    ranges = sorted(r['Range'] for r in _Handler.requests[1:])
+    assert len(ranges) == 4
+    assert ranges[0] == 'bytes=0-262143'
+
+
+def test_download_cached(server, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    assert _download(server, tmp_path, cache_dir=cache_dir) == CONTENT
+    (tmp_path / 'agent.tar.gz').unlink()
+    assert _download(server, tmp_path, cache_dir=cache_dir) == CONTENT
+    assert _Handler.requests[-1]['If-None-Match'] == ETAG
+    assert len(_Handler.requests) == 2
@@ -0,0 +1,33 @@
+from unittest.mock import Mock
+
+from cloudify_agent.installer.runners.streaming import OutputLogger
+
+
+def _logged(logger):
+    return [c[0][1] for c in logger.log.call_args_list]
+
+
+def test_logs_complete_lines():
+    logger = Mock()
+    output = OutputLogger(logger)
+    output.write(b'first\r\nsec')
+    assert _logged(logger) == ['first']
+    output.write('ond\nthi')
+    assert _logged(logger) == ['first', 'second']
+    output.close()
+    assert _logged(logger) == ['first', 'second', 'thi']
+
+
+def test_multibyte_split_between_writes():
+    logger = Mock()
+    output = OutputLogger(logger)
+    data = 'żółw\n'.encode('utf-8')
+    output.write(data[:2])
+    output.write(data[2:])
+    assert _logged(logger) == ['żółw']
+
+
+def test_tail_is_bounded():
+    output = OutputLogger(Mock(), tail_lines=2)
+    output.write(b'1\n2\n3\n')
+    assert output.tail == '2\n3'
@@ -1,4 +1,7 @@
+import base64
+import hashlib
 import pytest
+from unittest.mock import Mock
 
 from cloudify_agent.installer.runners import winrm_runner
 from cloudify_agent.installer.runners.winrm_runner import split_into_chunks
@@ -84,3 +87,193 @@ def test_line_too_long():
     """Exception raised on line too long."""
     contents = 'a very long line'
     pytest.raises(ValueError, split_into_chunks, contents, max_size=1)
+
+
+@pytest.mark.skipif(winrm_runner.winrm is None, reason='winrm not installed')
+def test_run_streaming():
+    logger = Mock()
+    runner = winrm_runner.WinRMRunner(
+        validate_connection=False,
+        host='test_host',
+        user='test_user',
+        password='test_password',
+        logger=logger)
+    protocol = Mock()
+    protocol.get_command_output_raw.side_effect = [
+        (b'line 1\r\nli', b'', 0, False),
+        (b'ne 2\r\n', b'', 0, True),
+    ]
+    runner.session = Mock(protocol=protocol)
+
+    response = runner.run('install.bat', stream=True)
+
+    protocol.run_command.assert_called_once_with(
+        protocol.open_shell.return_value, 'install.bat')
+    protocol.close_shell.assert_not_called()
+    runner.close()
+    protocol.close_shell.assert_called_once_with(
+        protocol.open_shell.return_value)
+    assert [c[0][1] for c in logger.log.call_args_list] == \
+        ['line 1', 'line 2']
+    assert response.std_out == 'line 1\nline 2'
+    runner.session.run_cmd.assert_not_called()
+
+
+class _Receiver(object):
+    """Decodes what put() sends, and replies like the receiving script"""
+
+    def __init__(self, corrupt=False):
+        self.received = b''
+        self.messages = 0
+        self._corrupt = corrupt
+
+    def send_command_input(self, shell_id, command_id, chunk, end=False):
+        self.messages += 1
+        for line in chunk.split(b'\r\n'):
+            if line:
+                self.received += base64.b64decode(line)
+
+    def get_command_output(self, shell_id, command_id):
+        received = self.received + (b'x' if self._corrupt else b'')
+        return (hashlib.sha256(received).hexdigest().encode('ascii'),
+                b'', 0)
+
+
+def _put_runner(receiver):
+    runner = winrm_runner.WinRMRunner(
+        validate_connection=False,
+        host='test_host',
+        user='test_user',
+        password='test_password',
+        logger=Mock())
+    protocol = Mock()
+    protocol.send_command_input.side_effect = receiver.send_command_input
+    protocol.get_command_output.side_effect = receiver.get_command_output
+    runner.session = Mock(protocol=protocol)
+    return runner
+
+
+def _sent_script(runner):
+    command = runner.session.protocol.run_command.call_args[0][1]
+    return base64.b64decode(command.split()[-1]).decode('utf_16_le')
+
+
+@pytest.mark.skipif(winrm_runner.winrm is None, reason='winrm not installed')
+def test_put_bulk():
+    receiver = _Receiver()
+    runner = _put_runner(receiver)
+    contents = bytes(range(256)) * 1000
+    runner.put(contents, 'C:\\temp\\it\'s.ps1')
+    protocol = runner.session.protocol
+    # a single command, in a single shell
+    protocol.open_shell.assert_called_once_with()
+    protocol.run_command.assert_called_once()
+    script = _sent_script(runner)
+    assert "'C:\\temp\\it''s.ps1'" in script
+    assert receiver.received == contents
+    assert receiver.messages == \
+        -(-len(contents) // winrm_runner.PUT_CHUNK_SIZE)
+    assert protocol.send_command_input.call_args[1] == {'end': True}
+    runner.session.run_ps.assert_not_called()
+
+
+@pytest.mark.skipif(winrm_runner.winrm is None, reason='winrm not installed')
+def test_put_hash_mismatch():
+    runner = _put_runner(_Receiver(corrupt=True))
+    with pytest.raises(winrm_runner.WinRMCommandExecutionError,
+                       match='sha256'):
+        runner.put('contents', 'C:\\temp\\script.ps1')
+
+
+@pytest.mark.skipif(winrm_runner.winrm is None, reason='winrm not installed')
+def test_put_file_line_endings(tmp_path):
+    receiver = _Receiver()
+    runner = _put_runner(receiver)
+    src = tmp_path / 'script.ps1'
+    src.write_text('line 1\nline 2')
+    runner.put_file(str(src), 'C:\\temp\\script.ps1')
+    assert receiver.received == b'\xef\xbb\xbfline 1\r\nline 2\r\n'
+
+
+@pytest.mark.skipif(winrm_runner.winrm is None, reason='winrm not installed')
+def test_put_text_encoding():
+    receiver = _Receiver()
+    runner = _put_runner(receiver)
+    runner.put(u'caf\xe9', 'C:\\temp\\script.ps1')
+    # powershell reads scripts with no BOM in the ANSI code page
+    assert receiver.received == u'caf\xe9'.encode('utf-8-sig')
+    script = _sent_script(runner)
+    assert '$ansi = $false' in script
+
+    receiver.received = b''
+    runner.put(u'set A=caf\xe9', 'C:\\temp\\env.bat')
+    # re-encoded on the remote side, same as Add-Content did
+    assert receiver.received == u'set A=caf\xe9'.encode('utf-8')
+    assert '$ansi = $true' in _sent_script(runner)
+
+
+def _shell_runner():
+    runner = winrm_runner.WinRMRunner(
+        validate_connection=False,
+        host='test_host',
+        user='test_user',
+        password='test_password',
+        tmpdir='C:\\temp',
+        logger=Mock())
+    protocol = Mock()
+    protocol.open_shell.side_effect = ['shell1', 'shell2']
+    protocol.get_command_output.return_value = (b'output', b'', 0)
+    runner.session = Mock(protocol=protocol)
+    return runner
+
+
+@pytest.mark.skipif(winrm_runner.winrm is None, reason='winrm not installed')
+def test_shell_reused():
+    runner = _shell_runner()
+    protocol = runner.session.protocol
+    assert runner.run('echo 1').std_out == 'output'
+    runner.run('echo 2', powershell=True)
+    assert protocol.open_shell.call_count == 1
+    assert [c[0][0] for c in protocol.run_command.call_args_list] == \
+        ['shell1', 'shell1']
+    assert protocol.cleanup_command.call_count == 2
+    runner.session.run_cmd.assert_not_called()
+    runner.session.run_ps.assert_not_called()
+    runner.close()
+    protocol.close_shell.assert_called_once_with('shell1')
+
+
+@pytest.mark.skipif(winrm_runner.winrm is None, reason='winrm not installed')
+def test_shell_reopened():
+    runner = _shell_runner()
+    protocol = runner.session.protocol
+    runner.run('echo 1')
+    protocol.run_command.side_effect = [
+        winrm_runner.WinRMError('shell not found'), 'command2']
+    runner.run('echo 2')
+    assert protocol.open_shell.call_count == 2
+    protocol.close_shell.assert_called_once_with('shell1')
+    assert protocol.run_command.call_args[0][:2] == ('shell2', 'echo 2')
+
+
+@pytest.mark.skipif(winrm_runner.winrm is None, reason='winrm not installed')
+def test_env_file_cached():
+    runner = _shell_runner()
+    runner.put = Mock()
+    runner.run('echo 1', execution_env={'A': '1'})
+    runner.run('echo 2', execution_env={'A': '1'})
+    runner.run('echo 3', execution_env={'A': '2'})
+    assert runner.put.call_count == 2
+    env_files = [c[1]['path'] for c in runner.put.call_args_list]
+    assert all(path.startswith('C:\\temp\\cfy-env-') for path in env_files)
+    commands = [c[0][1] for c in
+                runner.session.protocol.run_command.call_args_list]
+    assert commands[:3] == [
+        'call {0} & echo 1'.format(env_files[0]),
+        'call {0} & echo 2'.format(env_files[0]),
+        'call {0} & echo 3'.format(env_files[1]),
+    ]
+    runner.close()
+    removed = runner.session.protocol.run_command.call_args[0][1]
+    script = base64.b64decode(removed.split()[-1]).decode('utf_16_le')
+    assert all(path in script for path in env_files)
@@ -0,0 +1,93 @@
+import threading
+from unittest.mock import Mock, patch
+
+from cloudify.context import CloudifyContext
+from cloudify.exceptions import CommandExecutionError
+from cloudify.state import current_ctx
+
+from cloudify_agent.installer import batch
+
+
+class _AgentConfig(dict):
+    def set_installation_params(self, runner):
+        self['install_dir'] = '/opt/agent'
+
+
+def _agents(count):
+    return [_AgentConfig(name='agent{0}'.format(i), ip='10.0.0.{0}'.format(i))
+            for i in range(count)]
+
+
+def _install(side_effect=None, max_parallel=2):
+    logger = Mock()
+    runners = []
+
+    def _create_runner(cloudify_agent, validate_connection):
+        assert not validate_connection
+        runner = Mock()
+        runners.append(runner)
+        return runner
+
+    ctx = CloudifyContext({'node_id': 'a'})
+    with patch.object(batch, 'create_runner', side_effect=_create_runner), \
+            patch.object(batch, 'get_installer'), \
+            patch.object(batch, 'install_agent',
+                         side_effect=side_effect) as install_agent, \
+            current_ctx.push(ctx):
+        results = batch.install_agents(
+            _agents(5), max_parallel=max_parallel, host_timeout=60,
+            logger=logger)
+    return results, install_agent, runners, logger
+
+
+def test_install_agents():
+    results, install_agent, runners, logger = _install()
+    assert sorted(r.name for r in results) == \
+        ['agent{0}'.format(i) for i in range(5)]
+    assert all(r.error is None for r in results)
+    assert install_agent.call_count == 5
+    for call in install_agent.call_args_list:
+        assert call[1]['timeout'] == 60
+        assert call[0][0]['install_dir'] == '/opt/agent'
+    assert all(runner.close.called for runner in runners)
+    assert 'p95' in logger.info.call_args_list[-1][0][0]
+
+
+def test_install_agents_failure_isolated():
+    def _fail_one(cloudify_agent, installer, timeout):
+        if cloudify_agent['name'] == 'agent3':
+            raise CommandExecutionError('install.sh', 'no route to host')
+
+    results, _, runners, logger = _install(_fail_one)
+    failed = [r for r in results if r.error is not None]
+    assert [(r.name, r.host) for r in failed] == [('agent3', '10.0.0.3')]
+    assert len(results) == 5
+    assert all(runner.close.called for runner in runners)
+    logger.error.assert_called()
+
+
+def test_install_agents_concurrency_window():
+    lock = threading.Lock()
+    running = []
+    most_running = []
+
+    def _track(cloudify_agent, installer, timeout):
+        # ctx is available in the installing threads
+        assert current_ctx.get_ctx() is not None
+        with lock:
+            running.append(cloudify_agent['name'])
+            most_running.append(len(running))
+        threading.Event().wait(0.05)
+        with lock:
+            running.remove(cloudify_agent['name'])
+
+    results, _, _, _ = _install(_track, max_parallel=2)
+    assert all(r.error is None for r in results)
+    assert max(most_running) == 2
+
+
+def test_host_logger_prefix():
+    logger = Mock()
+    adapter = batch._HostLogger(logger, {'host': '10.0.0.1'})
+    adapter.info('installing')
+    assert logger.log.call_args[0][1] == '[10.0.0.1] installing'
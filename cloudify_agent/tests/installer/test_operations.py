@@ -18,29 +18,47 @@ logger = setup_logger(
     logger_level=logging.DEBUG)
 
 
+class _Listener(object):
+    """Stands in for AgentStartedListener: the agent starts on a wait"""
+
+    def __init__(self, starts_on_wait=None):
+        self._starts_on_wait = starts_on_wait
+        self.pings = 0
+        self.waits = 0
+        self.started = False
+
+    def ping(self, timeout):
+        self.pings += 1
+
+    def wait(self, timeout):
+        self.waits += 1
+        self.started = self.waits == self._starts_on_wait
+        return self.started
+
+
 @patch('cloudify_agent.installer.operations.update_agent_record')
-@patch('cloudify_agent.installer.operations.get_client')
-@patch('cloudify_agent.api.utils.is_agent_alive')
+@patch('cloudify_agent.liveness.get_client')
+@patch('cloudify_agent.readiness.AgentStartedListener')
 @patch('cloudify.manager.get_rest_client')
 def test_start_operation(
     rest_client_mock,
-    is_agent_alive_mock,
+    listener_mock,
     get_amqp_client_mock,
     update_agent_record_mock,
 ):
     """Test the agent start operation.
 
     This operation is used in plugin/init_script agent installation, and
-    is supposed to just wait until the agent has started. It will call
-    is_agent_alive and sleep over and over, until the agent is alive.
+    is supposed to just wait until the agent has started. It will ping the
+    agent and wait for it over and over, until the agent is started.
     """
     ctx = CloudifyContext({'node_id': 'a'})
     ctx._logger = Mock()  # no need to spam the logs
-    is_agent_alive_mock.side_effect = [False] * 10 + [True]
+    listener = _Listener(starts_on_wait=11)
+    listener_mock.return_value = listener
 
     # every time.time() call will advance the clock by 10 seconds
-    with patch('time.sleep') as sleep_mock, \
-            patch('time.time', side_effect=itertools.count(step=10)):
+    with patch('time.time', side_effect=itertools.count(step=10)):
 
         with current_ctx.push(ctx):
             start_operation(agent_config={
@@ -50,7 +68,11 @@ def test_start_operation(
                 'windows': False,
             })
 
-    assert len(sleep_mock.mock_calls) == 10
+    assert listener.waits == 11
+    assert listener.pings == 11
+    listener_mock.assert_called_once_with('agent')
+    get_amqp_client_mock.return_value.add_handler.assert_called_once_with(
+        listener)
 
     update_agent_record_mock.assert_has_calls([
         call(ANY, AgentState.STARTING),
@@ -59,27 +81,27 @@ def test_start_operation(
 
 
 @patch('cloudify_agent.installer.operations.update_agent_record')
-@patch('cloudify_agent.installer.operations.get_client')
-@patch('cloudify_agent.api.utils.is_agent_alive')
+@patch('cloudify_agent.liveness.get_client')
+@patch('cloudify_agent.readiness.AgentStartedListener')
 @patch('cloudify.manager.get_rest_client')
 def test_start_operation_nonresponsive(
     rest_client_mock,
-    is_agent_alive_mock,
+    listener_mock,
     get_amqp_client_mock,
     update_agent_record_mock,
 ):
     """Like test_start_operation, but the agent takes a long time
 
     The difference is, the agent is also going to be marked nonresponsive.
-    This is because is_agent_alive will report False for 50 tries
-    (=500 seconds) and only then True
+    This is because the agent will not start for 50 waits
+    (=500 seconds) and only then it will
     """
     ctx = CloudifyContext({'node_id': 'a'})
     ctx._logger = Mock()
-    is_agent_alive_mock.side_effect = [False] * 50 + [True]
+    listener = _Listener(starts_on_wait=51)
+    listener_mock.return_value = listener
 
-    with patch('time.sleep') as sleep_mock, \
-            patch('time.time', side_effect=itertools.count(step=10)):
+    with patch('time.time', side_effect=itertools.count(step=10)):
 
         with current_ctx.push(ctx):
             start_operation(agent_config={
@@ -89,7 +111,7 @@ def test_start_operation_nonresponsive(
                 'windows': False,
             })
 
-    assert len(sleep_mock.mock_calls) == 50
+    assert listener.waits == 51
 
     update_agent_record_mock.assert_has_calls([
         call(ANY, AgentState.STARTING),
@@ -99,27 +121,26 @@ def test_start_operation_nonresponsive(
 
 
 @patch('cloudify_agent.installer.operations.update_agent_record')
-@patch('cloudify_agent.installer.operations.get_client')
-@patch('cloudify_agent.api.utils.is_agent_alive')
+@patch('cloudify_agent.liveness.get_client')
+@patch('cloudify_agent.readiness.AgentStartedListener')
 @patch('cloudify.manager.get_rest_client')
 def test_start_operation_dead(
     rest_client_mock,
-    is_agent_alive_mock,
+    listener_mock,
     get_amqp_client_mock,
     update_agent_record_mock,
 ):
     """Like test_start_operation, but the agent never comes up
 
-    We will keep trying for an hour (360 calls to is_agent_alive, because
-    the mock time.time advances time by 10 seconds), and then throw
-    NonRecoverableError.
+    We will keep trying for an hour (360 pings, because the mock time.time
+    advances time by 10 seconds), and then throw NonRecoverableError.
     """
     ctx = CloudifyContext({'node_id': 'a'})
     ctx._logger = Mock()
 
-    is_agent_alive_mock.return_value = False
-    with patch('time.sleep'), \
-            patch('time.time', side_effect=itertools.count(step=10)):
+    listener = _Listener()
+    listener_mock.return_value = listener
+    with patch('time.time', side_effect=itertools.count(step=10)):
 
         with pytest.raises(NonRecoverableError):
             with current_ctx.push(ctx):
@@ -130,4 +151,4 @@ def test_start_operation_dead(
                     'windows': False,
                 })
 
-    assert len(is_agent_alive_mock.mock_calls) == 360
+    assert listener.pings == 360
@@ -1,4 +1,7 @@
-from cloudify_agent.api import utils
+import pytest
+from unittest import mock
+
+from cloudify_agent.api import exceptions, utils
 from cloudify_agent.shell.main import get_logger
 from cloudify_agent.tests.shell.commands import run_agent_command
 
@@ -113,3 +116,66 @@ def test_list(mock_get_storage_dir):
                       '--queue=queue --name=test-name2 --rest-host=127.0.0.1 '
                       '--broker-ip=127.0.0.1 --user=user ')
     run_agent_command('cfy-agent daemons list')
+
+
+def test_start_names(mock_daemon_factory_load, mock_get_storage_dir):
+    run_agent_command('cfy-agent daemons start --names=name1,name2 '
+                      '--interval 5 --timeout 20', raise_system_exit=True)
+
+    loaded = sorted(c[0][0] for c in mock_daemon_factory_load.call_args_list)
+    assert loaded == ['name1', 'name2']
+    daemon = mock_daemon_factory_load.return_value
+    assert daemon.start.call_count == 2
+    daemon.start.assert_called_with(
+        interval=5,
+        timeout=20,
+        delete_amqp_queue=False,
+    )
+
+
+def test_stop_all(mock_daemon_factory_load, mock_get_storage_dir):
+    summaries = [mock.Mock(), mock.Mock()]
+    summaries[0].name, summaries[1].name = 'name1', 'name2'
+    with mock.patch('cloudify_agent.shell.commands.daemons.DaemonFactory'
+                    '.list_daemons', return_value=summaries):
+        run_agent_command('cfy-agent daemons stop --all',
+                          raise_system_exit=True)
+
+    loaded = sorted(c[0][0] for c in mock_daemon_factory_load.call_args_list)
+    assert loaded == ['name1', 'name2']
+    assert mock_daemon_factory_load.return_value.stop.call_count == 2
+
+
+def test_status_names(mock_daemon_factory_load, mock_get_storage_dir,
+                      capsys):
+    mock_daemon_factory_load.return_value.status.return_value = True
+    run_agent_command('cfy-agent daemons status --names=name1,name2',
+                      raise_system_exit=True)
+    out = capsys.readouterr().out
+    assert 'name1: running' in out
+    summary = out.split('NAME')[1]
+    assert 'name1' in summary and 'name2' in summary
+
+
+def test_restart_names_failure(mock_daemon_factory_load,
+                               mock_get_storage_dir):
+    daemon = mock.Mock()
+
+    def _load(name, logger=None):
+        if name == 'missing':
+            raise exceptions.DaemonNotFoundError(name)
+        return daemon
+    mock_daemon_factory_load.side_effect = _load
+
+    with pytest.raises(SystemExit) as e:
+        run_agent_command('cfy-agent daemons restart --names=missing,name1',
+                          raise_system_exit=True)
+    assert e.value.code == 1
+    # the failure doesn't stop the other daemons
+    daemon.restart.assert_called_once_with()
+
+
+def test_name_required(mock_get_storage_dir):
+    with pytest.raises(SystemExit) as e:
+        run_agent_command('cfy-agent daemons stop', raise_system_exit=True)
+    assert e.value.code == 2
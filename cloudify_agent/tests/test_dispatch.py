@@ -1,11 +1,16 @@
+import argparse
+import importlib.metadata
 import json
 import os
+import queue
+import threading
+import time
 import pytest
 from unittest import mock
 
 from cloudify import exceptions, constants
 from cloudify.context import CloudifyContext
-from cloudify_agent import worker
+from cloudify_agent import journal, worker
 
 try:
     from packaging.version import parse as parse_version
@@ -86,3 +91,329 @@ def test_subprocess_env():
     bypass_env = consumer._build_subprocess_env(
         CloudifyContext({'bypass_maintenance': True}))
     assert constants.BYPASS_MAINTENANCE in bypass_env
+
+
+def test_handle_task_journaled(tmp_path):
+    tj = journal.TaskJournal(str(tmp_path / 'agent.journal'))
+    consumer = worker.CloudifyOperationConsumer(None, journal=tj)
+
+    def _task():
+        return {'cloudify_task': {'kwargs': {
+            '__cloudify_context': {'type': 'operation',
+                                   'task_id': 'task1',
+                                   'task_name': 'plugin.task'},
+        }}}
+
+    with mock.patch.object(worker, 'logger', create=True), \
+            mock.patch.object(consumer, '_validate_not_cancelled'), \
+            mock.patch.object(consumer, 'dispatch_to_subprocess',
+                              return_value=42) as dispatch:
+        assert consumer.handle_task(_task()) == {'ok': True, 'result': 42}
+        # the task is redelivered: the result is taken from the journal
+        assert consumer.handle_task(_task()) == {'ok': True, 'result': 42}
+    assert dispatch.call_count == 1
+
+
+def test_journaled_task_cancelled(tmp_path):
+    tj = journal.TaskJournal(str(tmp_path / 'agent.journal'))
+    tj.finished('task1', {'ok': True, 'result': 42})
+    consumer = worker.CloudifyOperationConsumer(None, journal=tj)
+    task = {'cloudify_task': {'kwargs': {
+        '__cloudify_context': {'type': 'operation',
+                               'task_id': 'task1',
+                               'task_name': 'plugin.task'},
+    }}}
+    with mock.patch.object(worker, 'logger', create=True), \
+            mock.patch.object(consumer, '_validate_not_cancelled',
+                              side_effect=exceptions.NonRecoverableError(
+                                  'cancelled')):
+        response = consumer.handle_task(task)
+    assert not response['ok']
+
+
+def test_switched_connection_routes_acks():
+    old, new = mock.Mock(), mock.Mock()
+    switched = worker._SwitchedConnection(old, new)
+    switched.ack('channel', 1)
+    switched.publish({'body': '{}'})
+    old.ack.assert_called_once_with('channel', 1, wait=False)
+    new.publish.assert_called_once_with({'body': '{}'})
+
+    switched.close_old(timeout=5)
+    old.close.assert_called_once_with(wait=True, timeout=5)
+    with mock.patch.object(worker, 'logger', create=True):
+        switched.ack('channel', 2)
+    assert old.ack.call_count == 1
+
+
+def test_switch_brokers():
+    args = mock.Mock(name='args')
+    agent_worker = worker.AgentWorker(args)
+    old_connection = mock.Mock()
+    old_handler = worker.CloudifyOperationConsumer('queue')
+    old_handler._tasks_buffer.append(('buffered', ))
+    agent_worker.connection = old_connection
+    agent_worker._handlers = [old_handler]
+    new_connection, new_thread = mock.Mock(), mock.Mock()
+
+    with mock.patch.object(worker, 'logger', create=True), \
+            mock.patch.object(worker.broker_config, 'load_broker_config'), \
+            mock.patch.object(agent_worker, '_connect', return_value=(
+                new_connection, [], new_thread)):
+        assert agent_worker.switch_brokers() is new_thread
+
+    assert agent_worker.connection is new_connection
+    old_connection.channel_method.assert_called_once_with(
+        worker._cancel_consumers, timeout=worker.BROKER_SWITCH_TIMEOUT)
+    old_connection.close.assert_called_once_with(
+        wait=True, timeout=worker.BROKER_SWITCH_CLOSE_TIMEOUT)
+    assert not old_handler._tasks_buffer
+    assert old_handler._channel is None
+    # responses of tasks still running go to the new connection
+    old_handler._connection.publish({'body': '{}'})
+    new_connection.publish.assert_called_once_with({'body': '{}'})
+
+
+def test_switch_brokers_waits_for_acks():
+    agent_worker = worker.AgentWorker(mock.Mock())
+    old_connection = mock.Mock()
+    old_handler = worker.CloudifyOperationConsumer('queue')
+    old_handler.register(old_connection, mock.Mock())
+    agent_worker.connection = old_connection
+    agent_worker._handlers = [old_handler]
+
+    # a task was started, but didn't send its ack yet
+    with mock.patch.object(worker.TaskConsumer, '_run_task'):
+        old_handler._run_task(('channel', None, {}, 7))
+
+    def _close(wait, timeout):
+        # the ack was queued on the old connection before closing it
+        old_connection.ack.assert_called_once_with(
+            'channel', 7, wait=False)
+        return True
+    old_connection.close.side_effect = _close
+
+    def _ack_later():
+        time.sleep(0.1)
+        old_handler._connection.ack('channel', 7)
+
+    acker = threading.Thread(target=_ack_later)
+    with mock.patch.object(worker, 'logger', create=True), \
+            mock.patch.object(worker.broker_config, 'load_broker_config'), \
+            mock.patch.object(agent_worker, '_connect', return_value=(
+                mock.Mock(), [], mock.Mock())):
+        acker.start()
+        agent_worker.switch_brokers()
+    acker.join()
+    assert old_connection.close.call_count == 1
+    assert not old_handler._unacked
+
+
+def test_switch_brokers_old_brokers_gone():
+    agent_worker = worker.AgentWorker(mock.Mock())
+    old_connection = mock.Mock()
+    # reconnecting to the old brokers, which are gone
+    old_connection.connect_wait.is_set.return_value = False
+    old_handler = worker.CloudifyOperationConsumer('queue')
+    agent_worker.connection = old_connection
+    agent_worker._handlers = [old_handler]
+    with mock.patch.object(old_handler, 'wait_for_acks') as wait_for_acks, \
+            mock.patch.object(worker, 'logger', create=True), \
+            mock.patch.object(worker.broker_config, 'load_broker_config'), \
+            mock.patch.object(agent_worker, '_connect', return_value=(
+                mock.Mock(), [], mock.Mock())):
+        agent_worker.switch_brokers()
+    old_connection.channel_method.assert_not_called()
+    wait_for_acks.assert_not_called()
+    old_connection.close.assert_called_once_with(
+        wait=True, timeout=worker.BROKER_SWITCH_CLOSE_TIMEOUT)
+
+
+@pytest.mark.skipif(
+    parse_version(importlib.metadata.version('cloudify-common')) <
+    parse_version('7.0.5'),
+    reason='cloudify-common is older than the minimum in setup.py')
+def test_watchdog_hooks_exist():
+    # overridden by _SwitchableConsumer: if they're gone or renamed, a
+    # retired consumer's watchdog keeps running
+    for hook in ['_is_watchdog_idle', '_watch_tasks_processing']:
+        assert callable(getattr(worker.TaskConsumer, hook, None)), hook
+
+
+def test_retired_consumer_stops_watchdog():
+    consumer = worker.CloudifyOperationConsumer('queue')
+    consumer.retire(mock.Mock())
+    # the watchdog loop of TaskConsumer checks whether it is idle first
+    watch = mock.patch.object(
+        worker.TaskConsumer, '_watch_tasks_processing', create=True,
+        side_effect=lambda: consumer._is_watchdog_idle())
+    with mock.patch.object(worker.TaskConsumer, '_is_watchdog_idle',
+                           create=True) as idle, watch:
+        consumer._watch_tasks_processing()
+    idle.assert_not_called()
+
+
+def test_closed_connection_stops_reconnecting():
+    connection = worker._WorkerConnection(handlers=[], connect_timeout=None)
+    attempts = []
+
+    def _connect(params, deadline=None):
+        attempts.append(params)
+        if len(attempts) == 2:
+            connection.close(wait=False)
+        return None
+
+    with mock.patch.object(worker.AMQPConnection, '_get_pika_connection',
+                           side_effect=_connect), \
+            mock.patch.object(worker, 'logger', create=True):
+        connection.consume()
+    assert len(attempts) == 2
+
+
+def test_switch_brokers_cant_connect():
+    agent_worker = worker.AgentWorker(mock.Mock())
+    old_connection = mock.Mock()
+    agent_worker.connection = old_connection
+    with mock.patch.object(worker, 'logger', create=True), \
+            mock.patch.object(worker.broker_config, 'load_broker_config'), \
+            mock.patch.object(agent_worker, '_connect',
+                              side_effect=RuntimeError('unreachable')):
+        assert agent_worker.switch_brokers() is None
+    assert agent_worker.connection is old_connection
+    old_connection.close.assert_not_called()
+
+
+def test_install_plugins_batched():
+    consumer = worker.ServiceTaskConsumer(
+        'agent', 'queue', 5, operation_registry=worker.ProcessRegistry())
+
+    def _install(plugin, **kwargs):
+        if plugin['name'] == 'bad':
+            raise RuntimeError('broken')
+
+    with mock.patch.object(worker, 'logger', create=True), \
+            mock.patch('cloudify.manager.get_rest_client') as get_client, \
+            mock.patch('cloudify.plugin_installer.install', _install):
+        response = consumer.handle_task({'service_task': {
+            'task_name': 'install-plugins',
+            'kwargs': {
+                'plugins': [{'name': 'p1', 'package_name': 'p1'},
+                            {'name': 'bad', 'package_name': 'bad'},
+                            {'name': 'p2', 'package_name': 'p2'}],
+                'rest_token': 'token',
+                'tenant': {'name': 'tenant1'},
+                'rest_host': ['127.0.0.1'],
+            }}})
+    assert [(p['name'], p['success']) for p in response['plugins']] == \
+        [('p1', True), ('bad', False), ('p2', True)]
+    assert response['plugins'][1]['error'] == 'broken'
+    # the installs are serialized without looking the plugins up
+    get_client.assert_not_called()
+
+
+def test_watchdog_only_when_responsive():
+    notifier = mock.Mock(watchdog_interval=5)
+    agent_worker = worker.AgentWorker(mock.Mock(), notifier=notifier)
+    agent_worker.connection = mock.Mock()
+
+    agent_worker._ping_watchdog()
+    agent_worker.connection.channel_method.assert_called_once_with(
+        worker._noop, timeout=1.25)
+    assert notifier.watchdog.call_count == 1
+    # pinged at most every interval
+    agent_worker._ping_watchdog()
+    assert notifier.watchdog.call_count == 1
+
+    # the connection thread is stuck: stop pinging the watchdog
+    agent_worker._last_watchdog = 0
+    agent_worker.connection.channel_method.side_effect = queue.Empty()
+    with mock.patch.object(worker, 'logger', create=True):
+        agent_worker._ping_watchdog()
+    assert notifier.watchdog.call_count == 1
+
+    # reconnecting is not being stuck
+    agent_worker.connection.connect_wait.is_set.return_value = False
+    agent_worker._ping_watchdog()
+    assert notifier.watchdog.call_count == 2
+
+
+class _Stop(BaseException):
+    pass
+
+
+def _watchdog_worker():
+    """An AgentWorker with a fast watchdog, and an event set on pings"""
+    pinged = threading.Event()
+    notifier = mock.Mock(watchdog_interval=0.01)
+    notifier.watchdog.side_effect = lambda: pinged.set()
+    agent_worker = worker.AgentWorker(
+        argparse.Namespace(queue='agent1', name=None), notifier=notifier)
+    return agent_worker, pinged
+
+
+def test_watchdog_pinged_while_reconnecting():
+    agent_worker, pinged = _watchdog_worker()
+    # the first connection is lost right away, and the connection thread
+    # is gone, so it doesn't respond anymore
+    lost_connection = mock.Mock()
+    lost_connection.channel_method.side_effect = queue.Empty()
+    dead_thread = mock.Mock()
+    dead_thread.is_alive.return_value = False
+    connections = [(lost_connection, [], dead_thread)]
+
+    def _connect(connect_timeout=None):
+        if connections:
+            return connections.pop()
+        # connecting again takes longer than the watchdog timeout
+        pinged.clear()
+        raise _Stop(pinged.wait(5))
+
+    with mock.patch.object(worker, 'logger', create=True), \
+            mock.patch.object(agent_worker, '_connect',
+                              side_effect=_connect):
+        try:
+            with pytest.raises(_Stop) as stopped:
+                agent_worker.run()
+        finally:
+            agent_worker._watchdog_stop.set()
+    # pinged while connecting
+    assert stopped.value.args == (True, )
+
+
+def test_watchdog_pinged_while_switching():
+    agent_worker, pinged = _watchdog_worker()
+    agent_worker.connection = mock.Mock()
+
+    def _connect_new(connect_timeout=None):
+        # connecting to the new brokers takes longer than the watchdog
+        # timeout
+        pinged.clear()
+        if not pinged.wait(5):
+            raise AssertionError('The watchdog was not pinged')
+        raise RuntimeError('unreachable')
+
+    with mock.patch.object(worker, 'logger', create=True), \
+            mock.patch.object(worker.broker_config, 'load_broker_config'), \
+            mock.patch.object(agent_worker, '_connect',
+                              side_effect=_connect_new):
+        agent_worker._start_watchdog()
+        try:
+            assert agent_worker.switch_brokers() is None
+        finally:
+            agent_worker._watchdog_stop.set()
+    assert agent_worker._watchdog_thread.daemon
+
+
+def test_started_event_published_once():
+    agent_worker = worker.AgentWorker(
+        argparse.Namespace(queue='agent1', name=None), notifier=mock.Mock())
+    agent_worker.connection = mock.Mock()
+    agent_worker._notify_ready()
+    # reconnecting doesn't publish it again
+    agent_worker._notify_ready()
+    agent_worker.connection.publish.assert_called_once()
+    # not waiting for it to be sent, so that the worker can't get stuck
+    assert agent_worker.connection.publish.call_args[1] == {'wait': False}
+    event = agent_worker.connection.publish.call_args[0][0]
+    assert event['exchange'] == 'agent1'
+    assert event['routing_key'] == 'started'
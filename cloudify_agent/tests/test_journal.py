@@ -0,0 +1,74 @@
+import os
+import time
+
+from unittest import mock
+
+from cloudify import constants
+
+from cloudify_agent import journal
+
+
+def test_store_and_get(tmp_path):
+    tj = journal.TaskJournal(str(tmp_path / 'agent.journal'))
+    tj.started('task1')
+    assert tj.get('task1').state == constants.TASK_STARTED
+    assert tj.get_result('task1') is None
+
+    tj.finished('task1', {'ok': True, 'result': 42})
+    assert tj.get('task1').state == constants.TASK_SUCCEEDED
+    assert tj.get_result('task1') == {'ok': True, 'result': 42}
+    assert tj.get_result('unknown') is None
+
+
+def test_failed_task(tmp_path):
+    tj = journal.TaskJournal(str(tmp_path / 'agent.journal'))
+    tj.started('task1')
+    tj.finished('task1', {'ok': False, 'error': {'message': 'x'}})
+    # a resumed execution sends the same task again: it must run again
+    assert tj.get('task1') is None
+    assert tj.get_result('task1') is None
+
+
+def test_persists_across_reopen(tmp_path):
+    path = str(tmp_path / 'agent.journal')
+    tj = journal.TaskJournal(path)
+    tj.finished('task1', {'ok': True, 'result': 'abc'})
+    tj.close()
+
+    assert journal.TaskJournal(path).get_result('task1') == \
+        {'ok': True, 'result': 'abc'}
+
+
+def test_for_daemon(tmp_path):
+    storage = str(tmp_path / 'storage')
+    tj = journal.TaskJournal.for_daemon(storage, 'agent1')
+    assert tj.path == os.path.join(storage, 'agent1.journal')
+    assert os.path.exists(tj.path)
+
+
+def test_compact_max_entries(tmp_path):
+    tj = journal.TaskJournal(str(tmp_path / 'agent.journal'), max_entries=3)
+    for i in range(5):
+        tj.finished('task{0}'.format(i), {'ok': True, 'result': i})
+    tj.compact()
+    assert tj.count() == 3
+    assert tj.get('task0') is None
+    assert tj.get_result('task4') == {'ok': True, 'result': 4}
+
+
+def test_compact_max_age(tmp_path):
+    tj = journal.TaskJournal(str(tmp_path / 'agent.journal'), max_age=10)
+    with mock.patch('time.time', return_value=time.time() - 20):
+        tj.finished('old', {'ok': True, 'result': None})
+    tj.finished('new', {'ok': True, 'result': None})
+    tj.compact()
+    assert tj.get('old') is None
+    assert tj.get('new') is not None
+
+
+def test_result_too_large(tmp_path):
+    tj = journal.TaskJournal(str(tmp_path / 'agent.journal'))
+    tj.started('task1')
+    with mock.patch.object(journal, 'MAX_RESULT_SIZE', 10):
+        tj.finished('task1', {'ok': True, 'result': 'x' * 100})
+    assert tj.get('task1') is None
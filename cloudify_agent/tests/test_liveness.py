@@ -0,0 +1,267 @@
+import json
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from cloudify_agent import liveness, readiness
+
+
+class _Client(object):
+    """Stands in for AMQPConnection: runs the channel methods right away"""
+
+    def __init__(self):
+        self.channel = mock.Mock()
+        self.handlers = []
+        self.closed = False
+
+    def add_handler(self, handler):
+        self.handlers.append(handler)
+
+    def consume_in_thread(self):
+        for handler in self.handlers:
+            handler.register(self, self.channel)
+
+    def channel_method(self, method, wait=True, timeout=None, **kwargs):
+        return method(self, self.channel, **kwargs)
+
+    def close(self):
+        self.closed = True
+
+    def pinged(self):
+        return [c[1]['exchange']
+                for c in self.channel.basic_publish.call_args_list]
+
+
+def _wait_for_waiters(monitor, count):
+    for _ in range(500):
+        with monitor._lock:
+            if sum(len(agent.waiters)
+                   for agent in monitor._agents.values()) >= count:
+                return
+        time.sleep(0.01)
+    raise AssertionError('waiters not registered')
+
+
+def _wait_for_pings(client, count):
+    for _ in range(500):
+        if client.channel.basic_publish.call_count >= count:
+            return
+        time.sleep(0.01)
+    raise AssertionError('pings not sent')
+
+
+def _deliver(monitor, channel, exchange):
+    method = mock.Mock(exchange=exchange)
+    monitor.process(channel, method, mock.Mock(), b'{}')
+
+
+def test_vhost_monitor_shared_queue():
+    client = _Client()
+    monitor = liveness._VhostMonitor(client)
+    assert not monitor.wait('agent1', 0.01)
+    assert not monitor.wait('agent2', 0.01)
+    bindings = {(c[1]['exchange'], c[1]['routing_key'])
+                for c in client.channel.queue_bind.call_args_list}
+    assert bindings == {
+        (name, routing_key)
+        for name in ('agent1', 'agent2')
+        for routing_key in (readiness.STARTED_ROUTING_KEY, monitor.queue)
+    }
+    # one queue for all of the agents, declared once
+    client.channel.queue_declare.assert_called_once_with(
+        queue=monitor.queue, exclusive=True, auto_delete=True)
+    # every agent is pinged when it's first waited for
+    assert client.pinged() == ['agent1', 'agent2']
+    properties = client.channel.basic_publish.call_args[1]['properties']
+    assert properties.reply_to == monitor.queue
+
+
+def test_vhost_monitor_wakes_waiters():
+    client = _Client()
+    monitor = liveness._VhostMonitor(client)
+    results = []
+
+    def _wait(name):
+        results.append((name, monitor.wait(name, 5)))
+
+    threads = [threading.Thread(target=_wait, args=(name, ))
+               for name in ('agent1', 'agent1', 'agent2')]
+    for thread in threads:
+        thread.start()
+    _wait_for_waiters(monitor, 3)
+    threading.Timer(0.05, _deliver,
+                    [monitor, client.channel, 'agent1']).start()
+    for thread in threads[:2]:
+        thread.join(5)
+    assert results == [('agent1', True), ('agent1', True)]
+    assert threads[2].is_alive()
+    _deliver(monitor, client.channel, 'agent2')
+    threads[2].join(5)
+    assert results[2] == ('agent2', True)
+    # already known to have started
+    assert monitor.wait('agent1', 0)
+
+
+def test_vhost_monitor_bind_failed():
+    client = _Client()
+    monitor = liveness._VhostMonitor(client)
+    client.channel.queue_bind.side_effect = [RuntimeError('timed out'),
+                                             None, None]
+    with pytest.raises(RuntimeError):
+        monitor.wait('agent1', 0.01)
+    assert client.pinged() == []
+    # the next wait binds the queue again
+    assert not monitor.wait('agent1', 0.01)
+    assert client.channel.queue_bind.call_count == 3
+    assert client.pinged() == ['agent1']
+    assert not monitor.wait('agent1', 0.01)
+    assert client.channel.queue_bind.call_count == 3
+
+
+def test_vhost_monitor_batches_pings():
+    client = _Client()
+    monitor = liveness._VhostMonitor(client)
+    waiters = [threading.Thread(target=monitor.wait, args=(name, 0.5))
+               for name in ('agent1', 'agent2', 'agent3')]
+    for waiter in waiters:
+        waiter.start()
+    _wait_for_waiters(monitor, 3)
+    # the first wait for every agent pings it right away
+    _wait_for_pings(client, 3)
+    _deliver(monitor, client.channel, 'agent3')
+    client.channel.reset_mock()
+
+    with mock.patch.object(client, 'channel_method',
+                           wraps=client.channel_method) as channel_method:
+        monitor.ping(interval=0)
+    # the agents that haven't started yet, sent together
+    channel_method.assert_called_once()
+    assert sorted(client.pinged()) == ['agent1', 'agent2']
+    for waiter in waiters:
+        waiter.join(5)
+
+    # nobody waits for them anymore
+    client.channel.reset_mock()
+    monitor.ping(interval=0)
+    assert client.pinged() == []
+
+
+def test_vhost_monitor_expire():
+    client = _Client()
+    monitor = liveness._VhostMonitor(client)
+    monitor.wait('agent1', 0)
+    monitor.expire(grace=60)
+    assert monitor.idle_since is None
+    client.channel.queue_unbind.assert_not_called()
+    monitor.expire(grace=-1)
+    assert monitor.idle_since is not None
+    assert {c[1]['exchange']
+            for c in client.channel.queue_unbind.call_args_list} == {'agent1'}
+
+    # rebound when the connection is made again
+    client.channel.reset_mock()
+    monitor.wait('agent2', 0)
+    monitor.register(client, client.channel)
+    assert {c[1]['exchange']
+            for c in client.channel.queue_bind.call_args_list} == {'agent2'}
+
+
+def test_monitor_closes_idle_vhosts():
+    clients = []
+
+    def _get_client(**kwargs):
+        clients.append(_Client())
+        return clients[-1]
+
+    monitor = liveness.LivenessMonitor(grace=-1, idle_timeout=-1)
+    with mock.patch('cloudify_agent.liveness.get_client', _get_client), \
+            mock.patch.object(monitor, '_ping_loop'):
+        monitor.wait('agent1', 0, 'vhost1', 'user', 'pass')
+        monitor.wait('agent2', 0, 'vhost1', 'user', 'pass')
+        monitor.wait('agent3', 0, 'vhost2', 'user', 'pass')
+    # one connection per vhost
+    assert len(clients) == 2
+    monitor.tick()
+    assert all(client.closed for client in clients)
+
+
+class _Monitor(object):
+    def __init__(self, started):
+        self.started = started
+        self.requests = []
+
+    def wait(self, name, timeout, vhost, user, password):
+        self.requests.append((name, timeout, vhost, user, password))
+        if isinstance(self.started, Exception):
+            raise self.started
+        return self.started
+
+
+@pytest.mark.only_posix
+def test_waiter_uses_monitor(tmp_path):
+    path = str(tmp_path / 'liveness')
+    monitor = _Monitor(started=True)
+    server = liveness.LivenessServer(path, monitor)
+    server.start()
+    try:
+        with mock.patch('cloudify_agent.liveness.get_client') as get_client:
+            with liveness.AgentWaiter('agent1', 'vhost1', 'user', 'pass',
+                                      socket_path=path) as waiter:
+                assert waiter.wait(10)
+        get_client.assert_not_called()
+    finally:
+        server.close()
+    assert monitor.requests == [('agent1', 10, 'vhost1', 'user', 'pass')]
+
+
+@pytest.mark.only_posix
+def test_waiter_monitor_error(tmp_path):
+    path = str(tmp_path / 'liveness')
+    server = liveness.LivenessServer(path, _Monitor(ValueError('broken')))
+    server.start()
+    listener = mock.Mock()
+    try:
+        with mock.patch('cloudify_agent.liveness.get_client') as get_client, \
+                mock.patch('cloudify_agent.readiness.AgentStartedListener',
+                           return_value=listener):
+            waiter = liveness.AgentWaiter('agent1', 'vhost1', 'user', 'pass',
+                                          socket_path=path)
+            with waiter:
+                assert waiter.wait(10) == listener.wait.return_value
+                # and the monitor isn't asked again
+                waiter.wait(10)
+    finally:
+        server.close()
+    get_client.assert_called_once_with(
+        amqp_user='user', amqp_pass='pass', amqp_vhost='vhost1')
+    get_client.return_value.add_handler.assert_called_once_with(listener)
+    assert listener.ping.call_count == 2
+    get_client.return_value.close.assert_called_once_with()
+
+
+def test_waiter_without_monitor(monkeypatch):
+    monkeypatch.delenv(liveness.LIVENESS_SOCKET_ENV, raising=False)
+    listener = mock.Mock()
+    listener.wait.return_value = False
+    with mock.patch('cloudify_agent.liveness.get_client'), \
+            mock.patch('cloudify_agent.readiness.AgentStartedListener',
+                       return_value=listener):
+        with liveness.AgentWaiter('agent1', 'vhost1', 'user', 'pass') \
+                as waiter:
+            assert not waiter.wait(10)
+    listener.ping.assert_called_once_with(10)
+
+
+def test_monitor_request_json(tmp_path):
+    # the request and the response are lines of json
+    server = liveness.LivenessServer(str(tmp_path / 'x'), _Monitor(False))
+    conn = mock.Mock()
+    conn.recv.side_effect = [json.dumps({
+        'name': 'agent1', 'timeout': 1, 'vhost': 'v',
+        'user': 'u', 'password': 'p',
+    }).encode('utf-8') + b'\n']
+    server._handle(conn)
+    conn.sendall.assert_called_once_with(b'{"started": false}\n')
+    conn.close.assert_called_once_with()
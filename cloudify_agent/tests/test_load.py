@@ -0,0 +1,72 @@
+import os
+
+from unittest import mock
+
+from cloudify_agent import load, worker
+
+
+def test_pressure(tmp_path):
+    (tmp_path / 'cpu').write_text(
+        'some avg10=1.50 avg60=0.20 avg300=0.00 total=1000\n'
+        'full avg10=0.00 avg60=0.00 avg300=0.00 total=0\n')
+    assert load.pressure('cpu', str(tmp_path)) == 1.5
+    assert load.pressure('io', str(tmp_path)) is None
+
+
+def test_memory_available(tmp_path):
+    meminfo = tmp_path / 'meminfo'
+    meminfo.write_text('MemTotal:  2000 kB\nMemFree:  500 kB\n'
+                       'MemAvailable:  1000 kB\n')
+    assert load.memory_available(str(meminfo)) == 1024000
+    assert load.memory_available(str(tmp_path / 'missing')) is None
+
+
+def test_plugin_counter(tmp_path):
+    def _install(tenant, name, version):
+        os.makedirs(str(tmp_path / 'plugins' / tenant / name / version))
+
+    _install('default_tenant', 'plugin1', '1.0')
+    _install('default_tenant', 'plugin1', '1.1')
+    _install('tenant2', 'plugin2', '2.0')
+    counter = load.PluginCounter(str(tmp_path))
+    assert counter.count() == 3
+
+    _install('tenant2', 'plugin3', '3.0')
+    assert counter.count() == 3
+    counter.invalidate()
+    assert counter.count() == 4
+
+
+def test_plugin_counter_root(tmp_path, monkeypatch):
+    # same as where cloudify.plugin_installer installs the plugins
+    monkeypatch.setenv('CFY_PLUGINS_ROOT', str(tmp_path))
+    os.makedirs(str(tmp_path / 'plugins' / 'tenant' / 'plugin1' / '1.0'))
+    assert load.PluginCounter().count() == 1
+
+
+def test_ping_load():
+    operation_consumer = worker.CloudifyOperationConsumer('queue', 5)
+    consumer = worker.ServiceTaskConsumer(
+        'agent', 'queue', 5, operation_registry=worker.ProcessRegistry(),
+        operation_consumer=operation_consumer)
+    operation_consumer._in_flight = 2
+    operation_consumer._tasks_buffer.append(('buffered', ))
+
+    with mock.patch.object(worker, 'logger', create=True):
+        response = consumer.handle_task({'service_task': {
+            'task_name': 'ping'}})
+    assert 'time' in response
+    assert response['load']['in_flight'] == 2
+    assert response['load']['free_slots'] == 3
+    assert response['load']['queued'] == 1
+    assert 'loadavg' in response['load']
+    assert 'plugins' in response['load']
+
+    # the plugin count is cached, so that the reply stays fast: pinging
+    # again neither scans the plugins directory nor calls the manager
+    with mock.patch.object(load, '_subdirs') as subdirs, \
+            mock.patch('cloudify.manager.get_rest_client') as get_client:
+        for _ in range(3):
+            consumer.ping_task()
+    subdirs.assert_not_called()
+    get_client.assert_not_called()
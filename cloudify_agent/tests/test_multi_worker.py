@@ -0,0 +1,205 @@
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import pytest
+
+from cloudify.context import CloudifyContext
+
+from cloudify_agent import multi_worker, worker
+from cloudify_agent.api import exceptions
+
+
+def _daemon_params(name, ssl_cert, **kwargs):
+    params = {
+        'process_management': 'init.d',
+        'name': name,
+        'queue': '{0}-queue'.format(name),
+        'rest_host': '127.0.0.1',
+        'broker_ip': '127.0.0.1',
+        'user': 'user',
+        'broker_ssl_enabled': True,
+        'local_rest_cert_file': ssl_cert.local_cert_path(),
+        'broker_ssl_cert_path': ssl_cert.local_cert_path(),
+    }
+    params.update(kwargs)
+    return params
+
+
+def test_agent_env(daemon_factory, agent_ssl_cert, tmp_path):
+    daemon = daemon_factory.new(**_daemon_params(
+        'agent1', agent_ssl_cert, agent_dir=str(tmp_path),
+        extra_env={'FOO': 1}))
+    env = multi_worker.agent_env(daemon)
+    assert env['AGENT_NAME'] == 'agent1'
+    assert env['CFY_PLUGINS_ROOT'] == str(tmp_path)
+    assert env['AGENT_WORK_DIR'] == os.path.join(str(tmp_path), 'work')
+    assert env['LOCAL_REST_CERT_FILE'] == agent_ssl_cert.local_cert_path()
+    assert env['FOO'] == '1'
+    assert 'CFY_EXEC_TEMP' not in env
+
+
+def test_agent_environment_applied(monkeypatch):
+    monkeypatch.setenv('AGENT_NAME', 'original')
+    monkeypatch.delenv('CFY_PLUGINS_ROOT', raising=False)
+    env = {'AGENT_NAME': 'agent1', 'CFY_PLUGINS_ROOT': '/agent1'}
+    with worker.agent_environment.applied(env):
+        assert os.environ['AGENT_NAME'] == 'agent1'
+        with worker.agent_environment.applied(dict(env)):
+            # the same environment can be applied by several holders
+            assert os.environ['CFY_PLUGINS_ROOT'] == '/agent1'
+        assert os.environ['CFY_PLUGINS_ROOT'] == '/agent1'
+    assert os.environ['AGENT_NAME'] == 'original'
+    assert 'CFY_PLUGINS_ROOT' not in os.environ
+
+
+def test_agent_environment_excludes_other_agents():
+    env1 = {'AGENT_NAME': 'agent1'}
+    env2 = {'AGENT_NAME': 'agent2'}
+    seen = []
+    first_applied = threading.Event()
+    release_first = threading.Event()
+
+    def _first():
+        with worker.agent_environment.applied(env1):
+            first_applied.set()
+            release_first.wait(5)
+            seen.append(os.environ['AGENT_NAME'])
+
+    def _second():
+        with worker.agent_environment.applied(env2):
+            seen.append(os.environ['AGENT_NAME'])
+
+    first = threading.Thread(target=_first)
+    first.start()
+    first_applied.wait(5)
+    second = threading.Thread(target=_second)
+    second.start()
+    second.join(0.2)
+    # the second agent waits until the first one is done
+    assert second.is_alive()
+    release_first.set()
+    first.join(5)
+    second.join(5)
+    assert seen == ['agent1', 'agent2']
+
+
+def test_consumer_agent_env(tmp_path):
+    consumer = worker.CloudifyOperationConsumer(
+        None, agent_env={'AGENT_NAME': 'agent1',
+                         'AGENT_LOG_DIR': str(tmp_path)})
+    env = consumer._build_subprocess_env(CloudifyContext({}))
+    assert env['AGENT_NAME'] == 'agent1'
+    ctx = CloudifyContext({'deployment_id': 'd1', 'tenant': {'name': 't'}})
+    logfile = consumer.logfile(ctx)
+    assert logfile._filename.startswith(str(tmp_path))
+
+
+def test_consumer_env_not_from_other_agents(monkeypatch):
+    monkeypatch.delenv('CFY_PLUGINS_ROOT', raising=False)
+    consumer = worker.CloudifyOperationConsumer(
+        None, agent_env={'AGENT_NAME': 'agent2'})
+    # another agent's thread is installing a plugin
+    with worker.agent_environment.applied(
+            {'AGENT_NAME': 'agent1', 'CFY_PLUGINS_ROOT': '/agent1'}):
+        env = consumer._build_subprocess_env(CloudifyContext({}))
+    assert env['AGENT_NAME'] == 'agent2'
+    assert 'CFY_PLUGINS_ROOT' not in env
+
+
+def test_tasks_run_in_shared_executor():
+    executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='task')
+    consumers = [
+        worker.CloudifyOperationConsumer(
+            'agent{0}'.format(i), 1, executor=executor)
+        for i in range(2)]
+    threads = []
+    done = threading.Semaphore(0)
+
+    def _handle_task(full_task):
+        threads.append(threading.current_thread().name)
+        done.release()
+        return {'ok': True}
+
+    for consumer in consumers:
+        consumer._connection = mock.Mock()
+        consumer.handle_task = _handle_task
+        consumer.process(mock.Mock(), mock.Mock(delivery_tag=1),
+                         mock.Mock(reply_to=None),
+                         json.dumps({'task': 1}).encode('utf-8'))
+    assert done.acquire(timeout=5) and done.acquire(timeout=5)
+    executor.shutdown(wait=True)
+    assert len(threads) == 2
+    assert all(name.startswith('task') for name in threads)
+
+
+def test_multi_worker_shares_executor(daemon_factory, agent_ssl_cert):
+    for name in ['agent1', 'agent2']:
+        daemon_factory.save(daemon_factory.new(
+            **_daemon_params(name, agent_ssl_cert, max_workers=3)))
+    with mock.patch.object(worker, '_open_task_journal'):
+        multi = multi_worker.MultiAgentWorker(['agent1', 'agent2'],
+                                              factory=daemon_factory)
+    assert multi.executor._max_workers == 12
+    assert all(w._executor is multi.executor for w in multi.workers)
+
+
+def test_cluster_update_only_for_the_agent(tmp_path, monkeypatch):
+    monkeypatch.delenv('REST_HOST', raising=False)
+    monkeypatch.setenv('AGENT_NAME', 'original')
+    env = {'AGENT_NAME': 'agent1', 'AGENT_LOG_DIR': str(tmp_path)}
+    args = mock.Mock(queue='agent1-queue', max_workers=1)
+    args.name = 'agent1'
+    operation_consumer, service_consumer = worker.make_handlers(
+        args, agent_env=env)
+    daemon = mock.Mock(local_rest_cert_file=str(tmp_path / 'rest.crt'),
+                       broker_ssl_cert_path=str(tmp_path / 'broker.crt'))
+    loaded_as = []
+
+    def _load(name):
+        loaded_as.append(os.environ['AGENT_NAME'])
+        return daemon
+
+    with mock.patch.object(worker, 'DaemonFactory') as factory:
+        factory.return_value.load.side_effect = _load
+        service_consumer.cluster_update_task(
+            brokers=['broker2'], broker_ca='ca', managers=['m1', 'm2'],
+            manager_ca='ca')
+    # the daemon is loaded with the agent's environment applied
+    assert loaded_as == ['agent1']
+    assert daemon.rest_host == ['m1', 'm2']
+    # the other agents served by the worker are not affected
+    assert 'REST_HOST' not in os.environ
+    assert os.environ['AGENT_NAME'] == 'original'
+    assert operation_consumer._build_subprocess_env(
+        CloudifyContext({}))['REST_HOST'] == 'm1,m2'
+    assert service_consumer._in_process_env['REST_HOST'] == 'm1,m2'
+
+
+def test_hosted_worker_connects_to_daemon_brokers(
+        daemon_factory, agent_ssl_cert):
+    daemon = daemon_factory.new(**_daemon_params(
+        'agent1', agent_ssl_cert, broker_vhost='vhost1'))
+    daemon_factory.save(daemon)
+    hosted = multi_worker.HostedAgentWorker(daemon, daemon_factory)
+    assert hosted.args.queue == 'agent1-queue'
+
+    handler = mock.Mock()
+    with mock.patch('cloudify_agent.multi_worker.get_client') as get_client:
+        connection = hosted._make_connection([handler], None)
+    assert get_client.call_args[0][4] == 'vhost1'
+    assert get_client.call_args[1]['name'] == 'agent1'
+    connection.add_handler.assert_called_once_with(handler)
+
+
+def test_multi_worker_same_user(daemon_factory, agent_ssl_cert):
+    daemon_factory.save(daemon_factory.new(
+        **_daemon_params('agent1', agent_ssl_cert, user='user1')))
+    daemon_factory.save(daemon_factory.new(
+        **_daemon_params('agent2', agent_ssl_cert, user='user2')))
+    with pytest.raises(exceptions.DaemonConfigurationError,
+                       match='same user'):
+        multi_worker.MultiAgentWorker(['agent1', 'agent2'],
+                                      factory=daemon_factory)
@@ -0,0 +1,105 @@
+import json
+import socket
+import threading
+from unittest import mock
+
+import pytest
+
+from cloudify_agent import readiness
+
+
+@pytest.mark.only_posix
+def test_notify_ready(tmp_path):
+    path = readiness.ready_socket_path(str(tmp_path), 'agent1')
+    with readiness.ReadinessListener(path) as listener:
+        assert listener.listening
+        assert listener.wait(0.01) is None
+        threading.Timer(0.05, readiness.notify_ready, [path]).start()
+        message = listener.wait(5)
+    assert 'pid' in message
+    assert not (tmp_path / 'agent1.ready').exists()
+
+
+def test_notify_nobody_listening(tmp_path):
+    path = readiness.ready_socket_path(str(tmp_path), 'agent1')
+    assert not readiness.notify_ready(path)
+
+
+def test_listener_unavailable(tmp_path):
+    # eg. the path is too long for a unix socket
+    path = readiness.ready_socket_path(str(tmp_path), 'a' * 200)
+    with readiness.ReadinessListener(path) as listener:
+        assert not listener.listening
+        assert listener.wait(0.01) is None
+
+
+@pytest.mark.only_posix
+def test_systemd_notifier(tmp_path):
+    path = str(tmp_path / 'notify')
+    environ = {'NOTIFY_SOCKET': path, 'WATCHDOG_USEC': '10000000',
+               'OTHER': 'x'}
+    notifier = readiness.SystemdNotifier.from_env(environ)
+    # not inherited by the operation subprocesses
+    assert environ == {'OTHER': 'x'}
+    assert notifier.watchdog_interval == 5
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(path)
+    sock.settimeout(5)
+    try:
+        assert notifier.ready(status='Consuming')
+        assert sock.recv(4096) == b'READY=1\nSTATUS=Consuming\n'
+        assert notifier.watchdog()
+        assert sock.recv(4096) == b'WATCHDOG=1\n'
+    finally:
+        sock.close()
+
+
+def test_systemd_notifier_disabled():
+    notifier = readiness.SystemdNotifier.from_env({})
+    assert not notifier.enabled
+    assert notifier.watchdog_interval is None
+    assert not notifier.ready()
+
+
+def test_systemd_watchdog_other_pid():
+    notifier = readiness.SystemdNotifier.from_env({
+        'NOTIFY_SOCKET': '@notify', 'WATCHDOG_USEC': '10000000',
+        'WATCHDOG_PID': '1'})
+    assert notifier.address == '\0notify'
+    assert notifier.watchdog_interval is None
+
+
+def test_started_listener_receives_event():
+    listener = readiness.AgentStartedListener('agent1')
+    channel = mock.Mock()
+    listener.register(mock.Mock(), channel)
+    bindings = {c[1]['routing_key'] for c in channel.queue_bind.call_args_list}
+    # the started event, and the replies to the pings
+    assert bindings == {readiness.STARTED_ROUTING_KEY, listener.queue}
+    assert not listener.wait(0.01)
+
+    connection = mock.Mock()
+    readiness.publish_started(connection, 'agent1', 'agent1')
+    event = connection.publish.call_args[0][0]
+    assert event['exchange'] == 'agent1'
+    assert event['routing_key'] == readiness.STARTED_ROUTING_KEY
+
+    threading.Timer(0.05, listener.process, [
+        channel, mock.Mock(), mock.Mock(),
+        event['body'].encode('utf-8')]).start()
+    assert listener.wait(5)
+    assert listener.started
+    assert listener.message['name'] == 'agent1'
+
+
+def test_started_listener_ping():
+    listener = readiness.AgentStartedListener('agent1')
+    connection = mock.Mock()
+    listener.register(connection, mock.Mock())
+    listener.ping(10)
+    message = connection.publish.call_args[0][0]
+    assert message['routing_key'] == 'service'
+    assert json.loads(message['body'])['service_task']['task_name'] == 'ping'
+    assert message['properties'].reply_to == listener.queue
+    assert message['properties'].expiration == '10000'
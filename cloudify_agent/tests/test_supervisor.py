@@ -0,0 +1,88 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+
+from cloudify_agent import supervisor
+
+
+@pytest.fixture
+def socket_dir():
+    # not tmp_path, because unix socket paths must be short
+    path = tempfile.mkdtemp(prefix='sup')
+    yield path
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def _wait_for(predicate, timeout=10):
+    end = time.time() + timeout
+    while time.time() < end:
+        if predicate():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def _run_in_thread(sup):
+    thread = threading.Thread(target=sup.run)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+@pytest.mark.only_posix
+def test_restarts_worker(socket_dir):
+    pid_file = os.path.join(socket_dir, 'agent.pid')
+    sup = supervisor.Supervisor(
+        [sys.executable, '-c', 'import sys; sys.exit(3)'],
+        pid_file=pid_file, min_backoff=0.01, max_backoff=0.05)
+    thread = _run_in_thread(sup)
+    assert _wait_for(lambda: sup.restarts >= 3)
+    assert sup.status()['last_exit_code'] == 3
+    with open(pid_file) as f:
+        assert int(f.read()) == os.getpid()
+    sup.stop()
+    thread.join(10)
+    assert not thread.is_alive()
+    assert not os.path.exists(pid_file)
+
+
+@pytest.mark.only_posix
+def test_status_socket(socket_dir):
+    status_socket = os.path.join(socket_dir, 'agent.status')
+    sup = supervisor.Supervisor(
+        [sys.executable, '-c', 'import time; time.sleep(30)'],
+        status_socket=status_socket)
+    thread = _run_in_thread(sup)
+    assert _wait_for(lambda: (supervisor.query_status(status_socket) or
+                              {}).get('running'))
+    status = supervisor.query_status(status_socket)
+    assert status['pid'] == os.getpid()
+    assert status['worker_pid'] == sup._child.pid
+    assert status['restarts'] == 0
+
+    sup.stop()
+    thread.join(10)
+    assert not thread.is_alive()
+    assert sup._child.poll() is not None
+    assert not os.path.exists(status_socket)
+    assert supervisor.query_status(status_socket) is None
+
+
+@pytest.mark.only_posix
+def test_status_socket_unusable(socket_dir):
+    # longer than unix sockets allow
+    status_socket = os.path.join(socket_dir, 'x' * 200, 'agent.status')
+    sup = supervisor.Supervisor(
+        [sys.executable, '-c', 'import time; time.sleep(30)'],
+        status_socket=status_socket)
+    thread = _run_in_thread(sup)
+    # the worker is started anyway
+    assert _wait_for(lambda: sup.status()['running'])
+    sup.stop()
+    thread.join(10)
+    assert not thread.is_alive()
@@ -0,0 +1,122 @@
+import json
+import logging
+import subprocess
+import sys
+
+import pytest
+from unittest import mock
+
+from cloudify_agent import task_logging, worker
+
+
+def _task(task_id='task1'):
+    return {'cloudify_task': {'kwargs': {
+        '__cloudify_context': {'type': 'operation',
+                               'task_id': task_id,
+                               'task_name': 'plugin.task',
+                               'execution_id': 'exc1',
+                               'deployment_id': 'd1'},
+    }}}
+
+
+def _json_logger():
+    logger = logging.getLogger('test_task_logging')
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    logger.handlers = [handler]
+    return logger, records
+
+
+def test_json_formatter():
+    record = logging.LogRecord('worker', logging.INFO, __file__, 1,
+                               'Finished %s', ('handling', ), None)
+    record.task = {'execution_id': 'exc1', 'rc': 0}
+    formatted = json.loads(task_logging.JSONFormatter().format(record))
+    assert formatted['message'] == 'Finished handling'
+    assert formatted['level'] == 'INFO'
+    assert formatted['execution_id'] == 'exc1'
+    assert formatted['rc'] == 0
+
+
+def test_from_env():
+    logger = mock.Mock()
+    task_logger = task_logging.TaskLogger.from_env(logger, {
+        task_logging.LOG_FORMAT_ENV: 'json',
+        task_logging.TASK_LOG_SAMPLE_RATE_ENV: '0.5',
+    })
+    assert task_logger.json_format
+    assert task_logger.sample_rate == 0.5
+
+    task_logger = task_logging.TaskLogger.from_env(logger, {
+        task_logging.LOG_FORMAT_ENV: 'xml',
+        task_logging.TASK_LOG_SAMPLE_RATE_ENV: 'half',
+    })
+    assert not task_logger.json_format
+    assert task_logger.sample_rate == 1.0
+
+
+def test_handle_task_json_fields():
+    logger, records = _json_logger()
+    consumer = worker.CloudifyOperationConsumer(
+        None, task_logger=task_logging.TaskLogger(logger, 'json'))
+    with mock.patch.object(consumer, '_validate_not_cancelled'), \
+            mock.patch.object(consumer, 'dispatch_to_subprocess',
+                              return_value=42):
+        consumer.handle_task(_task())
+
+    assert [r.getMessage() for r in records] == \
+        ['Started handling', 'Finished handling']
+    finished = records[1].task
+    assert finished['execution_id'] == 'exc1'
+    assert finished['deployment'] == 'd1'
+    assert finished['task'] == 'plugin.task'
+    assert finished['outcome'] == 'success'
+    assert finished['duration'] >= 0
+
+
+def test_sampling_logs_errors():
+    logger, records = _json_logger()
+    consumer = worker.CloudifyOperationConsumer(
+        None, task_logger=task_logging.TaskLogger(logger, 'json', 0))
+    with mock.patch.object(worker, 'logger', create=True), \
+            mock.patch.object(consumer, '_validate_not_cancelled'), \
+            mock.patch.object(consumer, 'dispatch_to_subprocess',
+                              side_effect=[42, RuntimeError()]):
+        consumer.handle_task(_task('task1'))
+        assert records == []
+        consumer.handle_task(_task('task2'))
+    assert len(records) == 1
+    assert records[0].task['task_id'] == 'task2'
+    assert records[0].task['outcome'] == 'error'
+
+
+@pytest.mark.only_posix
+def test_poll_rusage():
+    p = subprocess.Popen([sys.executable, '-c', 'import sys; sys.exit(3)'])
+    returncode = None
+    while returncode is None:
+        returncode, rusage = worker._poll(p)
+    assert returncode == p.returncode == 3
+    assert task_logging.rusage_fields(rusage)['utime'] > 0
+
+
+@pytest.mark.only_posix
+def test_poll_while_waited_for():
+    p = subprocess.Popen([sys.executable, '-c', 'import sys; sys.exit(3)'])
+    with p._waitpid_lock:
+        # another thread is in .wait(): don't reap the process under it
+        assert worker._poll(p) == (None, None)
+    p.wait()
+    assert worker._poll(p) == (3, None)
+
+
+def test_default_task_logger(monkeypatch):
+    monkeypatch.setenv('AGENT_NAME', 'agent1')
+    consumer = worker.CloudifyOperationConsumer('queue', 1)
+    assert consumer._task_logger.logger.name == 'worker.agent1'
+    consumer = worker.CloudifyOperationConsumer(
+        'queue', 1, agent_env={'AGENT_NAME': 'agent2'})
+    assert consumer._task_logger.logger.name == 'worker.agent2'
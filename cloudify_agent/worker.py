@@ -22,21 +22,29 @@ import argparse
 import traceback
 import tempfile
 import json
+import queue
 import subprocess
 import shutil
 import threading
 from contextlib import contextmanager
 
-from cloudify import plugin_installer
+from cloudify_agent import liveness, readiness
 from cloudify_agent.api import utils
 from cloudify_agent.api.factory import DaemonFactory
+from cloudify_agent.journal import TaskJournal
+from cloudify_agent.load import PluginCounter, host_load
+from cloudify_agent.task_logging import (
+    TaskLogger,
+    rusage_fields,
+    use_json_format,
+)
 
 from cloudify_rest_client.exceptions import (
     UserUnauthorizedError,
     CloudifyClientError
 )
 
-from cloudify import constants, exceptions, state
+from cloudify import broker_config, constants, exceptions, state
 from cloudify.context import CloudifyContext
 from cloudify.models_states import ExecutionState
 from cloudify.logs import setup_agent_logger
@@ -49,7 +57,6 @@ from cloudify.amqp_client import (
     AMQPConnection, TaskConsumer, NO_RESPONSE, STOP_AGENT
 )
 from cloudify.utils import get_manager_name, get_python_path
-from cloudify_agent.operations import install_plugins, uninstall_plugins
 
 try:
     from packaging.version import parse as parse_version
@@ -59,6 +66,14 @@ except ImportError:
 SYSTEM_DEPLOYMENT = '__system__'
 ENV_ENCODING = 'utf-8'  # encoding for env variables
 DEFAULT_MAX_WORKERS = 10
+# when moving over to new brokers, how long to try connecting to them,
+# before giving up and staying on the current connection
+BROKER_SWITCH_TIMEOUT = 30
+# after cancelling the consumers on the old connection, wait at most this
+# long for the tasks that were already received to send their acks on it
+BROKER_SWITCH_ACK_TIMEOUT = 5
+# and then, at most this long for the old connection to close
+BROKER_SWITCH_CLOSE_TIMEOUT = 5
 CLOUDIFY_DISPATCH = 'CLOUDIFY_DISPATCH'
 PREINSTALLED_PLUGINS = [
     'agent',
@@ -72,6 +87,77 @@ PREINSTALLED_PLUGINS = [
 ]
 
 
+class _AgentEnvironment(object):
+    """Applies the environment of an agent to the worker process.
+
+    When a worker serves several agents, each agent has its own settings
+    (plugins root, name, log dir...), which are passed to the operation
+    subprocesses in their env. But some things run in the worker process
+    itself, and read these settings from os.environ: mostly, installing
+    plugins. Such code runs in `.applied(env)`: threads that apply the
+    same environment run together, while threads that apply a different
+    one wait for them to finish.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._env = None
+        self._saved = None
+        self._holders = 0
+
+    @contextmanager
+    def applied(self, env):
+        if not env:
+            yield
+            return
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self._holders == 0 or self._env == env)
+            if self._holders == 0:
+                self._env = env
+                self._saved = {key: os.environ.get(key) for key in env}
+                os.environ.update(env)
+            self._holders += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._holders -= 1
+                if self._holders == 0:
+                    for key, value in self._saved.items():
+                        if value is None:
+                            os.environ.pop(key, None)
+                        else:
+                            os.environ[key] = value
+                    self._env = self._saved = None
+                    self._cond.notify_all()
+
+
+agent_environment = _AgentEnvironment()
+# the environment of the process, as it was when it started: when serving
+# several agents, os.environ is changed by agent_environment, while the
+# threads of other agents build the env of their operations
+_PROCESS_ENV = dict(os.environ)
+# the settings of an agent that the code running in the worker process
+# reads from the environment
+IN_PROCESS_ENV_KEYS = [
+    constants.REST_HOST_KEY,
+    'AGENT_NAME',
+    'AGENT_WORK_DIR',
+    'AGENT_LOG_DIR',
+    constants.LOCAL_REST_CERT_FILE_KEY,
+    constants.LOCAL_RESOURCES_ROOT_ENV_KEY,
+    'CFY_PLUGINS_ROOT',
+]
+
+
+def _in_process_env(agent_env):
+    if not agent_env:
+        return None
+    return {key: agent_env[key] for key in IN_PROCESS_ENV_KEYS
+            if key in agent_env}
+
+
 class LockedFile(object):
     """Like a writable file object, but writes are under a lock.
 
@@ -160,15 +246,152 @@ class TimeoutWrapper(object):
             self.timer.cancel()
 
 
-class CloudifyOperationConsumer(TaskConsumer):
+class _ConsumerRetired(Exception):
+    """Stops the watchdog thread of a consumer that was retired"""
+
+
+class _TrackedAcks(object):
+    """The connection of a consumer, which tells the consumer about acks.
+
+    Everything but the acks goes straight to the connection.
+    """
+
+    def __init__(self, connection, consumer):
+        self._connection = connection
+        self._consumer = consumer
+
+    def ack(self, channel, delivery_tag, **kwargs):
+        try:
+            return self._connection.ack(channel, delivery_tag, **kwargs)
+        finally:
+            self._consumer._acked(delivery_tag)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+class _SwitchableConsumer(object):
+    """A consumer that can be moved off its connection.
+
+    When the worker moves over to new brokers, the consumers on the old
+    connection are retired: they stop receiving tasks, and the tasks they
+    are already running send their responses on another connection.
+    The consumer keeps track of the tasks it started that didn't send
+    their ack yet, so that the old connection is only closed once they did.
+    """
+
+    def __init__(self, *args, **kwargs):
+        # runs the tasks, instead of a new thread for every task; shared by
+        # the consumers of all the agents served by a worker
+        self._executor = kwargs.pop('executor', None)
+        # set before the TaskConsumer watchdog thread is started
+        self._retired = False
+        self._unacked = set()
+        self._acks_cond = threading.Condition()
+        super(_SwitchableConsumer, self).__init__(*args, **kwargs)
+
+    def register(self, connection, channel):
+        if self._retired:
+            # the old connection reconnected while being closed: the tasks
+            # are consumed on the new connection already
+            return
+        super(_SwitchableConsumer, self).register(connection, channel)
+        self._connection = _TrackedAcks(connection, self)
+
+    def _run_task(self, task_args, *args, **kwargs):
+        with self._acks_cond:
+            self._unacked.add(task_args[3])  # the delivery tag
+        # tasks that the TaskConsumer watchdog runs over the threadpool
+        # size always get a thread of their own: they are what keeps tasks
+        # that wait for other tasks from deadlocking
+        threadpool_worker = kwargs.get(
+            'threadpool_worker', args[0] if args else True)
+        if self._executor is None or not threadpool_worker:
+            super(_SwitchableConsumer, self)._run_task(
+                task_args, *args, **kwargs)
+            return
+        # the same function that TaskConsumer._run_task runs in a thread;
+        # cloudify-common before 7.0.5 has no _threadpool_worker
+        target = getattr(self, '_threadpool_worker', self._process_message)
+        self._executor.submit(target, *task_args)
+
+    def _acked(self, delivery_tag):
+        with self._acks_cond:
+            self._unacked.discard(delivery_tag)
+            self._acks_cond.notify_all()
+
+    def retire(self, connection):
+        """Stop consuming, and send everything on connection from now on.
+
+        Call this after the consumer was cancelled on its channel.
+        """
+        self._retired = True
+        self._connection = _TrackedAcks(connection, self)
+        # not acked yet, so they will be requeued when the old
+        # connection is closed
+        self._tasks_buffer.clear()
+        self._channel = None
+
+    def wait_for_acks(self, timeout):
+        """Wait for the tasks that were started to send their acks.
+
+        :return: whether all the acks were sent
+        """
+        with self._acks_cond:
+            return self._acks_cond.wait_for(
+                lambda: not self._unacked, timeout)
+
+    def _is_watchdog_idle(self):
+        if self._retired:
+            raise _ConsumerRetired()
+        return super(_SwitchableConsumer, self)._is_watchdog_idle()
+
+    def _watch_tasks_processing(self):
+        try:
+            super(_SwitchableConsumer, self)._watch_tasks_processing()
+        except _ConsumerRetired:
+            pass
+
+
+class CloudifyOperationConsumer(_SwitchableConsumer, TaskConsumer):
     routing_key = 'operation'
+    # the cloudify-common version of the plugin venvs, shared by all the
+    # consumers in the process
+    _plugin_version_cache = {}
 
     def __init__(self, *args, **kwargs):
+        # when serving several agents: the env of this consumer's agent
+        self._agent_env = kwargs.pop('agent_env', None) or {}
         self._process_registry = kwargs.pop('registry', None)
-        self._plugin_version_cache = {}
+        self._journal = kwargs.pop('journal', None)
+        self._task_logger = kwargs.pop('task_logger', None) or \
+            TaskLogger(logging.getLogger('worker.{0}'.format(
+                self._agent_env.get('AGENT_NAME') or
+                os.environ.get('AGENT_NAME'))))
+        # the returncode and resource usage of the subprocess of the task
+        # that is running in the current thread
+        self._task_stats = threading.local()
+        self._in_flight = 0
+        self._in_flight_lock = threading.Lock()
         super(CloudifyOperationConsumer, self).__init__(*args, **kwargs)
 
-    def _print_task(self, ctx, action, status=None):
+    _STATUS_MESSAGES = {
+        'success': '\n\tStatus: SUCCESS - result: %(result)s',
+        'error': '\n\tStatus: ERROR - result: %(result)s',
+        'retry': '\n\tStatus: Operation rescheduled',
+        'stop': '\n\tStatus: Stopping agent',
+    }
+
+    def _print_task(self, ctx, action, outcome=None, result=None,
+                    duration=None):
+        """Log the start or the finish of handling an operation.
+
+        :param outcome: for finished operations: one of success, error,
+                        retry, stop
+        :param result: the operation result, only formatted if it is
+                       actually logged
+        :param duration: how long handling the operation took, in seconds
+        """
         if ctx.task_type in ['workflow', 'hook']:
             prefix = '{0} {1}'.format(action, ctx.task_type)
             suffix = ''
@@ -179,21 +402,38 @@ class CloudifyOperationConsumer(TaskConsumer):
             prefix = ''
             suffix = ''
 
-        if status:
-            suffix += '\n\tStatus: {0}'.format(status)
-
-        logger.info(
+        fields = {
+            'execution_id': ctx.execution_id,
+            'workflow_id': ctx.workflow_id,
+            'task_id': ctx.task_id,
+            'task': ctx.task_name,
+            'deployment': ctx.deployment.id,
+            'tenant': ctx.tenant_name,
+            'queue': ctx.task_target,
+        }
+        if outcome:
+            fields.update({
+                'outcome': outcome,
+                'duration': duration,
+                'rc': getattr(self._task_stats, 'rc', None),
+                'rusage': rusage_fields(
+                    getattr(self._task_stats, 'rusage', None)),
+            })
+        self._task_logger.log(
+            action, fields,
             '\n\t%(prefix)s on queue `%(queue)s` on tenant `%(tenant)s`:\n'
             '\tTask name: %(name)s\n'
             '\tExecution ID: %(execution_id)s\n'
-            '\tWorkflow ID: %(workflow_id)s%(suffix)s\n',
+            '\tWorkflow ID: %(workflow_id)s%(suffix)s' +
+            self._STATUS_MESSAGES.get(outcome, '') + '\n',
             {'tenant': ctx.tenant_name,
              'prefix': prefix,
              'name': ctx.task_name,
              'queue': ctx.task_target,
              'execution_id': ctx.execution_id,
              'workflow_id': ctx.workflow_id,
-             'suffix': suffix})
+             'suffix': suffix,
+             'result': result})
 
     @staticmethod
     def _validate_not_cancelled(ctx):
@@ -292,41 +532,96 @@ class CloudifyOperationConsumer(TaskConsumer):
             self._plugin_version_cache[executable] = version
         return self._plugin_version_cache[executable]
 
+    def load(self):
+        """The operations currently handled by this consumer."""
+        in_flight = self._in_flight
+        return {
+            'in_flight': in_flight,
+            'max_workers': self.threadpool_size,
+            'free_slots': max(self.threadpool_size - in_flight, 0),
+            # received, but waiting for a free slot
+            'queued': len(self._tasks_buffer),
+        }
+
     def handle_task(self, full_task):
+        with self._in_flight_lock:
+            self._in_flight += 1
+        try:
+            return self._handle_operation(full_task)
+        finally:
+            with self._in_flight_lock:
+                self._in_flight -= 1
+
+    def _handle_operation(self, full_task):
         task = full_task['cloudify_task']
         raw_ctx = task['kwargs'].pop('__cloudify_context')
         ctx = CloudifyContext(raw_ctx)
         task_args = task.get('args', [])
         task_kwargs = task['kwargs']
 
-        self._print_task(ctx, 'Started handling')
+        # decided once, so that either both the start and the finish of
+        # the task are logged, or neither
+        sampled = self._task_logger.sample()
+
+        self._task_stats.rc = None
+        self._task_stats.rusage = None
+        started = time.monotonic()
         try:
+            # a cancelled execution gets no reply from the journal either
             self._validate_not_cancelled(ctx)
+            journaled = self._journaled_result(ctx)
+            if journaled is not None:
+                if sampled:
+                    self._print_task(ctx, 'Replying from journal to')
+                return journaled
+            if sampled:
+                self._print_task(ctx, 'Started handling')
+            if self._journal and ctx.task_id:
+                self._journal.started(ctx.task_id)
             rv = self.dispatch_to_subprocess(ctx, task_args, task_kwargs)
             result = {'ok': True, 'result': rv}
-            status = 'SUCCESS - result: {0}'.format(result)
+            outcome = 'success'
         except exceptions.StopAgent:
             result = STOP_AGENT
-            status = 'Stopping agent'
+            outcome = 'stop'
         except exceptions.OperationRetry as e:
             result = {'ok': False, 'error': serialize_known_exception(e)}
-            status = 'Operation rescheduled'
+            outcome = 'retry'
         except exceptions.ProcessKillCancelled:
             self._print_task(ctx, 'Task kill-cancelled')
             return NO_RESPONSE
         except Exception as e:
             error = serialize_known_exception(e)
             result = {'ok': False, 'error': error}
-            status = 'ERROR - result: {0}'.format(result)
+            outcome = 'error'
             logger.error(
                 'ERROR - caught: %r%s',
                 e,
                 '\n{0}'.format(error['traceback'])
                 if error.get('traceback') else ''
             )
-        self._print_task(ctx, 'Finished handling', status)
+        if sampled or outcome == 'error':
+            self._print_task(ctx, 'Finished handling', outcome, result,
+                             duration=time.monotonic() - started)
+        if self._journal and ctx.task_id and isinstance(result, dict):
+            self._journal.finished(ctx.task_id, result)
         return result
 
+    def _journaled_result(self, ctx):
+        """The stored result of this task, if it had already finished.
+
+        The task might be delivered again, if the worker died before the
+        response was sent. In that case, reply with the result stored
+        in the journal, instead of running the operation again.
+        """
+        if not self._journal or not ctx.task_id:
+            return None
+        try:
+            return self._journal.get_result(ctx.task_id)
+        except Exception as e:
+            logger.warning('Could not read the task journal: %s', e)
+            return None
+
     def dispatch_to_subprocess(self, ctx, task_args, task_kwargs):
         # inputs.json, output.json and output are written to a temporary
         # directory that only lives during the lifetime of the subprocess
@@ -335,10 +630,12 @@ class CloudifyOperationConsumer(TaskConsumer):
             env = self._build_subprocess_env(ctx)
 
             if self._uses_external_plugin(ctx):
-                plugin_dir = self._extract_plugin_dir(ctx)
-                if plugin_dir is None:
-                    self._install_plugin(ctx)
+                with agent_environment.applied(
+                        _in_process_env(self._agent_env)):
                     plugin_dir = self._extract_plugin_dir(ctx)
+                    if plugin_dir is None:
+                        self._install_plugin(ctx)
+                        plugin_dir = self._extract_plugin_dir(ctx)
                 if plugin_dir is None:
                     raise RuntimeError(
                         'Plugin was not installed: {0}'
@@ -392,7 +689,11 @@ class CloudifyOperationConsumer(TaskConsumer):
                 .format(dispatch_output['type']))
 
     def _build_subprocess_env(self, ctx):
-        env = os.environ.copy()
+        if self._agent_env:
+            env = dict(_PROCESS_ENV)
+            env.update(self._agent_env)
+        else:
+            env = os.environ.copy()
 
         # marker for code that only gets executed when inside the dispatched
         # subprocess, see usage in the imports section of this module
@@ -431,6 +732,7 @@ class CloudifyOperationConsumer(TaskConsumer):
             else:
                 dep_id = None
                 bp_id = None
+            from cloudify import plugin_installer
             plugin_installer.install(
                 ctx.plugin._plugin_context,
                 deployment_id=dep_id,
@@ -443,14 +745,18 @@ class CloudifyOperationConsumer(TaskConsumer):
         if self._process_registry:
             self._process_registry.register(ctx.execution_id, p)
 
+        rusage = None
         with TimeoutWrapper(ctx, p) as timeout_wrapper:
             with self.logfile(ctx) as f:
                 while True:
                     line = p.stdout.readline()
                     if line:
                         f.write(line)
-                    if p.poll() is not None:
+                    returncode, rusage = _poll(p)
+                    if returncode is not None:
                         break
+        self._task_stats.rc = p.returncode
+        self._task_stats.rusage = rusage
 
         cancelled = False
         if self._process_registry:
@@ -488,13 +794,36 @@ class CloudifyOperationConsumer(TaskConsumer):
             # in that case, the deployment id will be None
             handler_context = handler_context or SYSTEM_DEPLOYMENT
 
-        log_name = os.path.join(os.environ.get('AGENT_LOG_DIR', ''), 'logs',
+        log_dir = self._agent_env.get('AGENT_LOG_DIR') or \
+            os.environ.get('AGENT_LOG_DIR', '')
+        log_name = os.path.join(log_dir, 'logs',
                                 '{0}.log'.format(handler_context))
 
         return LockedFile.open(log_name)
 
 
-class ServiceTaskConsumer(TaskConsumer):
+class _EmptyID(object):
+    id = None
+
+
+class PluginInstallCloudifyContext(object):
+    """A CloudifyContext that has just enough data to install plugins"""
+    def __init__(self, rest_host, rest_port, tenant, rest_token,
+                 bypass_maintenance=False):
+        self.rest_host = rest_host
+        self.rest_port = rest_port
+        self.tenant_name = tenant['name']
+        self.rest_token = rest_token
+        self.execution_token = None
+        self.logger = logging.getLogger('plugin')
+        # deployment/blueprint are not defined for force-installs,
+        # but the ctx demands they be objects with an .id
+        self.deployment = _EmptyID()
+        self.blueprint = _EmptyID()
+        self.bypass_maintenance = bypass_maintenance
+
+
+class ServiceTaskConsumer(_SwitchableConsumer, TaskConsumer):
     routing_key = 'service'
     service_tasks = {
         'ping': 'ping_task',
@@ -503,11 +832,20 @@ class ServiceTaskConsumer(TaskConsumer):
         'replace-ca-certs': 'replace_ca_certs_task',
         'install-plugin': 'install_plugin_task',
         'uninstall-plugin': 'uninstall_plugin_task',
+        'install-plugins': 'install_plugins_task',
+        'uninstall-plugins': 'uninstall_plugins_task',
     }
 
     def __init__(self, name, *args, **kwargs):
         self.name = name
         self._operation_registry = kwargs.pop('operation_registry')
+        self._on_cluster_update = kwargs.pop('on_cluster_update', None)
+        self._operation_consumer = kwargs.pop('operation_consumer', None)
+        # shared with the operation consumer, see _update_agent_env
+        self._agent_env = kwargs.pop('agent_env', None)
+        self._in_process_env = _in_process_env(self._agent_env)
+        self._plugin_counter = PluginCounter(
+            (self._in_process_env or {}).get('CFY_PLUGINS_ROOT'))
         super(ServiceTaskConsumer, self).__init__(*args, **kwargs)
 
     def handle_task(self, full_task):
@@ -516,86 +854,121 @@ class ServiceTaskConsumer(TaskConsumer):
         task_name = task['task_name']
         kwargs = task.get('kwargs') or {}
 
-        logger.info(
-            'Received `{0}` service task with kwargs: {1}'.format(
-                task_name, kwargs))
+        # kwargs and results can be large (eg. whole plugin dicts), so
+        # they are only logged on debug
+        logger.info('Received `%s` service task', task_name)
+        logger.debug('Service task `%s` kwargs: %s', task_name, kwargs)
         task_handler = getattr(self, self.service_tasks[task_name])
         result = task_handler(**kwargs)
-        logger.info('Result: {0}'.format(result))
+        logger.debug('Service task `%s` result: %s', task_name, result)
         return result
 
     def ping_task(self):
-        return {'time': time.time()}
+        """Reply with the current time, and the load of the agent.
+
+        The load allows picking the least loaded agent, and noticing
+        when an agent is saturated, not only whether it is alive.
+        """
+        load = host_load()
+        load['plugins'] = self._plugin_counter.count()
+        if self._operation_consumer is not None:
+            load.update(self._operation_consumer.load())
+        return {'time': time.time(), 'load': load}
 
     def install_plugin_task(self, plugin, rest_token, tenant,
                             rest_host, rest_port=53333, target=None,
                             bypass_maintenance=False):
+        if not self._is_target(target):
+            return
 
-        if target:
-            # target was provided, so this is to be installed only on the
-            # specified workers, but might have been received by us because
-            # it was sent to a fanout exchange.
-            # This only matters for mgmtworkers, because agents have no
-            # fanout exchanges.
-            if get_manager_name() not in target:
-                return
-
-        class _EmptyID(object):
-            id = None
-
-        class PluginInstallCloudifyContext(object):
-            """A CloudifyContext that has just enough data to install plugins
-            """
-            def __init__(self):
-                self.rest_host = rest_host
-                self.rest_port = rest_port
-                self.tenant_name = tenant['name']
-                self.rest_token = rest_token
-                self.execution_token = None
-                self.logger = logging.getLogger('plugin')
-                # deployment/blueprint are not defined for force-installs,
-                # but the ctx demands they be objects with an .id
-                self.deployment = _EmptyID()
-                self.blueprint = _EmptyID()
-                self.bypass_maintenance = bypass_maintenance
-
-        with current_ctx.push(PluginInstallCloudifyContext()):
-            install_plugins([plugin])
+        # imported here, because this imports the agent installer as well
+        from cloudify_agent.operations import install_plugins
+        ctx = PluginInstallCloudifyContext(
+            rest_host, rest_port, tenant, rest_token, bypass_maintenance)
+        try:
+            with agent_environment.applied(self._in_process_env), \
+                    current_ctx.push(ctx):
+                install_plugins([plugin])
+        finally:
+            self._plugin_counter.invalidate()
 
     def uninstall_plugin_task(self, plugin, rest_token, tenant,
                               rest_host, rest_port=53333, target=None,
                               bypass_maintenance=False):
+        if not self._is_target(target):
+            return
 
-        if target:
-            # target was provided, so this is to be installed only on the
-            # specified workers, but might have been received by us because
-            # it was sent to a fanout exchange.
-            # This only matters for mgmtworkers, because agents have no
-            # fanout exchanges.
-            if get_manager_name() not in target:
-                return
+        from cloudify_agent.operations import uninstall_plugins
+        ctx = PluginInstallCloudifyContext(
+            rest_host, rest_port, tenant, rest_token, bypass_maintenance)
+        try:
+            with agent_environment.applied(self._in_process_env), \
+                    current_ctx.push(ctx):
+                uninstall_plugins([plugin])
+        finally:
+            self._plugin_counter.invalidate()
 
-        class _EmptyID(object):
-            id = None
-
-        class PluginUninstallCloudifyContext(object):
-            """A CloudifyContext that has just enough data to uninstall plugins
-            """
-            def __init__(self):
-                self.rest_host = rest_host
-                self.rest_port = rest_port
-                self.tenant_name = tenant['name']
-                self.rest_token = rest_token
-                self.execution_token = None
-                self.logger = logging.getLogger('plugin')
-                # deployment/blueprint are not defined for force-installs,
-                # but the ctx demands they be objects with an .id
-                self.deployment = _EmptyID()
-                self.blueprint = _EmptyID()
-                self.bypass_maintenance = bypass_maintenance
-
-        with current_ctx.push(PluginUninstallCloudifyContext()):
-            uninstall_plugins([plugin])
+    def install_plugins_task(self, plugins, rest_token, tenant,
+                             rest_host, rest_port=53333, target=None,
+                             bypass_maintenance=False, max_parallel=None):
+        """Install several plugins, in parallel.
+
+        Unlike install-plugin, this doesn't fail if a plugin fails to
+        install: the result of every plugin is returned instead, as
+        {'plugins': [{'name':, 'success':, 'error':, 'duration':}, ...]}
+        """
+        if not self._is_target(target):
+            return
+
+        from cloudify import plugin_installer
+        from cloudify_agent.api.plugins import parallel
+        return self._run_for_plugins(
+            plugins, 'Installing',
+            lambda plugin: plugin_installer.install(
+                plugin, deployment_id=None, blueprint_id=None),
+            PluginInstallCloudifyContext(
+                rest_host, rest_port, tenant, rest_token,
+                bypass_maintenance),
+            max_parallel, parallel.install_key)
+
+    def uninstall_plugins_task(self, plugins, rest_token, tenant,
+                               rest_host, rest_port=53333, target=None,
+                               bypass_maintenance=False, max_parallel=None):
+        """Uninstall several plugins, in parallel.
+
+        Returns the result of every plugin, same as install-plugins.
+        """
+        if not self._is_target(target):
+            return
+
+        from cloudify import plugin_installer
+        from cloudify_agent.api.plugins import parallel
+        return self._run_for_plugins(
+            plugins, 'Uninstalling', plugin_installer.uninstall,
+            PluginInstallCloudifyContext(
+                rest_host, rest_port, tenant, rest_token,
+                bypass_maintenance),
+            max_parallel, parallel.uninstall_dir)
+
+    def _run_for_plugins(self, plugins, action, func, ctx, max_parallel,
+                         key):
+        from cloudify_agent.api.plugins import parallel
+        try:
+            with agent_environment.applied(self._in_process_env), \
+                    current_ctx.push(ctx):
+                results = parallel.run_for_plugins(
+                    plugins, func, action, ctx.logger, max_parallel, key)
+        finally:
+            self._plugin_counter.invalidate()
+        return {'plugins': parallel.result_dicts(results)}
+
+    def _is_target(self, target):
+        # if target was provided, the plugins are to be (un)installed only
+        # on the specified workers, but might have been received by us
+        # because it was sent to a fanout exchange.
+        # This only matters for mgmtworkers, because agents have no
+        # fanout exchanges.
+        return not target or get_manager_name() in target
 
     def cluster_update_task(self, brokers, broker_ca, managers, manager_ca):
         """Update the running agent with the new cluster.
@@ -603,26 +976,47 @@ class ServiceTaskConsumer(TaskConsumer):
         When a node is added or removed from the cluster, the agent will
         receive the current cluster nodes in this task. We need to update
         both the current process envvars, the cert files, and all the
-        daemon config files.
+        daemon config files, and then move the worker over to the new
+        brokers.
         """
         self._assert_name('cluster-update')
-        factory = DaemonFactory()
-        daemon = factory.load(self.name)
+        self._update_agent_env(constants.REST_HOST_KEY, u','.join(managers))
 
-        os.environ[constants.REST_HOST_KEY] = \
-            u','.join(managers).encode('utf-8')
+        with agent_environment.applied(self._in_process_env):
+            factory = DaemonFactory()
+            daemon = factory.load(self.name)
 
-        with open(daemon.local_rest_cert_file, 'w') as f:
-            f.write(manager_ca)
-        with open(daemon.broker_ssl_cert_path, 'w') as f:
-            f.write(broker_ca)
+            with open(daemon.local_rest_cert_file, 'w') as f:
+                f.write(manager_ca)
+            with open(daemon.broker_ssl_cert_path, 'w') as f:
+                f.write(broker_ca)
 
-        daemon.rest_host = managers
-        daemon.broker_ip = brokers
-        daemon.create_broker_conf()
-        daemon.create_config()
+            daemon.rest_host = managers
+            daemon.broker_ip = brokers
+            daemon.create_broker_conf()
+            daemon.create_config()
 
-        factory.save(daemon)
+            factory.save(daemon)
+        if self._on_cluster_update:
+            self._on_cluster_update()
+
+    def _update_agent_env(self, key, value):
+        """Set an environment variable of this agent.
+
+        When the worker serves only this agent, that is the process
+        environment. Otherwise, it's only set in the environment of the
+        operations of this agent, and of the code that runs in the worker
+        process with this agent's environment applied.
+        """
+        if self._agent_env is None:
+            os.environ[key] = value
+            return
+        # the dict is shared with the operation consumer: update it in place
+        self._agent_env[key] = value
+        # ...but replace this one, because it might be applied right now
+        in_process_env = dict(self._in_process_env or {})
+        in_process_env[key] = value
+        self._in_process_env = in_process_env
 
     def cancel_operation_task(self, execution_id):
         logger.info('Cancelling task %s', execution_id)
@@ -652,6 +1046,41 @@ class ServiceTaskConsumer(TaskConsumer):
                                'set'.format(command_name))
 
 
+def _poll(process):
+    """Like process.poll(), but also returns the process resource usage.
+
+    The process is reaped the same way Popen does it, holding its waitpid
+    lock, so that this doesn't race with .poll(), .wait() or .send_signal()
+    called from other threads.
+
+    :return: a tuple of the returncode (None if the process is still
+             running), and the resource usage of the process, if it has
+             finished, and the resource usage is available.
+    """
+    if not hasattr(os, 'wait4') or process.returncode is not None or \
+            not isinstance(process, subprocess.Popen):
+        return process.poll(), None
+    if not process._waitpid_lock.acquire(False):
+        # another thread is waiting for the process: it sets the
+        # returncode, which the next poll returns
+        return None, None
+    try:
+        if process.returncode is not None:
+            return process.returncode, None
+        try:
+            pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+        except ChildProcessError:
+            # the status is gone, eg. SIGCHLD is ignored: same as Popen
+            process.returncode = 0
+            return process.returncode, None
+        if pid != process.pid:
+            return None, None
+        process._handle_exitstatus(status)
+        return process.returncode, rusage
+    finally:
+        process._waitpid_lock.release()
+
+
 def _setup_excepthook(daemon_name):
     # Setting a new exception hook to catch any exceptions
     # on agent startup and write them to a file. This file
@@ -726,20 +1155,335 @@ class ProcessRegistry(object):
         return execution_id in self._cancelled
 
 
-def make_amqp_worker(args):
-    operation_registry = ProcessRegistry()
-    handlers = [
-        CloudifyOperationConsumer(args.queue, args.max_workers,
-                                  registry=operation_registry),
+def _open_task_journal(daemon_name):
+    if not daemon_name:
+        return None
+    try:
+        return TaskJournal.for_daemon(
+            utils.internal.get_daemon_storage_dir(), daemon_name)
+    except Exception as e:
+        logger.warning('Could not open the task journal, operations '
+                       'will not be journaled: %s', e)
+        return None
+
+
+def make_handlers(args, journal=None, task_logger=None,
+                  operation_registry=None, on_cluster_update=None,
+                  agent_env=None, executor=None):
+    if operation_registry is None:
+        operation_registry = ProcessRegistry()
+    operation_consumer = CloudifyOperationConsumer(
+        args.queue, args.max_workers,
+        registry=operation_registry,
+        journal=journal,
+        task_logger=task_logger,
+        agent_env=agent_env,
+        executor=executor)
+    return [
+        operation_consumer,
         ServiceTaskConsumer(args.name, args.queue, args.max_workers,
-                            operation_registry=operation_registry),
+                            operation_registry=operation_registry,
+                            on_cluster_update=on_cluster_update,
+                            operation_consumer=operation_consumer,
+                            agent_env=agent_env,
+                            executor=executor),
     ]
 
-    return AMQPConnection(handlers=handlers,
+
+def make_amqp_worker(args, journal=None, task_logger=None):
+    return AMQPConnection(handlers=make_handlers(args, journal, task_logger),
                           name=args.name,
                           connect_timeout=None)
 
 
+class _ConnectionClosed(Exception):
+    """The connection was closed while it was reconnecting"""
+
+
+class _WorkerConnection(AMQPConnection):
+    """An AMQPConnection that stops reconnecting once it is closed.
+
+    The consume loop of AMQPConnection reconnects until it succeeds, which,
+    with no connect timeout, is forever, if the brokers are gone. Closing
+    this connection makes the loop give up, and closing can be waited for
+    with a timeout.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._closing = False
+        super(_WorkerConnection, self).__init__(*args, **kwargs)
+
+    def _get_pika_connection(self, params, deadline=None):
+        if self._closing:
+            raise _ConnectionClosed()
+        connection = super(_WorkerConnection, self)._get_pika_connection(
+            params, deadline)
+        if connection is not None and self._closing:
+            connection.close()
+            raise _ConnectionClosed()
+        return connection
+
+    def consume(self):
+        try:
+            super(_WorkerConnection, self).consume()
+        except _ConnectionClosed:
+            logger.debug('Connection closed while reconnecting')
+
+    def close(self, wait=True, timeout=None):
+        """Close the connection.
+
+        :param wait: wait for the consumer thread to exit
+        :param timeout: wait at most this long
+        :return: whether the consumer thread has exited
+        """
+        self._closing = True
+        consumer_thread = self._consumer_thread
+        super(_WorkerConnection, self).close(wait=False)
+        if not wait or consumer_thread is None:
+            return True
+        consumer_thread.join(timeout)
+        if consumer_thread.is_alive():
+            return False
+        self._consumer_thread = None
+        return True
+
+
+class _SwitchedConnection(object):
+    """The connection of consumers that were moved over to new brokers.
+
+    Acks must be sent on the channel that the message was received on,
+    so they still go to the old connection, until it is closed. Everything
+    else (responses, deleting reply queues) goes to the new connection.
+    """
+
+    def __init__(self, old_connection, new_connection):
+        self._old = old_connection
+        self._new = new_connection
+        self._old_closed = False
+        self._lock = threading.Lock()
+
+    def ack(self, channel, delivery_tag, wait=True, timeout=None):
+        with self._lock:
+            if self._old_closed:
+                # the message was requeued when the connection was closed,
+                # and it will be delivered again
+                logger.warning('Not sending ack for %s: the connection to '
+                               'the old brokers is already closed',
+                               delivery_tag)
+                return
+            # acks that were queued before the old connection is closed
+            # are sent when it closes, so there's no need to wait for them
+            self._old.ack(channel, delivery_tag, wait=False)
+
+    def close_old(self, timeout=None):
+        """Close the old connection, waiting at most timeout for it.
+
+        :return: whether the old connection has closed
+        """
+        with self._lock:
+            self._old_closed = True
+        return self._old.close(wait=True, timeout=timeout)
+
+    def __getattr__(self, name):
+        return getattr(self._new, name)
+
+
+def _noop(connection, channel):
+    pass
+
+
+def _cancel_consumers(connection, channel):
+    # messages that the consumers received, but were not yet passed to them,
+    # are requeued by pika
+    for consumer_tag in list(channel.consumer_tags):
+        channel.basic_cancel(consumer_tag)
+
+
+class AgentWorker(object):
+    """Runs the agent consumers, and moves them over to new brokers.
+
+    When the agent is told that the cluster has changed, a connection to
+    the new brokers is made first, and the consumers on it start
+    receiving tasks. Only then the consumers on the old connection are
+    cancelled, and the old connection is closed, after the tasks that
+    were received on it have sent their acks. Tasks that are still running
+    send their responses using the new connection.
+
+    Under systemd, the worker notifies systemd when it is ready, and pings
+    the systemd watchdog as long as the connection thread is responsive,
+    so that a worker that got stuck is restarted.
+    """
+
+    def __init__(self, args, journal=None, task_logger=None, notifier=None,
+                 agent_env=None, executor=None):
+        self.args = args
+        self.connection = None
+        self._agent_env = agent_env
+        self._executor = executor
+        self._journal = journal
+        self._task_logger = task_logger
+        self._handlers = []
+        # shared between the connections, so that operations started
+        # before switching brokers can still be cancelled
+        self._operation_registry = ProcessRegistry()
+        self._switch_requested = threading.Event()
+        self._notifier = notifier or readiness.SystemdNotifier()
+        self._last_watchdog = 0
+        self._watchdog_thread = None
+        self._watchdog_stop = threading.Event()
+        self._started_published = False
+
+    def request_broker_switch(self):
+        self._switch_requested.set()
+
+    def _connect(self, connect_timeout=None):
+        handlers = make_handlers(
+            self.args, self._journal, self._task_logger,
+            operation_registry=self._operation_registry,
+            on_cluster_update=self.request_broker_switch,
+            agent_env=self._agent_env,
+            executor=self._executor)
+        connection = self._make_connection(handlers, connect_timeout)
+        consumer_thread = connection.consume_in_thread()
+        return connection, handlers, consumer_thread
+
+    def _make_connection(self, handlers, connect_timeout):
+        return _WorkerConnection(handlers=handlers,
+                                 name=self.args.name,
+                                 connect_timeout=connect_timeout)
+
+    def _reload_broker_config(self):
+        broker_config.load_broker_config()
+        logger.info('Connecting to the new brokers: %s',
+                    broker_config.broker_hostname)
+
+    def run(self):
+        self._start_watchdog()
+        while True:
+            # connecting again: the watchdog keeps being pinged meanwhile
+            self.connection = None
+            try:
+                self.connection, self._handlers, consumer_thread = \
+                    self._connect()
+            except Exception:
+                logger.exception('Error while reading from rabbitmq')
+                self._notifier.status('Cannot connect to rabbitmq, retrying')
+                time.sleep(1)
+                continue
+            self._notify_ready()
+            while consumer_thread.is_alive():
+                if self._switch_requested.wait(1):
+                    self._switch_requested.clear()
+                    consumer_thread = self.switch_brokers() or \
+                        consumer_thread
+            logger.warning('Connection to rabbitmq lost, reconnecting')
+            self._notifier.status('Connection to rabbitmq lost, reconnecting')
+            time.sleep(1)
+
+    def _start_watchdog(self):
+        """Ping the systemd watchdog from a thread of its own.
+
+        Connecting and switching brokers block the main loop for long,
+        possibly longer than the watchdog timeout, so it is not pinged
+        from there.
+        """
+        interval = self._notifier.watchdog_interval
+        if not interval or self._watchdog_thread is not None:
+            return
+        self._watchdog_thread = threading.Thread(
+            target=self._watchdog_loop, args=(min(interval, 1), ),
+            name='systemd-watchdog')
+        self._watchdog_thread.daemon = True
+        self._watchdog_thread.start()
+
+    def _watchdog_loop(self, poll_interval):
+        while not self._watchdog_stop.wait(poll_interval):
+            self._ping_watchdog()
+
+    def _ping_watchdog(self):
+        interval = self._notifier.watchdog_interval
+        if not interval or time.time() - self._last_watchdog < interval:
+            return
+        connection = self.connection
+        if connection is not None and connection.connect_wait.is_set():
+            # make sure that the connection thread is still processing:
+            # if it's stuck, stop pinging, and let systemd restart us.
+            # The interval is already half of the watchdog timeout: a
+            # short probe leaves most of the rest for the ping itself
+            try:
+                connection.channel_method(_noop, timeout=interval / 4)
+            except queue.Empty:
+                logger.error('The connection thread is not responding')
+                return
+        # otherwise, we're connecting or the connection thread is
+        # reconnecting: that is not stuck, and restarting wouldn't help
+        self._notifier.watchdog()
+        self._last_watchdog = time.time()
+
+    def _notify_ready(self):
+        """The consumers are attached: tell whoever started us."""
+        self._notifier.ready(
+            status='Consuming from queue {0}'.format(self.args.queue))
+        if not self._started_published:
+            # only once: reconnecting is not starting
+            self._started_published = readiness.publish_started(
+                self.connection, self.args.queue, self.args.name)
+        if not self.args.name:
+            return
+        try:
+            storage_dir = utils.internal.get_storage_directory()
+        except Exception as e:
+            logger.debug('Not sending the ready message: %s', e)
+            return
+        readiness.notify_ready(
+            readiness.ready_socket_path(storage_dir, self.args.name))
+
+    def switch_brokers(self):
+        """Move the consumers over to the brokers in the broker config.
+
+        :return: the consumer thread of the new connection, or None if
+                 the new brokers could not be connected to
+        """
+        self._reload_broker_config()
+        try:
+            new_connection, new_handlers, consumer_thread = self._connect(
+                connect_timeout=BROKER_SWITCH_TIMEOUT)
+        except Exception as e:
+            logger.error('Could not connect to the new brokers, staying on '
+                         'the current connection: %s', e)
+            return None
+
+        old_connection, old_handlers = self.connection, self._handlers
+        self.connection, self._handlers = new_connection, new_handlers
+
+        switched = _SwitchedConnection(old_connection, new_connection)
+        # when the old brokers are gone, the old connection is reconnecting:
+        # there are no consumers to cancel, and no acks can be sent
+        old_connected = old_connection.connect_wait.is_set()
+        if old_connected:
+            try:
+                old_connection.channel_method(
+                    _cancel_consumers, timeout=BROKER_SWITCH_TIMEOUT)
+            except Exception as e:
+                logger.warning('Could not cancel the consumers on the old '
+                               'connection: %s', e)
+        for handler in old_handlers:
+            # this also stops the watchdog thread of the old consumer
+            handler.retire(switched)
+        if old_connected:
+            deadline = time.time() + BROKER_SWITCH_ACK_TIMEOUT
+            for handler in old_handlers:
+                if not handler.wait_for_acks(max(deadline - time.time(), 0)):
+                    logger.warning('Timed out waiting for the tasks received '
+                                   'from the old brokers to ack them')
+                    break
+        if not switched.close_old(timeout=BROKER_SWITCH_CLOSE_TIMEOUT):
+            logger.warning('The connection to the old brokers is still '
+                           'closing')
+        logger.info('Moved over to the new brokers')
+        return consumer_thread
+
+
 def main():
     global logger
 
@@ -748,20 +1492,30 @@ def main():
     parser.add_argument('--max-workers', default=DEFAULT_MAX_WORKERS, type=int)
     parser.add_argument('--name')
     parser.add_argument('--hooks-queue')
+    parser.add_argument('--agents',
+                        help='serve these agents, a comma separated list '
+                             'of daemon names, instead of a single queue')
     args = parser.parse_args()
 
+    if args.agents:
+        # imported here, because it imports the daemon implementations
+        from cloudify_agent.multi_worker import main as multi_agent_main
+        return multi_agent_main(args.agents.split(','))
+
     if args.name:
         _setup_excepthook(args.name)
     logger = logging.getLogger('worker.{0}'.format(args.name))
     setup_agent_logger(args.name)
-
-    while True:
-        worker = make_amqp_worker(args)
-        try:
-            worker.consume()
-        except Exception:
-            logger.exception('Error while reading from rabbitmq')
-        time.sleep(1)
+    task_logger = TaskLogger.from_env(logger)
+    if task_logger.json_format:
+        use_json_format()
+    journal = _open_task_journal(args.name)
+    # the start operations of the installer, which run in subprocesses,
+    # wait for their agents with it
+    liveness.serve_from_env()
+
+    AgentWorker(args, journal=journal, task_logger=task_logger,
+                notifier=readiness.SystemdNotifier.from_env()).run()
 
 
 if __name__ == '__main__':
@@ -18,7 +18,8 @@ from setuptools import setup
 install_requires = [
     'appdirs',
     'click',
-    'cloudify-common',
+    # the TaskConsumer watchdog hooks that worker._SwitchableConsumer uses
+    'cloudify-common>=7.0.5',
     'jinja2>=3.1.4,<4',
     'packaging',
     'requests>=2.32.0,<3',